@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import subprocess
+import statistics
+import tempfile
+import shutil
+import select
+import json
+import time
+import os
+import sys
+
+# Boots an EOS disk image headless under QEMU over and over and times each boot from the serial console, so
+# changes to boot_builder, the initramfs or its compression can be compared run against run. Like launch.sh each
+# boot starts from a fresh copy of the stock OVMF vars, which also leaves secure boot off so the UKI accepts the
+# console=ttyS0 this script passes it through SMBIOS. The disk is opened with snapshot=on so runs never change it.
+OVMF_CODE_PATH = "/usr/share/edk2-ovmf/x64/OVMF_CODE.4m.fd"
+OVMF_VARS_PATH = "/usr/share/edk2-ovmf/x64/OVMF_VARS.4m.fd"
+
+# Serial output that marks each point of the boot, in the order they happen
+MARKERS = [
+    ("firmware_handoff", "BdsDxe: starting"),
+    ("kernel_start", "Linux version"),
+    ("unlock_prompt", "Enter passphrase for"),
+    ("switch_root", "Welcome to"),
+    ("userspace_ready", "login:"),
+]
+# Stages reported, each from one marker to the next. Unencrypted images have no unlock_prompt so their unlock
+# stage is 0 and initramfs runs up to switch_root.
+STAGES = [
+    ("firmware", "qemu_start", "firmware_handoff"),
+    ("loader_and_kernel", "firmware_handoff", "kernel_start"),
+    ("initramfs", "kernel_start", "unlock_prompt"),
+    ("unlock", "password_sent", "switch_root"),
+    ("userspace", "switch_root", "userspace_ready"),
+    ("total", "qemu_start", "userspace_ready"),
+]
+
+def PrintWarning(message):
+    print(f"\033[93mWarning: {message}\033[0m")
+def PrintError(message):
+    print(f"\033[91mERROR: {message}\033[0m")
+
+def GetAccelArgs(force_tcg):
+    if not force_tcg and os.access("/dev/kvm", os.R_OK | os.W_OK):
+        return [ "-accel", "kvm", "-cpu", "host" ], "kvm"
+    return [ "-accel", "tcg,thread=multi", "-cpu", "max" ], "tcg"
+def MakeQemuArgs(run_dir_path, disk_path, uki_path, accel_args, memory, cpus):
+    vars_path = os.path.join(run_dir_path, "OVMF_VARS.4m.fd")
+    shutil.copyfile(OVMF_VARS_PATH, vars_path)
+    disk_format = "qcow2" if disk_path.endswith(".qcow2") else "raw"
+    args = [ "qemu-system-x86_64" ] + accel_args + [
+        "-smp", f"cores={cpus}",
+        "-m", memory,
+        "-display", "none",
+        "-monitor", "none",
+        "-serial", "stdio",
+        "-no-reboot",
+        "-drive", f"if=pflash,format=raw,readonly=on,file={OVMF_CODE_PATH}",
+        "-drive", f"if=pflash,format=raw,file={vars_path}",
+        # systemd-stub appends this to the UKI's cmdline. Commas are doubled to escape them from qemu.
+        "-smbios", "type=11,value=io.systemd.stub.kernel-cmdline-extra=console=ttyS0,,115200",
+        "-device", "ahci,id=ahci0",
+        "-drive", f"file={disk_path},format={disk_format},if=none,id=hd0,snapshot=on",
+        "-device", f"ide-hd,drive=hd0,bus=ahci0.0,bootindex={1 if uki_path != None else 0}",
+    ]
+    if uki_path != None:
+        # A freshly built UKI boots from a throwaway ESP ahead of the disk's own, which still holds root
+        esp_dir_path = os.path.join(run_dir_path, "esp")
+        os.makedirs(os.path.join(esp_dir_path, "EFI", "BOOT"))
+        shutil.copyfile(uki_path, os.path.join(esp_dir_path, "EFI", "BOOT", "BOOTX64.EFI"))
+        args += [
+            "-drive", f"file=fat:{esp_dir_path},format=raw,if=none,id=esp,readonly=on",
+            "-device", "ide-hd,drive=esp,bus=ahci0.1,bootindex=0",
+        ]
+    return args
+
+def RunBoot(qemu_args, password, timeout, log_path):
+    # Returns the time of every marker seen, in seconds since qemu started
+    times = {}
+    output = b""
+    search_start = 0
+    next_marker = 0
+    start_time = time.monotonic()
+    process = subprocess.Popen(qemu_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    times["qemu_start"] = 0.0
+    try:
+        while next_marker < len(MARKERS):
+            remaining = timeout - (time.monotonic() - start_time)
+            if remaining <= 0:
+                raise Exception(f"Timed out after {timeout}s waiting for \"{MARKERS[next_marker][1]}\".")
+            readable, _, _ = select.select([ process.stdout ], [], [], min(remaining, 1.0))
+            if len(readable) == 0:
+                continue
+            chunk = os.read(process.stdout.fileno(), 65536)
+            now = time.monotonic() - start_time
+            if chunk == b"":
+                raise Exception(f"qemu exited with code {process.wait()} before \"{MARKERS[next_marker][1]}\".")
+            output += chunk
+            # Markers are looked for in order so a later one printed early, like login: in a kernel message,
+            # can't be counted before the ones ahead of it
+            text = output.decode("UTF-8", errors="replace")
+            while next_marker < len(MARKERS):
+                name, marker = MARKERS[next_marker]
+                index = text.find(marker, search_start)
+                if index == -1 and name == "unlock_prompt" and text.find(MARKERS[next_marker + 1][1], search_start) != -1:
+                    next_marker += 1
+                    continue
+                if index == -1:
+                    break
+                times[name] = round(now, 3)
+                search_start = index + len(marker)
+                next_marker += 1
+                if name == "unlock_prompt":
+                    if password == None:
+                        raise Exception("The image is encrypted. Pass --password-file to unlock it.")
+                    process.stdin.write((password + "\n").encode("UTF-8"))
+                    process.stdin.flush()
+                    times["password_sent"] = round(time.monotonic() - start_time, 3)
+    finally:
+        process.kill()
+        process.wait()
+        with open(log_path, "wb") as file:
+            file.write(output)
+    if not "unlock_prompt" in times:
+        times["unlock_prompt"] = times["switch_root"]
+        times["password_sent"] = times["switch_root"]
+    return times
+
+def Summarize(values):
+    values = sorted(values)
+    return {
+        "min": values[0],
+        "median": round(statistics.median(values), 3),
+        "mean": round(statistics.fmean(values), 3),
+        "p90": values[min(len(values) - 1, int(len(values) * 0.9))],
+        "max": values[-1],
+        "stdev": round(statistics.stdev(values), 3) if len(values) > 1 else 0.0,
+    }
+
+def Main():
+    script_name = os.path.basename(__file__)
+    usage = f"Usage: {script_name} [--runs N] [--uki file.efi] [--password-file path] [--tcg] [--timeout seconds] [--memory 4G] [--cpus 4] [--json report.json] [--log-dir dir] <disk image>"
+    args = sys.argv[1:]
+    options = { "--runs": "5", "--uki": None, "--password-file": None, "--timeout": None, "--memory": "4G", "--cpus": "4", "--json": None, "--log-dir": None }
+    force_tcg = False
+    disk_path = None
+    while len(args) != 0:
+        arg = args.pop(0)
+        if arg == "--tcg":
+            force_tcg = True
+        elif arg in options and len(args) != 0:
+            options[arg] = args.pop(0)
+        elif not arg.startswith("--") and disk_path == None:
+            disk_path = os.path.realpath(arg)
+        else:
+            PrintError(usage)
+            return 1
+    if disk_path == None or not os.path.exists(disk_path):
+        PrintError(usage)
+        return 1
+    for required_path in [ OVMF_CODE_PATH, OVMF_VARS_PATH ] + ([ options["--uki"] ] if options["--uki"] != None else []):
+        if not os.path.exists(required_path):
+            PrintError(f"\"{required_path}\" does not exist.")
+            return 1
+    if shutil.which("qemu-system-x86_64") == None:
+        PrintError("qemu-system-x86_64 is not installed.")
+        return 1
+    password = None
+    if options["--password-file"] != None:
+        with open(options["--password-file"], "r", encoding="UTF-8") as file:
+            password = file.read().rstrip("\n")
+    accel_args, accel = GetAccelArgs(force_tcg)
+    if accel == "tcg" and not force_tcg:
+        PrintWarning("KVM is unavailable. Falling back to TCG, which is many times slower.")
+    # TCG emulates every instruction so the same boot takes several minutes
+    timeout = int(options["--timeout"]) if options["--timeout"] != None else (180 if accel == "kvm" else 1200)
+    run_count = int(options["--runs"])
+
+    runs = []
+    work_dir_path = tempfile.mkdtemp(prefix="boot_bench.")
+    try:
+        for run_index in range(run_count):
+            run_dir_path = os.path.join(work_dir_path, str(run_index))
+            os.makedirs(run_dir_path)
+            log_dir_path = options["--log-dir"] if options["--log-dir"] != None else run_dir_path
+            os.makedirs(log_dir_path, exist_ok=True)
+            log_path = os.path.join(log_dir_path, f"serial.{run_index}.log")
+            qemu_args = MakeQemuArgs(run_dir_path, disk_path, options["--uki"], accel_args, options["--memory"], options["--cpus"])
+            try:
+                times = RunBoot(qemu_args, password, timeout, log_path)
+            except Exception as exception:
+                PrintError(f"Run {run_index + 1} failed. {exception}")
+                with open(log_path, "r", encoding="UTF-8", errors="replace") as file:
+                    for line in file.read().splitlines()[-20:]:
+                        print(f"    {line}")
+                return 1
+            stages = { name: round(times[end] - times[start], 3) for name, start, end in STAGES }
+            runs.append({ "markers": times, "stages": stages })
+            print(f"Run {run_index + 1}/{run_count}: " + ", ".join([ f"{name} {seconds:.2f}s" for name, seconds in stages.items() ]))
+    finally:
+        shutil.rmtree(work_dir_path)
+
+    report = {
+        "version": 1,
+        "disk": disk_path,
+        "uki": options["--uki"],
+        "accel": accel,
+        "runs": runs,
+        "stages": { name: Summarize([ run["stages"][name] for run in runs ]) for name, _, _ in STAGES },
+    }
+    print()
+    print(f"{"Stage":<20} {"Min":>8} {"Median":>8} {"Mean":>8} {"P90":>8} {"Max":>8} {"Stdev":>8}  ({run_count} runs, {accel})")
+    for name, summary in report["stages"].items():
+        print(f"{name:<20} " + " ".join([ f"{summary[key]:>7.2f}s" for key in [ "min", "median", "mean", "p90", "max", "stdev" ] ]))
+    if options["--json"] != None:
+        with open(options["--json"], "w", encoding="UTF-8") as file:
+            file.write(json.dumps(report, indent=4) + "\n")
+    return 0
+if __name__ == "__main__":
+    sys.exit(Main())
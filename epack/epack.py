@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+import tarfile
+import concurrent.futures
+import collections
+import hashlib
+import shutil
+import ctypes
+import struct
+import gzip
+import zlib
+import stat
+import uuid
+import io
+import json
+import pwd
+import sys
+import grp
+import os
+
+import epack_store
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_MAX_SIZE = 1024 * 1024
+INDEX_NAME = ".epack-index.json"
+COPY_BUFFER_SIZE = 1024 * 1024
+FOOTER_SIZE = 42
+CURRENT_NAME = ".current"
+AT_FDCWD = -100
+RENAME_EXCHANGE = 0x2
+
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+def OpenEpackStream(file):
+    # GzipFile is used instead of r|gz because tarfile's own stream stops after the first gzip member
+    return tarfile.open(fileobj=gzip.GzipFile(fileobj=file, mode="rb"), mode="r|")
+def NormalizeEntryName(name):
+    # Rejects anything that could land outside of the app's folder
+    if name.startswith("/") or "\\" in name:
+        raise Exception(f"Absolute or invalid path \"{name}\" in epack.")
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    parts = name.split("/")
+    if name == "" or name == ".":
+        return ""
+    if any([ part == ".." or part == "" for part in parts ]):
+        raise Exception(f"Path \"{name}\" escapes the epack root.")
+    return "/".join([ part for part in parts if part != "." ])
+def AuditEntry(member, name, symlink_names):
+    if member.mode & (stat.S_ISUID | stat.S_ISGID | stat.S_ISVTX):
+        raise Exception(f"Setuid, setgid, or sticky bit on \"{name}\" is not allowed in epacks.")
+    if member.ischr() or member.isblk() or member.isfifo() or member.isdev():
+        raise Exception(f"Device node or fifo \"{name}\" is not allowed in epacks.")
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        raise Exception(f"Unsupported entry type for \"{name}\" in epack.")
+    parts = name.split("/")
+    for i in range(1, len(parts)):
+        if "/".join(parts[:i]) in symlink_names:
+            raise Exception(f"Path \"{name}\" passes through a symlink.")
+    if member.issym():
+        if member.linkname.startswith("/"):
+            raise Exception(f"Symlink \"{name}\" has an absolute target.")
+        target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+        if target == ".." or target.startswith("../"):
+            raise Exception(f"Symlink \"{name}\" points outside of the epack.")
+    if member.islnk():
+        NormalizeEntryName(member.linkname)
+def ReadManifestBytes(tar, member):
+    if not member.isfile():
+        raise Exception(f"{MANIFEST_NAME} must be a regular file.")
+    if member.size > MANIFEST_MAX_SIZE:
+        raise Exception(f"{MANIFEST_NAME} is larger than {MANIFEST_MAX_SIZE} bytes.")
+    return tar.extractfile(member).read()
+def ParseManifest(manifest_bytes):
+    manifest = json.loads(manifest_bytes.decode("UTF-8"))
+    if not isinstance(manifest, dict):
+        raise Exception(f"{MANIFEST_NAME} must contain a json object.")
+    for key in [ "uuid", "name" ]:
+        if not isinstance(manifest.get(key), str) or manifest[key] == "":
+            raise Exception(f"{MANIFEST_NAME} is missing required field \"{key}\".")
+    manifest["uuid"] = str(uuid.UUID(manifest["uuid"]))
+    files = manifest.get("files", {})
+    if not isinstance(files, dict) or not all([ isinstance(file_hash, str) for file_hash in files.values() ]):
+        raise Exception(f"{MANIFEST_NAME} field \"files\" must map names to sha256 hashes.")
+    if not all([ c.isalnum() or c in "_-." for c in manifest["name"] ]):
+        raise Exception(f"App name \"{manifest["name"]}\" contains invalid characters.")
+    return manifest
+
+def ReadManifest(epack_path):
+    # Seekable epacks read the manifest straight from the index. Otherwise stop reading as soon as the
+    # manifest is found so only the front of the archive is decompressed.
+    if IsSeekableEpack(epack_path):
+        with SeekableEpack(epack_path) as epack:
+            return epack.ReadManifest()
+    with open(epack_path, "rb") as file:
+        with OpenEpackStream(file) as tar:
+            for member in tar:
+                if NormalizeEntryName(member.name) == MANIFEST_NAME:
+                    return ParseManifest(ReadManifestBytes(tar, member))
+    raise Exception(f"\"{epack_path}\" does not contain a {MANIFEST_NAME}.")
+
+def ExtractEpack(epack_path, apps_dir_path="/apps"):
+    # Single streaming pass over the archive. Entries are audited as they go by and written to a staging folder
+    # next to /apps/<uuid> which is renamed into place once the manifest has told us the uuid. File contents go
+    # into the shared object store and are hardlinked into bin so files already installed never take up space twice.
+    os.makedirs(apps_dir_path, exist_ok=True)
+    store_path = epack_store.GetStorePath(apps_dir_path)
+    staging_path = os.path.join(apps_dir_path, f".epack-{uuid.uuid4()}")
+    staging_bin_path = os.path.join(staging_path, "bin")
+    os.makedirs(staging_bin_path, mode=0o700)
+    manifest = None
+    seen_names = set()
+    symlink_names = set()
+    file_names = set()
+    dir_paths = []
+    try:
+        with open(epack_path, "rb") as file:
+            with OpenEpackStream(file) as tar:
+                for member in tar:
+                    name = NormalizeEntryName(member.name)
+                    if name == "" or name == INDEX_NAME:
+                        continue
+                    if name in seen_names:
+                        raise Exception(f"Duplicate entry \"{name}\" in epack.")
+                    seen_names.add(name)
+                    # epack build always writes the manifest first. Every file after it is checked against its hash.
+                    if name == MANIFEST_NAME and manifest == None and len(seen_names) == 1:
+                        manifest = ParseManifest(ReadManifestBytes(tar, member))
+                        continue
+                    if manifest == None:
+                        raise Exception(f"\"{epack_path}\" does not start with a {MANIFEST_NAME}.")
+                    AuditEntry(member, name, symlink_names)
+                    dest_path = os.path.join(staging_bin_path, name)
+                    MakeStagedDirs(staging_bin_path, os.path.dirname(dest_path), dir_paths)
+                    if member.isdir():
+                        MakeStagedDirs(staging_bin_path, dest_path, dir_paths)
+                    elif member.issym():
+                        os.symlink(member.linkname, dest_path)
+                        symlink_names.add(name)
+                    elif member.islnk():
+                        link_name = NormalizeEntryName(member.linkname)
+                        if not link_name in seen_names or link_name in symlink_names or link_name == MANIFEST_NAME:
+                            raise Exception(f"Hardlink \"{name}\" points to an entry which was not extracted.")
+                        os.link(os.path.join(staging_bin_path, link_name), dest_path, follow_symlinks=False)
+                    else:
+                        expected_hash = manifest.get("files", {}).get(name)
+                        if not isinstance(expected_hash, str):
+                            raise Exception(f"\"{name}\" is not listed in {MANIFEST_NAME}.")
+                        object_path = epack_store.StoreObject(store_path, tar.extractfile(member), member.mode & 0o111 != 0, expected_hash)
+                        epack_store.LinkObject(object_path, dest_path)
+                        file_names.add(name)
+        if manifest == None:
+            raise Exception(f"\"{epack_path}\" does not contain a {MANIFEST_NAME}.")
+        # The installed manifest decides which objects later deltas may reuse so it may only list what was extracted
+        if set(manifest.get("files", {}).keys()) != file_names:
+            raise Exception(f"{MANIFEST_NAME} lists files \"{epack_path}\" does not contain.")
+
+        old_objects = CommitStagedApp(apps_dir_path, store_path, staging_path, manifest, dir_paths, symlink_names)
+    finally:
+        RemoveTree(staging_path)
+    epack_store.ReleaseObjects(old_objects)
+    return manifest
+
+def CommitStagedApp(apps_dir_path, store_path, staging_path, manifest, dir_paths, symlink_names):
+    # Shared by full installs and delta updates. staging_path/bin must be fully populated. Returns the objects
+    # the replaced version referenced so they can be released once the staging folder is gone.
+    staging_bin_path = os.path.join(staging_path, "bin")
+    # Folders are reset to r-x------ owned by the app. Files are shared store objects and keep root ownership.
+    owner = GetAppOwner(manifest["name"]) if os.geteuid() == 0 else None
+    WriteManifest(os.path.join(staging_path, MANIFEST_NAME), manifest)
+    for dir_path in reversed(dir_paths + [ staging_bin_path ]):
+        if owner != None:
+            os.chown(dir_path, owner[0], owner[1], follow_symlinks=False)
+        os.chmod(dir_path, 0o500)
+    if owner != None:
+        for link_path in [ os.path.join(staging_bin_path, name) for name in symlink_names ]:
+            os.chown(link_path, owner[0], owner[1], follow_symlinks=False)
+
+    # bin and the manifest live together in a version folder. /apps/<uuid>/bin and /apps/<uuid>/manifest.json are
+    # fixed symlinks through /apps/<uuid>/.current so one rename swaps both at once. Data is kept.
+    app_path = os.path.join(apps_dir_path, manifest["uuid"])
+    os.makedirs(app_path, mode=0o755, exist_ok=True)
+    if os.path.isdir(os.path.join(app_path, "bin")) and not os.path.islink(os.path.join(app_path, "bin")):
+        AdoptUnversionedApp(app_path)
+    version_name = f".v-{uuid.uuid4()}"
+    version_path = os.path.join(app_path, version_name)
+    os.mkdir(version_path, mode=0o755)
+    os.rename(staging_bin_path, os.path.join(version_path, "bin"))
+    os.rename(os.path.join(staging_path, MANIFEST_NAME), os.path.join(version_path, MANIFEST_NAME))
+    ReplaceWithSymlink(os.path.join(app_path, CURRENT_NAME), version_name)
+    for name in [ "bin", MANIFEST_NAME ]:
+        if not os.path.islink(os.path.join(app_path, name)):
+            ReplaceWithSymlink(os.path.join(app_path, name), f"{CURRENT_NAME}/{name}")
+
+    # Every other version, including any an interrupted install left behind, is moved into staging to be deleted
+    old_objects = []
+    for name in os.listdir(app_path):
+        if not name.startswith(".v-") or name == version_name:
+            continue
+        old_manifest_path = os.path.join(app_path, name, MANIFEST_NAME)
+        if os.path.exists(old_manifest_path):
+            with open(old_manifest_path, "r", encoding="UTF-8") as old_manifest_file:
+                old_objects += epack_store.GetManifestObjects(store_path, json.load(old_manifest_file))
+        os.rename(os.path.join(app_path, name), os.path.join(staging_path, name))
+    return old_objects
+def ReplaceWithSymlink(link_path, target):
+    temp_path = os.path.join(os.path.dirname(link_path), f".tmp-{uuid.uuid4()}")
+    os.symlink(target, temp_path)
+    os.replace(temp_path, link_path)
+def ExchangePaths(path_a, path_b):
+    if LIBC.renameat2(AT_FDCWD, path_a.encode("UTF-8"), AT_FDCWD, path_b.encode("UTF-8"), RENAME_EXCHANGE) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"Failed to exchange \"{path_a}\" and \"{path_b}\". {os.strerror(errno)}")
+def AdoptUnversionedApp(app_path):
+    # Apps installed before version folders had a real bin folder and manifest. They are moved into a version
+    # folder without ever showing a missing bin or a bin that doesn't match the manifest.
+    version_path = os.path.join(app_path, f".v-{uuid.uuid4()}")
+    os.mkdir(version_path, mode=0o755)
+    os.symlink(f"{CURRENT_NAME}/bin", os.path.join(version_path, "bin"))
+    if os.path.exists(os.path.join(app_path, MANIFEST_NAME)):
+        os.link(os.path.join(app_path, MANIFEST_NAME), os.path.join(version_path, MANIFEST_NAME))
+    ReplaceWithSymlink(os.path.join(app_path, CURRENT_NAME), os.path.basename(version_path))
+    # The symlink lands in bin and resolves through .current to the real folder now in the version folder
+    ExchangePaths(os.path.join(app_path, "bin"), os.path.join(version_path, "bin"))
+    ReplaceWithSymlink(os.path.join(app_path, MANIFEST_NAME), f"{CURRENT_NAME}/{MANIFEST_NAME}")
+def GetAppOwner(app_name):
+    try:
+        return (pwd.getpwnam(app_name).pw_uid, grp.getgrnam(app_name).gr_gid)
+    except KeyError:
+        raise Exception(f"No user and group named {app_name} exist to own the app's files.")
+def WriteManifest(manifest_path, manifest):
+    # The manifest lists the hash of every file the app ships so only root may read it
+    with open(manifest_path, "w", encoding="UTF-8") as file:
+        os.fchmod(file.fileno(), 0o600)
+        json.dump(manifest, file, indent=4, sort_keys=True)
+def MakeStagedDirs(staging_bin_path, dir_path, dir_paths):
+    # Folders are made on demand so a folder entry may come after its children or not at all. Every folder made is
+    # recorded in dir_paths, parents first, so CommitStagedApp hands all of them to the app.
+    missing_paths = []
+    while dir_path != staging_bin_path and not os.path.lexists(dir_path):
+        missing_paths.append(dir_path)
+        dir_path = os.path.dirname(dir_path)
+    for missing_path in reversed(missing_paths):
+        os.mkdir(missing_path, mode=0o700)
+        dir_paths.append(missing_path)
+def RemoveTree(path):
+    # Extracted folders are read only so they need write access back before they can be deleted
+    if not os.path.lexists(path):
+        return
+    for root, dir_names, file_names in os.walk(path):
+        os.chmod(root, 0o700)
+    shutil.rmtree(path)
+
+# Seekable epacks store every tar entry in its own gzip member. Concatenated gzip members are still one valid
+# .tgz but any single member can be decompressed on its own. After the entries comes one more member holding
+# INDEX_NAME (the offset and length of every entry's member) plus the end of archive blocks, and finally an empty
+# FOOTER_SIZE byte member whose gzip extra field stores where the index member starts.
+def PadTarData(size):
+    return b"\x00" * ((tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+def IterateEntryBlocks(entries, block_size):
+    # Yields the raw tar bytes of every entry cut into block_size pieces as (entry number, block, is last)
+    for entry_number, (tarinfo, source) in enumerate(entries):
+        buffer = bytearray(tarinfo.tobuf(tarfile.PAX_FORMAT, "UTF-8", "surrogateescape"))
+        if source != None and tarinfo.isfile():
+            source_file = open(source, "rb") if isinstance(source, str) else source
+            try:
+                remaining = tarinfo.size
+                while remaining > 0:
+                    data = source_file.read(min(block_size, remaining))
+                    if len(data) == 0:
+                        raise Exception(f"Unexpected end of data for \"{tarinfo.name}\".")
+                    remaining -= len(data)
+                    buffer += data
+                    while len(buffer) >= block_size:
+                        yield entry_number, bytes(buffer[:block_size]), False
+                        del buffer[:block_size]
+            finally:
+                if isinstance(source, str):
+                    source_file.close()
+            buffer += PadTarData(tarinfo.size)
+        yield entry_number, bytes(buffer), True
+def DeflateBlock(block, previous_block, is_last, level):
+    # pigz style: every block is compressed on its own, primed with the last 32K of the block before it, and
+    # ends on a byte boundary so the raw deflate streams can simply be concatenated into one gzip member
+    if previous_block == None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, previous_block[-32768:])
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+def BuildMemberHeader(level):
+    return b"\x1f\x8b\x08\x00\x00\x00\x00\x00" + (b"\x02" if level == 9 else b"\x04" if level == 1 else b"\x00") + b"\xff"
+def BuildFooter(index_offset):
+    payload = f"{index_offset:016x}".encode("ascii")
+    extra = b"EP" + struct.pack("<H", len(payload)) + payload
+    header = b"\x1f\x8b\x08\x04" + b"\x00\x00\x00\x00" + b"\x00\xff" + struct.pack("<H", len(extra)) + extra
+    return header + b"\x03\x00" + struct.pack("<II", 0, 0)
+def ParseFooter(footer):
+    if len(footer) != FOOTER_SIZE or footer[:4] != b"\x1f\x8b\x08\x04" or footer[12:14] != b"EP":
+        return None
+    return int(footer[16:32].decode("ascii"), 16)
+def WriteSeekableEpack(out_path, entries, jobs=None, level=9, block_size=COPY_BUFFER_SIZE):
+    # entries is an iterable of (TarInfo, path or file object or None) with the manifest expected first.
+    # Blocks are deflated across all cores and written back in order so the output never depends on jobs.
+    jobs = jobs or os.cpu_count() or 1
+    index = {}
+    names = []
+    in_flight = collections.deque()
+    previous_block = None
+    crc = 0
+    entry_size = 0
+    def WriteOldest(out_file):
+        entry_number, is_first, is_last, future, entry_crc, entry_size = in_flight.popleft()
+        if is_first:
+            index[names[entry_number]] = [ out_file.tell(), 0 ]
+            out_file.write(BuildMemberHeader(level))
+        out_file.write(future.result())
+        if is_last:
+            out_file.write(struct.pack("<II", entry_crc, entry_size & 0xFFFFFFFF))
+            index[names[entry_number]][1] = out_file.tell() - index[names[entry_number]][0]
+    def NameEntries():
+        for tarinfo, source in entries:
+            names.append(NormalizeEntryName(tarinfo.name))
+            yield tarinfo, source
+    with open(out_path, "wb") as out_file:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            is_first = True
+            for entry_number, block, is_last in IterateEntryBlocks(NameEntries(), block_size):
+                future = executor.submit(DeflateBlock, block, previous_block, is_last, level)
+                crc = zlib.crc32(block, crc)
+                entry_size += len(block)
+                in_flight.append((entry_number, is_first, is_last, future, crc, entry_size))
+                previous_block = None if is_last else block
+                if is_last:
+                    crc = 0
+                    entry_size = 0
+                is_first = is_last
+                if len(in_flight) >= jobs * 2:
+                    WriteOldest(out_file)
+            while len(in_flight) != 0:
+                WriteOldest(out_file)
+        index_offset = out_file.tell()
+        index_bytes = json.dumps({ "version": 1, "entries": index }, sort_keys=True, separators=(",", ":")).encode("UTF-8")
+        index_info = tarfile.TarInfo(INDEX_NAME)
+        index_info.size = len(index_bytes)
+        index_info.mode = 0o400
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        out_file.write(compressor.compress(index_info.tobuf(tarfile.PAX_FORMAT, "UTF-8", "surrogateescape") + index_bytes + PadTarData(len(index_bytes))))
+        out_file.write(compressor.compress(b"\x00" * (tarfile.BLOCKSIZE * 2)))
+        out_file.write(compressor.flush())
+        out_file.write(BuildFooter(index_offset))
+def ConvertToSeekable(epack_path, out_path):
+    with open(epack_path, "rb") as file:
+        with OpenEpackStream(file) as tar:
+            WriteSeekableEpack(out_path, ((member, tar.extractfile(member) if member.isfile() else None) for member in tar if NormalizeEntryName(member.name) != INDEX_NAME))
+def IsSeekableEpack(epack_path):
+    with open(epack_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < FOOTER_SIZE:
+            return False
+        file.seek(-FOOTER_SIZE, os.SEEK_END)
+        return ParseFooter(file.read(FOOTER_SIZE)) != None
+class SeekableEpack:
+    def __init__(self, epack_path):
+        self.file = open(epack_path, "rb")
+        try:
+            file_size = os.fstat(self.file.fileno()).st_size
+            self.file.seek(max(0, file_size - FOOTER_SIZE))
+            index_offset = ParseFooter(self.file.read(FOOTER_SIZE))
+            if index_offset == None or index_offset > file_size - FOOTER_SIZE:
+                raise Exception(f"\"{epack_path}\" is not a seekable epack.")
+            index_info, index_bytes = self.ReadMember(index_offset, file_size - FOOTER_SIZE - index_offset)
+            if index_info.name != INDEX_NAME:
+                raise Exception(f"\"{epack_path}\" has a corrupt index.")
+            self.index = json.loads(index_bytes.decode("UTF-8"))["entries"]
+        except:
+            self.file.close()
+            raise
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+    def Close(self):
+        self.file.close()
+    def ReadMember(self, offset, length):
+        # Only this one member is read and decompressed
+        self.file.seek(offset)
+        buffer = zlib.decompress(self.file.read(length), 31)
+        with tarfile.open(fileobj=io.BytesIO(buffer), mode="r|") as tar:
+            tarinfo = tar.next()
+            if tarinfo == None:
+                raise Exception(f"Empty member at offset {offset}.")
+            data = tar.extractfile(tarinfo).read() if tarinfo.isfile() else None
+            return tarinfo, data
+    def List(self):
+        return sorted(self.index.keys())
+    def GetInfo(self, name):
+        name = NormalizeEntryName(name)
+        if not name in self.index:
+            raise Exception(f"\"{name}\" is not in this epack.")
+        return self.ReadMember(self.index[name][0], self.index[name][1])[0]
+    def ReadFile(self, name):
+        name = NormalizeEntryName(name)
+        if not name in self.index:
+            raise Exception(f"\"{name}\" is not in this epack.")
+        tarinfo, data = self.ReadMember(self.index[name][0], self.index[name][1])
+        if data == None:
+            raise Exception(f"\"{name}\" is not a regular file.")
+        return data
+    def ReadManifest(self):
+        return ParseManifest(self.ReadFile(MANIFEST_NAME))
+
+def HashFile(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while True:
+            buffer = file.read(COPY_BUFFER_SIZE)
+            if len(buffer) == 0:
+                return sha256.hexdigest()
+            sha256.update(buffer)
+def CollectBuildEntries(source_dir_path, mtime_limit):
+    # Sorted by path so parents come before their children and the order never depends on the filesystem
+    rel_paths = []
+    for root, dir_names, file_names in os.walk(source_dir_path):
+        for entry_name in dir_names + file_names:
+            rel_paths.append(os.path.relpath(os.path.join(root, entry_name), source_dir_path))
+    entries = []
+    symlink_names = set()
+    for rel_path in sorted(rel_paths):
+        name = NormalizeEntryName(rel_path.replace(os.sep, "/"))
+        if name == MANIFEST_NAME or name == INDEX_NAME:
+            continue
+        source_path = os.path.join(source_dir_path, rel_path)
+        st = os.lstat(source_path)
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = min(int(st.st_mtime), mtime_limit)
+        tarinfo.uid = 0
+        tarinfo.gid = 0
+        tarinfo.uname = ""
+        tarinfo.gname = ""
+        if stat.S_ISDIR(st.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o500
+            source_path = None
+        elif stat.S_ISLNK(st.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(source_path)
+            tarinfo.mode = 0o777
+            source_path = None
+        elif stat.S_ISREG(st.st_mode):
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = st.st_size
+            tarinfo.mode = 0o500 if st.st_mode & 0o111 else 0o400
+        else:
+            raise Exception(f"\"{source_path}\" is not a regular file, folder, or symlink.")
+        AuditEntry(tarinfo, name, symlink_names)
+        if tarinfo.issym():
+            symlink_names.add(name)
+        entries.append((tarinfo, source_path))
+    return entries
+def BuildEpack(source_dir_path, out_path, name=None, app_uuid=None, version=None, jobs=None):
+    # Byte reproducible: sorted entries, normalized owners and modes, clamped mtimes and a fixed block size
+    mtime_limit = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+    manifest = {}
+    manifest_path = os.path.join(source_dir_path, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="UTF-8") as file:
+            manifest = json.load(file)
+    manifest["name"] = name or manifest.get("name") or os.path.basename(os.path.realpath(source_dir_path))
+    manifest["uuid"] = app_uuid or manifest.get("uuid") or str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{manifest["name"]}.epack"))
+    if version != None:
+        manifest["version"] = version
+    entries = CollectBuildEntries(source_dir_path, mtime_limit)
+    file_entries = [ (tarinfo, source_path) for tarinfo, source_path in entries if tarinfo.isfile() ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        hashes = list(executor.map(HashFile, [ source_path for tarinfo, source_path in file_entries ]))
+    manifest["files"] = { tarinfo.name: file_hash for (tarinfo, source_path), file_hash in zip(file_entries, hashes) }
+    manifest = ParseManifest(json.dumps(manifest).encode("UTF-8"))
+    manifest_bytes = (json.dumps(manifest, indent=4, sort_keys=True) + "\n").encode("UTF-8")
+    manifest_info = tarfile.TarInfo(MANIFEST_NAME)
+    manifest_info.size = len(manifest_bytes)
+    manifest_info.mode = 0o400
+    manifest_info.mtime = 0
+    WriteSeekableEpack(out_path, [ (manifest_info, io.BytesIO(manifest_bytes)) ] + entries, jobs=jobs)
+    return manifest
+
+def Main():
+    script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
+    usage = [
+        f"Usage:",
+        f"    {script_name} build <dir> [-o <out.epack>] [--name <name>] [--uuid <uuid>] [--version <version>] [--jobs <count>]",
+        f"    {script_name} manifest <file.epack>",
+        f"    {script_name} list <file.epack>",
+        f"    {script_name} install <file.epack> [--apps <dir>]",
+        f"    {script_name} delta <old.epack> <new.epack> [-o <out.epack-delta>] [--jobs <count>]",
+        f"    {script_name} apply-delta <file.epack-delta> [--apps <dir>] [--fallback <file.epack>]",
+        f"    {script_name} sign <file.epack> --key <private key.pem> --domain <domain> --key-id <key id>",
+        f"    {script_name} verify <file.epack>...",
+        f"    {script_name} gc [--apps <dir>]",
+        f"    {script_name} launch [--apps <dir>] [--timing] <uuid | name> [program] [args...]",
+        f"    {script_name} zygote [--apps <dir>]",
+    ]
+    args = sys.argv[1:]
+    if len(args) >= 1 and args[0] == "launch":
+        # Everything after the app is handed to it untouched so it is parsed before the options below
+        import epack_launch
+        args = args[1:]
+        apps_dir_path = "/apps"
+        timing = False
+        while len(args) != 0 and args[0].startswith("--"):
+            if args[0] == "--timing":
+                timing = True
+                args = args[1:]
+            elif args[0] == "--apps" and len(args) >= 2:
+                apps_dir_path = args[1]
+                args = args[2:]
+            else:
+                break
+        if len(args) < 1:
+            print("\n".join(usage))
+            return 1
+        return epack_launch.LaunchApp(args[0], args[1] if len(args) >= 2 else None, args[2:], apps_dir_path, timing)
+    if len(args) < 1 or (len(args) < 2 and not args[0] in [ "gc", "zygote" ]):
+        print("\n".join(usage))
+        return 1
+    options = {}
+    positionals = []
+    i = 0
+    while i < len(args):
+        if args[i].startswith("-"):
+            if i + 1 >= len(args):
+                print(f"Missing value for {args[i]}.")
+                return 1
+            options[args[i].lstrip("-")] = args[i + 1]
+            i += 2
+        else:
+            positionals.append(args[i])
+            i += 1
+    command = positionals[0]
+    if command == "build":
+        source_dir_path = positionals[1].rstrip("/")
+        out_path = options.get("o", options.get("output", f"{os.path.basename(os.path.realpath(source_dir_path))}.epack"))
+        jobs = int(options["jobs"]) if "jobs" in options else None
+        manifest = BuildEpack(source_dir_path, out_path, options.get("name"), options.get("uuid"), options.get("version"), jobs)
+        print(f"Built {manifest["name"]} ({manifest["uuid"]}) with {len(manifest["files"])} files to \"{out_path}\".")
+    elif command == "manifest":
+        print(json.dumps(ReadManifest(positionals[1]), indent=4, sort_keys=True))
+    elif command == "list":
+        if IsSeekableEpack(positionals[1]):
+            with SeekableEpack(positionals[1]) as epack:
+                print("\n".join(epack.List()))
+        else:
+            with open(positionals[1], "rb") as file:
+                with OpenEpackStream(file) as tar:
+                    for member in tar:
+                        print(NormalizeEntryName(member.name))
+    elif command == "install":
+        manifest = ExtractEpack(positionals[1], options.get("apps", "/apps"))
+        print(f"Installed {manifest["name"]} to \"{os.path.join(options.get("apps", "/apps"), manifest["uuid"])}\".")
+    elif command == "delta":
+        import epack_delta
+        out_path = options.get("o", options.get("output", f"{os.path.splitext(os.path.basename(positionals[2]))[0]}.epack-delta"))
+        jobs = int(options["jobs"]) if "jobs" in options else None
+        delta = epack_delta.MakeDelta(positionals[1], positionals[2], out_path, jobs)
+        patch_count = len([ payload for payload in delta["payloads"].values() if payload["source"] == "patch" ])
+        print(f"Wrote \"{out_path}\" with {len(delta["payloads"]) - patch_count} new and {patch_count} patched files ({os.path.getsize(out_path)} bytes).")
+    elif command == "apply-delta":
+        import epack_delta
+        manifest, used_delta = epack_delta.ApplyDelta(positionals[1], options.get("apps", "/apps"), options.get("fallback"))
+        print(f"Updated {manifest["name"]} in \"{os.path.join(options.get("apps", "/apps"), manifest["uuid"])}\"{"" if used_delta else " from the full epack"}.")
+    elif command == "gc":
+        freed_bytes = epack_store.CollectGarbage(epack_store.GetStorePath(options.get("apps", "/apps")))
+        print(f"Freed {freed_bytes} bytes of unused app files.")
+    elif command == "zygote":
+        import epack_launch
+        epack_launch.RunZygote(options.get("apps", "/apps"))
+    elif command == "sign":
+        import epack_trust
+        epack_trust.SignEpack(positionals[1], options["key"], options["domain"], options["key-id"])
+        print(f"Signed \"{positionals[1]}\" as {options["domain"]}.")
+    elif command == "verify":
+        import epack_trust
+        status_code = 0
+        results = epack_trust.TrustResolver().VerifyMany(positionals[1:])
+        for epack_path in positionals[1:]:
+            if isinstance(results[epack_path], Exception):
+                print(f"UNTRUSTED {epack_path}: {results[epack_path]}")
+                status_code = 1
+            else:
+                print(f"Trusted {epack_path}: signed by {results[epack_path]}")
+        return status_code
+    else:
+        print("\n".join(usage))
+        return 1
+    return 0
+if __name__ == "__main__":
+    sys.exit(Main())
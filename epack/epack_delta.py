@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import subprocess
+import tempfile
+import tarfile
+import hashlib
+import shutil
+import zlib
+import uuid
+import io
+import json
+import os
+
+import epack
+import epack_store
+
+# A .epack-delta turns one installed version of an app into the next without downloading files it already has.
+# It is a seekable epack whose first entry is delta.json:
+# {
+#     "version": 1,
+#     "uuid": "<app uuid>",
+#     "base_files": { "<name>": "<sha256>" },   the "files" of the manifest the delta applies on top of
+#     "manifest": { ... },                       the new manifest
+#     "entries": [ { "name": "<name>", "type": "dir" | "symlink" | "file", "target": "<symlink target>", "hash": "<sha256>", "executable": true } ],
+#     "payloads": { "<sha256>": { "source": "data" } or { "source": "patch", "base": "<base sha256>" } }
+# }
+# followed by data/<sha256> (the whole file) and patch/<sha256> (zstd --patch-from against the base object) for
+# every new file contents. Contents the base version already has come straight from the object store.
+DELTA_NAME = "delta.json"
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+
+def UnpackEpack(epack_path, dir_path):
+    # Streams an epack into dir_path/<sha256> and returns (manifest, entries). Equal files are only stored once.
+    manifest = None
+    entries = []
+    seen_names = set()
+    symlink_names = set()
+    with open(epack_path, "rb") as file:
+        with epack.OpenEpackStream(file) as tar:
+            for member in tar:
+                name = epack.NormalizeEntryName(member.name)
+                if name == "" or name == epack.INDEX_NAME:
+                    continue
+                if name in seen_names:
+                    raise Exception(f"Duplicate entry \"{name}\" in epack.")
+                seen_names.add(name)
+                if name == epack.MANIFEST_NAME:
+                    manifest = epack.ParseManifest(epack.ReadManifestBytes(tar, member))
+                    continue
+                epack.AuditEntry(member, name, symlink_names)
+                if member.isdir():
+                    entries.append({ "name": name, "type": "dir" })
+                elif member.issym():
+                    entries.append({ "name": name, "type": "symlink", "target": member.linkname })
+                    symlink_names.add(name)
+                elif member.islnk():
+                    raise Exception(f"Hardlink \"{name}\" can't be expressed in a delta. Ship a full epack instead.")
+                else:
+                    temp_path = os.path.join(dir_path, f".tmp-{len(entries)}")
+                    sha256 = hashlib.sha256()
+                    source_file = tar.extractfile(member)
+                    with open(temp_path, "wb") as temp_file:
+                        while True:
+                            buffer = source_file.read(epack.COPY_BUFFER_SIZE)
+                            if len(buffer) == 0:
+                                break
+                            sha256.update(buffer)
+                            temp_file.write(buffer)
+                    os.replace(temp_path, os.path.join(dir_path, sha256.hexdigest()))
+                    entries.append({ "name": name, "type": "file", "hash": sha256.hexdigest(), "executable": member.mode & 0o111 != 0 })
+    if manifest == None:
+        raise Exception(f"\"{epack_path}\" does not contain a {epack.MANIFEST_NAME}.")
+    # Installed apps are matched against deltas by manifest hashes alone so they have to be right
+    if manifest.get("files") != { entry["name"]: entry["hash"] for entry in entries if entry["type"] == "file" }:
+        raise Exception(f"The file hashes in \"{epack_path}\"'s manifest don't match its contents. Rebuild it with epack build.")
+    return manifest, entries
+def GetCompressedSize(file_path):
+    compressor = zlib.compressobj(9)
+    compressed_size = 0
+    with open(file_path, "rb") as file:
+        while True:
+            buffer = file.read(epack.COPY_BUFFER_SIZE)
+            if len(buffer) == 0:
+                return compressed_size + len(compressor.flush())
+            compressed_size += len(compressor.compress(buffer))
+def MakePatch(base_path, new_path, patch_path):
+    # Returns True when the patch is smaller than just shipping the compressed file
+    subprocess.run([ "zstd", "-q", "-f", "-19", "--long=31", f"--patch-from={base_path}", new_path, "-o", patch_path ], capture_output=True, check=True)
+    return os.path.getsize(patch_path) < GetCompressedSize(new_path)
+def MakeDelta(old_epack_path, new_epack_path, out_path, jobs=None):
+    with tempfile.TemporaryDirectory(prefix="epack_delta_") as temp_dir_path:
+        old_dir_path = os.path.join(temp_dir_path, "old")
+        new_dir_path = os.path.join(temp_dir_path, "new")
+        patch_dir_path = os.path.join(temp_dir_path, "patch")
+        for dir_path in [ old_dir_path, new_dir_path, patch_dir_path ]:
+            os.mkdir(dir_path)
+        old_manifest, old_entries = UnpackEpack(old_epack_path, old_dir_path)
+        new_manifest, new_entries = UnpackEpack(new_epack_path, new_dir_path)
+        if old_manifest["uuid"] != new_manifest["uuid"]:
+            raise Exception(f"\"{old_epack_path}\" and \"{new_epack_path}\" are different apps.")
+
+        # Files are patched against the old file with the same name. Without zstd every new file is shipped whole.
+        old_hashes = set(old_manifest["files"].values())
+        payloads = {}
+        patch_candidates = []
+        for entry in new_entries:
+            if entry["type"] != "file" or entry["hash"] in old_hashes or entry["hash"] in payloads:
+                continue
+            payloads[entry["hash"]] = { "source": "data" }
+            base_hash = old_manifest["files"].get(entry["name"])
+            if base_hash != None and shutil.which("zstd") != None:
+                patch_candidates.append((entry["hash"], base_hash))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = [ executor.submit(MakePatch, os.path.join(old_dir_path, base_hash), os.path.join(new_dir_path, new_hash), os.path.join(patch_dir_path, new_hash)) for new_hash, base_hash in patch_candidates ]
+            for (new_hash, base_hash), future in zip(patch_candidates, futures):
+                if future.result():
+                    payloads[new_hash] = { "source": "patch", "base": base_hash }
+
+        delta = { "version": 1, "uuid": new_manifest["uuid"], "base_files": old_manifest["files"], "manifest": new_manifest, "entries": new_entries, "payloads": payloads }
+        delta_bytes = (json.dumps(delta, indent=4, sort_keys=True) + "\n").encode("UTF-8")
+        delta_info = tarfile.TarInfo(DELTA_NAME)
+        delta_info.size = len(delta_bytes)
+        delta_info.mode = 0o400
+        archive_entries = [ (delta_info, io.BytesIO(delta_bytes)) ]
+        for file_hash in sorted(payloads.keys()):
+            source = payloads[file_hash]["source"]
+            source_path = os.path.join(patch_dir_path if source == "patch" else new_dir_path, file_hash)
+            payload_info = tarfile.TarInfo(f"{source}/{file_hash}")
+            payload_info.size = os.path.getsize(source_path)
+            payload_info.mode = 0o400
+            archive_entries.append((payload_info, source_path))
+        epack.WriteSeekableEpack(out_path, archive_entries, jobs=jobs)
+        return delta
+
+def ParseDelta(delta_bytes):
+    delta = json.loads(delta_bytes.decode("UTF-8"))
+    if not isinstance(delta, dict) or delta.get("version") != 1:
+        raise Exception(f"{DELTA_NAME} is not a version 1 delta.")
+    for key, value_type in [ ("base_files", dict), ("manifest", dict), ("entries", list), ("payloads", dict) ]:
+        if not isinstance(delta.get(key), value_type):
+            raise Exception(f"{DELTA_NAME} is missing required field \"{key}\".")
+    delta["manifest"] = epack.ParseManifest(json.dumps(delta["manifest"]).encode("UTF-8"))
+    delta["uuid"] = str(uuid.UUID(delta.get("uuid", "")))
+    if delta["uuid"] != delta["manifest"]["uuid"]:
+        raise Exception(f"{DELTA_NAME} does not match its own manifest.")
+    return delta
+def FindObject(store_path, file_hash):
+    for executable in [ False, True ]:
+        object_path = epack_store.GetObjectPath(store_path, file_hash, executable)
+        if os.path.exists(object_path):
+            return object_path
+    return None
+def GetObject(store_path, file_hash, executable):
+    # Objects are stored once per executable bit so a file that changed mode is copied from its twin
+    object_path = epack_store.GetObjectPath(store_path, file_hash, executable)
+    if os.path.exists(object_path):
+        return object_path
+    twin_path = FindObject(store_path, file_hash)
+    if twin_path == None:
+        raise Exception(f"Object {file_hash} is missing from the store.")
+    with open(twin_path, "rb") as twin_file:
+        return epack_store.StoreObject(store_path, twin_file, executable, file_hash)
+def ReadInstalledManifest(apps_dir_path, app_uuid):
+    manifest_path = os.path.join(apps_dir_path, app_uuid, epack.MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="UTF-8") as file:
+        return json.load(file)
+def ApplyPatch(store_path, base_path, patch_file, executable, file_hash):
+    patch_path = epack_store.NewTempPath(store_path)
+    out_path = epack_store.NewTempPath(store_path)
+    try:
+        with open(patch_path, "wb") as temp_file:
+            shutil.copyfileobj(patch_file, temp_file, epack.COPY_BUFFER_SIZE)
+        subprocess.run([ "zstd", "-d", "-q", "-f", "--long=31", f"--patch-from={base_path}", patch_path, "-o", out_path ], capture_output=True, check=True)
+        return epack_store.AdoptObject(store_path, out_path, executable, file_hash)
+    finally:
+        os.remove(patch_path)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+def ApplyDeltaStream(delta_path, apps_dir_path):
+    # Like ExtractEpack the new bin is staged next to the app and swapped in with one rename so an interrupted
+    # update leaves the old version installed. Nothing the base version already has is read or written.
+    os.makedirs(apps_dir_path, exist_ok=True)
+    store_path = epack_store.GetStorePath(apps_dir_path)
+    with open(delta_path, "rb") as file:
+        with epack.OpenEpackStream(file) as tar:
+            member = tar.next()
+            if member == None or epack.NormalizeEntryName(member.name) != DELTA_NAME or not member.isfile() or member.size > DELTA_MAX_SIZE:
+                raise Exception(f"\"{delta_path}\" does not start with a {DELTA_NAME}.")
+            delta = ParseDelta(tar.extractfile(member).read())
+            installed_manifest = ReadInstalledManifest(apps_dir_path, delta["uuid"])
+            if installed_manifest == None:
+                raise Exception(f"{delta["manifest"]["name"]} is not installed so there is nothing to apply \"{delta_path}\" to.")
+            if installed_manifest.get("files") != delta["base_files"]:
+                raise Exception(f"The installed version of {delta["manifest"]["name"]} is not the one \"{delta_path}\" was made from.")
+            executable_hashes = set([ entry["hash"] for entry in delta["entries"] if entry["type"] == "file" and entry["executable"] ])
+            # Objects not carried in the delta may only come from the installed version, never from another app
+            base_hashes = set(delta["base_files"].values())
+            for entry in delta["entries"]:
+                if entry["type"] == "file" and not entry["hash"] in delta["payloads"] and not entry["hash"] in base_hashes:
+                    raise Exception(f"Object {entry["hash"]} for \"{entry["name"]}\" is not part of the installed version.")
+                if entry["type"] == "file" and not entry["hash"] in delta["payloads"] and FindObject(store_path, entry["hash"]) == None:
+                    raise Exception(f"Object {entry["hash"]} for \"{entry["name"]}\" is missing from the store.")
+            for payload in delta["payloads"].values():
+                if payload["source"] == "patch" and not payload["base"] in base_hashes:
+                    raise Exception(f"Patch base {payload["base"]} is not part of the installed version.")
+
+            received_hashes = set()
+            # tar.next() rather than iterating since iteration would start over at delta.json
+            while True:
+                member = tar.next()
+                if member == None:
+                    break
+                name = epack.NormalizeEntryName(member.name)
+                if name == "" or name == epack.INDEX_NAME:
+                    continue
+                source, _, file_hash = name.partition("/")
+                payload = delta["payloads"].get(file_hash)
+                if payload == None or payload["source"] != source or not member.isfile() or file_hash in received_hashes:
+                    raise Exception(f"Unexpected entry \"{name}\" in \"{delta_path}\".")
+                received_hashes.add(file_hash)
+                if source == "data":
+                    epack_store.StoreObject(store_path, tar.extractfile(member), file_hash in executable_hashes, file_hash)
+                else:
+                    base_path = FindObject(store_path, payload["base"])
+                    if base_path == None:
+                        raise Exception(f"Patch base {payload["base"]} is missing from the store.")
+                    ApplyPatch(store_path, base_path, tar.extractfile(member), file_hash in executable_hashes, file_hash)
+            if received_hashes != set(delta["payloads"].keys()):
+                raise Exception(f"\"{delta_path}\" is truncated.")
+
+    staging_path = os.path.join(apps_dir_path, f".epack-{uuid.uuid4()}")
+    staging_bin_path = os.path.join(staging_path, "bin")
+    os.makedirs(staging_bin_path, mode=0o700)
+    seen_names = set()
+    symlink_names = set()
+    dir_paths = []
+    try:
+        for entry in delta["entries"]:
+            name = epack.NormalizeEntryName(entry["name"])
+            if name == "" or name in seen_names or name in [ epack.MANIFEST_NAME, epack.INDEX_NAME ]:
+                raise Exception(f"Invalid entry \"{entry["name"]}\" in {DELTA_NAME}.")
+            seen_names.add(name)
+            # Entries get the same audit as archive members so a delta can't do anything an epack couldn't
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.type = { "dir": tarfile.DIRTYPE, "symlink": tarfile.SYMTYPE, "file": tarfile.REGTYPE }[entry["type"]]
+            tarinfo.linkname = entry.get("target", "")
+            tarinfo.mode = 0o500 if entry["type"] == "dir" or entry.get("executable") else 0o400
+            epack.AuditEntry(tarinfo, name, symlink_names)
+            dest_path = os.path.join(staging_bin_path, name)
+            epack.MakeStagedDirs(staging_bin_path, os.path.dirname(dest_path), dir_paths)
+            if entry["type"] == "dir":
+                epack.MakeStagedDirs(staging_bin_path, dest_path, dir_paths)
+            elif entry["type"] == "symlink":
+                os.symlink(entry["target"], dest_path)
+                symlink_names.add(name)
+            else:
+                epack_store.LinkObject(GetObject(store_path, entry["hash"], entry["executable"]), dest_path)
+        if delta["manifest"].get("files") != { entry["name"]: entry["hash"] for entry in delta["entries"] if entry["type"] == "file" }:
+            raise Exception(f"{DELTA_NAME} entries don't match its manifest.")
+        old_objects = epack.CommitStagedApp(apps_dir_path, store_path, staging_path, delta["manifest"], dir_paths, symlink_names)
+    finally:
+        epack.RemoveTree(staging_path)
+    epack_store.ReleaseObjects(old_objects)
+    return delta["manifest"]
+def ApplyDelta(delta_path, apps_dir_path="/apps", fallback_epack_path=None):
+    # Returns (manifest, used_delta). Any failure leaves the installed version untouched so the full epack is
+    # always a safe fallback. Objects a failed delta already stored are cleaned up by epack gc.
+    try:
+        return ApplyDeltaStream(delta_path, apps_dir_path), True
+    except Exception as ex:
+        if fallback_epack_path == None:
+            raise
+        print(f"Delta update failed ({ex}). Installing \"{fallback_epack_path}\" instead.")
+        return epack.ExtractEpack(fallback_epack_path, apps_dir_path), False
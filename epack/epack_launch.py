@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import socket
+import select
+import signal
+import ctypes
+import struct
+import stat
+import uuid
+import pwd
+import json
+import time
+import sys
+import os
+
+import epack
+
+# Apps run as their own user inside a private mount namespace. /apps is covered by an empty read only tmpfs with
+# only the app's own folders bound back in, so one app can never see another's files:
+#     $bin  = /apps/<uuid>/bin   read only, nosuid, nodev
+#     $data = /apps/<uuid>/data  read write, nosuid, nodev, really /apps/<uuid>/data/<uid> of the calling user
+#     $tmp  = /apps/<uuid>/tmp   tmpfs, mounted on the app's first launch for the calling user
+# Building that namespace costs several mounts so the zygote builds one template per app and user and keeps a
+# handle to it. Every launch after that is a fork of the already warm zygote, one setns into the template and an
+# execve. Callers are identified with SO_PEERCRED and may launch an app when the owner and mode of /apps/<uuid>
+# let them search it, so an app can be limited to a group with chmod 750. Each user only ever sees their own
+# $data and $tmp, though instances launched for different users still share the app's uid.
+# tmpfs is used for $tmp instead of ramfs so it has a size limit and can be swapped out to zram. Its mountpoint
+# only exists inside the namespace so the zygote never creates or mounts anything in the world writable /tmp.
+SOCKET_PATH = "/run/epack/zygote.sock"
+STAGING_DIR_PATH = "/run/epack/staging"
+REQUEST_MAX_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 1.0
+TMP_SIZE = "25%"
+# Only these variables are passed from the caller. Anything else, like LD_PRELOAD, could inject code into the app.
+ENV_NAMES = [ "TERM", "COLORTERM", "LANG", "LANGUAGE", "TZ", "DISPLAY", "WAYLAND_DISPLAY", "XDG_RUNTIME_DIR" ]
+ENV_PREFIXES = [ "LC_" ]
+
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_REMOUNT = 0x20
+MS_BIND = 0x1000
+MS_MOVE = 0x2000
+MS_REC = 0x4000
+MS_SLAVE = 0x80000
+PR_SET_NO_NEW_PRIVS = 38
+
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+def Mount(source, target, fs_type, flags, data=None):
+    encode = lambda value: value.encode("UTF-8") if value != None else None
+    if LIBC.mount(encode(source), encode(target), encode(fs_type), ctypes.c_ulong(flags), encode(data)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"Failed to mount \"{target}\". {os.strerror(errno)}")
+
+def ReadAppManifest(apps_dir_path, app_uuid):
+    with open(os.path.join(apps_dir_path, app_uuid, epack.MANIFEST_NAME), "r", encoding="UTF-8") as file:
+        return epack.ParseManifest(file.read().encode("UTF-8"))
+def ListApps(apps_dir_path):
+    manifests = []
+    for name in sorted(os.listdir(apps_dir_path)):
+        try:
+            manifests.append(ReadAppManifest(apps_dir_path, str(uuid.UUID(name))))
+        except (ValueError, OSError):
+            continue
+    return manifests
+def FindApp(apps_dir_path, app):
+    # Apps are looked up by uuid first which needs no scan of /apps
+    try:
+        return ReadAppManifest(apps_dir_path, str(uuid.UUID(app)))
+    except (ValueError, OSError):
+        pass
+    matches = [ manifest for manifest in ListApps(apps_dir_path) if manifest["name"] == app ]
+    if len(matches) == 0:
+        raise Exception(f"No app named {app} is installed in \"{apps_dir_path}\".")
+    return matches[0]
+
+def CanUseApp(apps_dir_path, manifest, uid, gid):
+    # Same owner, group and other x bit rules the kernel uses to search /apps/<uuid>
+    if uid == 0:
+        return True
+    app_stat = os.stat(os.path.join(apps_dir_path, manifest["uuid"]))
+    try:
+        groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        groups = [ gid ]
+    if app_stat.st_uid == uid:
+        return app_stat.st_mode & stat.S_IXUSR != 0
+    if app_stat.st_gid in groups:
+        return app_stat.st_mode & stat.S_IXGRP != 0
+    return app_stat.st_mode & stat.S_IXOTH != 0
+
+def GetAppEnv(caller_env, app_paths):
+    env = { name: value for name, value in caller_env.items() if name in ENV_NAMES or any([ name.startswith(prefix) for prefix in ENV_PREFIXES ]) }
+    env["PATH"] = f"{app_paths["bin"]}:/usr/bin"
+    env["HOME"] = app_paths["data"]
+    env["TMPDIR"] = app_paths["tmp"]
+    env["APP_BIN"] = app_paths["bin"]
+    env["APP_DATA"] = app_paths["data"]
+    env["APP_TMP"] = app_paths["tmp"]
+    return env
+
+class AppTemplate:
+    # A mount namespace with only this app's folders under /apps and uid's data. The namespace lives for as long as
+    # ns_fd is open or any app launched into it is still running.
+    def __init__(self, apps_dir_path, manifest, uid):
+        self.manifest = manifest
+        self.uid = uid
+        self.paths = {
+            "bin": os.path.join(apps_dir_path, manifest["uuid"], "bin"),
+            "data": os.path.join(apps_dir_path, manifest["uuid"], "data"),
+            "tmp": os.path.join(apps_dir_path, manifest["uuid"], "tmp"),
+        }
+        self.data_source_path = os.path.join(self.paths["data"], str(uid))
+        self.owner = epack.GetAppOwner(manifest["name"])
+        self.ns_fd = None
+        self.tmp_mounted = False
+        # The data folder only holds one folder per user and only the zygote may look inside it
+        if not os.path.exists(self.paths["data"]):
+            os.mkdir(self.paths["data"], mode=0o700)
+        if not os.path.exists(self.data_source_path):
+            os.mkdir(self.data_source_path, mode=0o700)
+            os.chown(self.data_source_path, self.owner[0], self.owner[1])
+        self.bin_id = self.GetBinId()
+        start_time = time.monotonic()
+        self.Build(apps_dir_path)
+        self.build_ms = (time.monotonic() - start_time) * 1000
+    def GetBinId(self):
+        # Installs and updates rename a new bin folder into place so a new inode means the template is stale
+        bin_stat = os.stat(self.paths["bin"])
+        return (bin_stat.st_dev, bin_stat.st_ino)
+    def IsStale(self):
+        try:
+            return self.GetBinId() != self.bin_id
+        except OSError:
+            return True
+    def Build(self, apps_dir_path):
+        # The zygote steps into a fresh namespace, mounts, keeps a handle to it and steps back out. No fork needed.
+        os.makedirs(STAGING_DIR_PATH, mode=0o700, exist_ok=True)
+        host_ns_fd = os.open("/proc/self/ns/mnt", os.O_RDONLY)
+        try:
+            os.unshare(os.CLONE_NEWNS)
+            try:
+                # Slave so drives mounted later on the host still show up inside the app
+                Mount(None, "/", None, MS_REC | MS_SLAVE)
+                # The new /apps is put together off to the side while the real folders are still visible
+                Mount("tmpfs", STAGING_DIR_PATH, "tmpfs", MS_NOSUID | MS_NODEV | MS_NOEXEC, "mode=0755,size=64k")
+                staged_paths = { name: os.path.join(STAGING_DIR_PATH, self.manifest["uuid"], name) for name in [ "bin", "data" ] }
+                source_paths = { "bin": self.paths["bin"], "data": self.data_source_path }
+                for name, staged_path in staged_paths.items():
+                    os.makedirs(staged_path)
+                    Mount(source_paths[name], staged_path, None, MS_BIND)
+                os.mkdir(os.path.join(STAGING_DIR_PATH, self.manifest["uuid"], "tmp"), mode=0o755)
+                Mount(None, staged_paths["bin"], None, MS_REMOUNT | MS_BIND | MS_RDONLY | MS_NOSUID | MS_NODEV)
+                Mount(None, staged_paths["data"], None, MS_REMOUNT | MS_BIND | MS_NOSUID | MS_NODEV)
+                Mount(None, STAGING_DIR_PATH, None, MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV | MS_NOEXEC)
+                Mount(STAGING_DIR_PATH, apps_dir_path, None, MS_MOVE)
+                self.ns_fd = os.open("/proc/self/ns/mnt", os.O_RDONLY)
+            finally:
+                os.setns(host_ns_fd, os.CLONE_NEWNS)
+                os.chdir("/")
+        finally:
+            os.close(host_ns_fd)
+    def MountTmp(self):
+        # $tmp costs memory for as long as it is mounted so apps which are never launched never get one
+        if self.tmp_mounted:
+            return False
+        host_ns_fd = os.open("/proc/self/ns/mnt", os.O_RDONLY)
+        try:
+            os.setns(self.ns_fd, os.CLONE_NEWNS)
+            try:
+                Mount("tmpfs", self.paths["tmp"], "tmpfs", MS_NOSUID | MS_NODEV, f"mode=0700,uid={self.owner[0]},gid={self.owner[1]},size={TMP_SIZE}")
+            finally:
+                os.setns(host_ns_fd, os.CLONE_NEWNS)
+                os.chdir("/")
+        finally:
+            os.close(host_ns_fd)
+        self.tmp_mounted = True
+        return True
+    def Close(self):
+        if self.ns_fd != None:
+            os.close(self.ns_fd)
+            self.ns_fd = None
+
+def SendMessage(conn, message):
+    conn.sendall((json.dumps(message) + "\n").encode("UTF-8"))
+def ExecApp(template, request, fds, conn, start_ns, details):
+    # Runs in the forked child. Never returns.
+    try:
+        program = epack.NormalizeEntryName(request.get("program") or template.manifest.get("exec") or "")
+        if program == "":
+            raise Exception(f"{template.manifest["name"]} has no \"exec\" in its manifest. Name the program to run.")
+        program_path = os.path.join(template.paths["bin"], program)
+        os.setns(template.ns_fd, os.CLONE_NEWNS)
+        os.setgroups([])
+        os.setgid(template.owner[1])
+        os.setuid(template.owner[0])
+        if LIBC.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0:
+            raise OSError(ctypes.get_errno(), "prctl failed")
+        os.chdir(template.paths["data"])
+        # Python ignores SIGPIPE and ignored signals survive execve
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        log_fd = os.dup(1)
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+        env = GetAppEnv(request.get("env", {}), template.paths)
+        setup_ms = (time.monotonic_ns() - start_ns) / 1000000
+        if conn != None:
+            SendMessage(conn, { "event": "started", "pid": os.getpid(), "setup_ms": round(setup_ms, 3), **details })
+        os.write(log_fd, f"Launched {template.manifest["name"]} for uid {template.uid} as pid {os.getpid()} in {setup_ms:.2f}ms (template {details["template"]}, tmp {details["tmp"]}).\n".encode("UTF-8"))
+        os.close(log_fd)
+        os.execve(program_path, [ program_path ] + request.get("args", []), env)
+    except BaseException as exception:
+        try:
+            if conn != None:
+                SendMessage(conn, { "event": "error", "message": str(exception) })
+        finally:
+            os._exit(127)
+
+class Zygote:
+    def __init__(self, apps_dir_path="/apps"):
+        self.apps_dir_path = apps_dir_path
+        self.templates = {}
+        # pidfd -> (pid, client connection or None)
+        self.children = {}
+    def Prewarm(self):
+        # Templates are built for every user who has launched each app before
+        start_time = time.monotonic()
+        for manifest in ListApps(self.apps_dir_path):
+            data_path = os.path.join(self.apps_dir_path, manifest["uuid"], "data")
+            uids = [ int(name) for name in os.listdir(data_path) if name.isdigit() ] if os.path.isdir(data_path) else []
+            for uid in uids:
+                try:
+                    self.GetTemplate(manifest, uid)
+                except Exception as exception:
+                    print(f"Skipping {manifest["name"]} for uid {uid}. {exception}")
+        print(f"Prepared {len(self.templates)} app template(s) in {(time.monotonic() - start_time) * 1000:.2f}ms.")
+    def GetTemplate(self, manifest, uid):
+        key = (manifest["uuid"], uid)
+        template = self.templates.get(key)
+        if template != None and not template.IsStale():
+            return template, "cached"
+        if template != None:
+            # The app was updated so its manifest may have changed too
+            template.Close()
+            del self.templates[key]
+            manifest = ReadAppManifest(self.apps_dir_path, manifest["uuid"])
+        template = AppTemplate(self.apps_dir_path, manifest, uid)
+        self.templates[key] = template
+        print(f"Built the template for {manifest["name"]} and uid {uid} in {template.build_ms:.2f}ms.")
+        return template, "built"
+    def FindTemplate(self, app, uid, gid):
+        # Warm launches by name never touch /apps beyond a stat of the app's folder and its bin folder
+        manifest = None
+        for template in self.templates.values():
+            if app == template.manifest["uuid"] or app == template.manifest["name"]:
+                if not template.IsStale():
+                    manifest = template.manifest
+                break
+        if manifest == None:
+            manifest = FindApp(self.apps_dir_path, app)
+        if not CanUseApp(self.apps_dir_path, manifest, uid, gid):
+            raise Exception(f"Permission denied to launch {manifest["name"]}.")
+        return self.GetTemplate(manifest, uid)
+    def Launch(self, request, fds, conn, start_ns, uid, gid):
+        template, template_state = self.FindTemplate(request["app"], uid, gid)
+        tmp_state = "mounted" if template.MountTmp() else "cached"
+        pid = os.fork()
+        if pid == 0:
+            ExecApp(template, request, fds, conn, start_ns, { "template": template_state, "tmp": tmp_state })
+        return pid
+    def Accept(self, server):
+        conn, _ = server.accept()
+        start_ns = time.monotonic_ns()
+        fds = []
+        try:
+            _, uid, gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+            conn.settimeout(REQUEST_TIMEOUT)
+            message, fds, _, _ = socket.recv_fds(conn, REQUEST_MAX_SIZE, 3)
+            # Received fds are inheritable. Only the dup2 copies made in the child may reach the app.
+            for fd in fds:
+                os.set_inheritable(fd, False)
+            conn.setblocking(True)
+            if len(fds) != 3:
+                raise Exception("Launch requests must pass stdin, stdout and stderr.")
+            request = json.loads(message.decode("UTF-8"))
+            if not isinstance(request, dict) or not isinstance(request.get("app"), str):
+                raise Exception("Launch requests must be a json object with an \"app\".")
+            pid = self.Launch(request, fds, conn, start_ns, uid, gid)
+            self.children[os.pidfd_open(pid)] = (pid, conn)
+        except Exception as exception:
+            try:
+                SendMessage(conn, { "event": "error", "message": str(exception) })
+            except OSError:
+                pass
+            conn.close()
+        finally:
+            for fd in fds:
+                os.close(fd)
+    def ReapChild(self, pidfd):
+        pid, conn = self.children.pop(pidfd)
+        _, status = os.waitpid(pid, 0)
+        os.close(pidfd)
+        if conn != None:
+            try:
+                SendMessage(conn, { "event": "exited", "code": os.waitstatus_to_exitcode(status) })
+            except OSError:
+                pass
+            conn.close()
+    def ReadClient(self, pidfd):
+        # Clients only ever send signals to forward. A closed client leaves the app running.
+        pid, conn = self.children[pidfd]
+        try:
+            data = conn.recv(4096)
+        except OSError:
+            data = b""
+        if data == b"":
+            conn.close()
+            self.children[pidfd] = (pid, None)
+            return
+        for line in data.decode("UTF-8", errors="replace").splitlines():
+            try:
+                signal.pidfd_send_signal(pidfd, int(json.loads(line)["signal"]))
+            except (ValueError, KeyError, TypeError, OSError):
+                continue
+    def Serve(self, socket_path=SOCKET_PATH):
+        os.makedirs(os.path.dirname(socket_path), mode=0o755, exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o666)
+        server.listen(64)
+        print(f"Listening on \"{socket_path}\".")
+        while True:
+            client_fds = { conn.fileno(): pidfd for pidfd, (pid, conn) in self.children.items() if conn != None }
+            readable, _, _ = select.select([ server ] + list(self.children.keys()) + list(client_fds.keys()), [], [])
+            for fd in readable:
+                if fd is server:
+                    self.Accept(server)
+                elif fd in self.children:
+                    self.ReapChild(fd)
+                elif fd in client_fds and client_fds[fd] in self.children:
+                    self.ReadClient(client_fds[fd])
+
+def MakeRequest(app, program, args):
+    return { "app": app, "program": program, "args": args, "env": dict(os.environ) }
+def WaitForApp(conn, timing, start_time):
+    # Returns the app's exit code once the zygote reports it or None if the connection closed first
+    for line in conn.makefile("r", encoding="UTF-8"):
+        message = json.loads(line)
+        if message["event"] == "started" and timing:
+            total_ms = (time.monotonic() - start_time) * 1000
+            print(f"Started pid {message["pid"]}: setup {message["setup_ms"]:.2f}ms, end to end {total_ms:.2f}ms (template {message["template"]}, tmp {message["tmp"]}).", file=sys.stderr)
+        elif message["event"] == "error":
+            print(f"Failed to launch. {message["message"]}", file=sys.stderr)
+            return 127
+        elif message["event"] == "exited":
+            return ToShellCode(message["code"])
+    return None
+def ToShellCode(code):
+    # Apps killed by a signal exit with 128 + the signal number like they would from a shell
+    return code if code >= 0 else 128 - code
+def LaunchApp(app, program, args, apps_dir_path="/apps", timing=False, socket_path=SOCKET_PATH):
+    start_time = time.monotonic()
+    request = MakeRequest(app, program, args)
+    if not os.path.exists(socket_path):
+        if os.geteuid() != 0:
+            raise Exception(f"The epack zygote is not running at \"{socket_path}\".")
+        # Cold launch through the same code the zygote runs, which also shows what the zygote saves
+        print(f"The epack zygote is not running. Launching cold.", file=sys.stderr)
+        conn, zygote_conn = socket.socketpair()
+        pid = Zygote(apps_dir_path).Launch(request, [ 0, 1, 2 ], zygote_conn, time.monotonic_ns(), os.getuid(), os.getgid())
+        zygote_conn.close()
+        with conn:
+            code = WaitForApp(conn, timing, start_time)
+        _, status = os.waitpid(pid, 0)
+        return code if code != None else ToShellCode(os.waitstatus_to_exitcode(status))
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with conn:
+        conn.connect(socket_path)
+        socket.send_fds(conn, [ json.dumps(request).encode("UTF-8") ], [ 0, 1, 2 ])
+        # The app is not in our process group so signals sent to us are passed on
+        forward = lambda signal_number, frame: conn.sendall((json.dumps({ "signal": signal_number }) + "\n").encode("UTF-8"))
+        for signal_number in [ signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT ]:
+            signal.signal(signal_number, forward)
+        code = WaitForApp(conn, timing, start_time)
+        if code == None:
+            raise Exception("The epack zygote closed the connection before the app exited.")
+        return code
+def RunZygote(apps_dir_path="/apps", socket_path=SOCKET_PATH):
+    if os.geteuid() != 0:
+        raise Exception("The epack zygote requires root to build mount namespaces.")
+    zygote = Zygote(apps_dir_path)
+    zygote.Prewarm()
+    zygote.Serve(socket_path)
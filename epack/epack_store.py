@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import tempfile
+import hashlib
+import shutil
+import errno
+import time
+import os
+
+# Every regular file installed into /apps/<uuid>/bin is really a hardlink to an object in /apps/.objects named by
+# its sha256. Two apps, or two versions of one app, shipping the same file share one inode and so share both disk
+# space and page cache. Objects are owned by root and read only (r-xr-xr-x or r--r--r--) because a shared inode
+# can't belong to any one app. The store itself is rwx------ root so the only way to reach an object is through
+# the r-x------ bin folder of an app that ships it. Objects are always named by the hash of the bytes actually
+# written so an epack can't claim another app's objects just by listing their hashes in its manifest.
+STORE_DIR_NAME = ".objects"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def GetStorePath(apps_dir_path):
+    store_path = os.path.join(apps_dir_path, STORE_DIR_NAME)
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path, mode=0o700, exist_ok=True)
+    elif os.stat(store_path).st_mode & 0o077 != 0:
+        # Stores made before objects were private were rwx--x--x
+        os.chmod(store_path, 0o700)
+    return store_path
+def GetObjectPath(store_path, file_hash, executable):
+    return os.path.join(store_path, file_hash[:2], file_hash + (".x" if executable else ""))
+def StoreObject(store_path, source_file, executable, expected_hash=None):
+    # expected_hash is only ever checked against the data. When the object already exists the temp copy is dropped.
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=store_path)
+    try:
+        sha256 = hashlib.sha256()
+        with os.fdopen(fd, "wb") as temp_file:
+            while True:
+                buffer = source_file.read(COPY_BUFFER_SIZE)
+                if len(buffer) == 0:
+                    break
+                sha256.update(buffer)
+                temp_file.write(buffer)
+            os.fchmod(temp_file.fileno(), 0o555 if executable else 0o444)
+        return PublishObject(store_path, temp_path, sha256.hexdigest(), executable, expected_hash)
+    finally:
+        os.remove(temp_path)
+def AdoptObject(store_path, temp_path, executable, expected_hash=None):
+    # Turns a file some other tool wrote into a temp file inside the store (see NewTempPath) into an object.
+    # The temp file is always removed.
+    try:
+        sha256 = hashlib.sha256()
+        with open(temp_path, "rb") as temp_file:
+            while True:
+                buffer = temp_file.read(COPY_BUFFER_SIZE)
+                if len(buffer) == 0:
+                    break
+                sha256.update(buffer)
+        os.chmod(temp_path, 0o555 if executable else 0o444)
+        return PublishObject(store_path, temp_path, sha256.hexdigest(), executable, expected_hash)
+    finally:
+        os.remove(temp_path)
+def NewTempPath(store_path):
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=store_path)
+    os.close(fd)
+    return temp_path
+def PublishObject(store_path, temp_path, file_hash, executable, expected_hash):
+    if expected_hash != None and file_hash != expected_hash:
+        raise Exception(f"Contents do not match the manifest hash {expected_hash}.")
+    object_path = GetObjectPath(store_path, file_hash, executable)
+    os.makedirs(os.path.dirname(object_path), mode=0o700, exist_ok=True)
+    try:
+        # link instead of rename so a concurrent install of the same object can never be replaced under it
+        os.link(temp_path, object_path)
+    except FileExistsError:
+        pass
+    return object_path
+def LinkObject(object_path, dest_path):
+    try:
+        os.link(object_path, dest_path)
+    except OSError as ex:
+        # Very popular objects can run out of hardlinks so fall back to a private copy
+        if ex.errno != errno.EMLINK:
+            raise
+        shutil.copy2(object_path, dest_path)
+def ReleaseObjects(object_paths):
+    # Removes objects which are no longer linked from any app
+    freed_bytes = 0
+    for object_path in set(object_paths):
+        try:
+            st = os.stat(object_path)
+        except FileNotFoundError:
+            continue
+        if st.st_nlink == 1:
+            os.remove(object_path)
+            freed_bytes += st.st_size
+    return freed_bytes
+def GetManifestObjects(store_path, manifest):
+    # Manifests don't record which files are executable so both possible objects are returned
+    object_paths = []
+    for file_hash in manifest.get("files", {}).values():
+        object_paths.append(GetObjectPath(store_path, file_hash, True))
+        object_paths.append(GetObjectPath(store_path, file_hash, False))
+    return object_paths
+def CollectGarbage(store_path):
+    object_paths = []
+    for root, dir_names, file_names in os.walk(store_path):
+        for file_name in file_names:
+            if file_name.startswith(".tmp-") and time.time() - os.path.getmtime(os.path.join(root, file_name)) < 60 * 60:
+                continue
+            object_paths.append(os.path.join(root, file_name))
+    return ReleaseObjects(object_paths)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import urllib.request
+import urllib.error
+import email.utils
+import subprocess
+import threading
+import tempfile
+import hashlib
+import base64
+import time
+import json
+import os
+
+import epack
+
+# An app is trusted when its detached <file>.sig was made by a key published at https://<domain>/sigkey.pub.
+# sigkey.pub is a json document:
+# {
+#     "version": 1,
+#     "root_key": "<ed25519 public key pem>",
+#     "subkeys": { "<key id>": { "public_key": "<pem>", "signature": "<base64 root key signature of SubkeyMessage>" } },
+#     "revoked": [ "<key id>" ]
+# }
+# Key ids are the first 32 hex digits of the sha256 of the key's DER encoding. A .sig file is a json object with
+# "domain", "key_id" and "signature" (base64 signature of SignatureMessage over the epack's sha256).
+SIGKEY_URL_FORMAT = "https://{domain}/sigkey.pub"
+DEFAULT_MAX_AGE = 24 * 60 * 60
+MAX_STALE_AGE = 30 * 24 * 60 * 60
+
+def SignatureMessage(file_hash):
+    return f"epack-signature-v1\n{file_hash}\n".encode("UTF-8")
+def SubkeyMessage(domain, key_id):
+    return f"epack-subkey-v1\n{domain}\n{key_id}\n".encode("UTF-8")
+def GetKeyId(public_key_pem):
+    lines = [ line.strip() for line in public_key_pem.strip().splitlines() ]
+    if len(lines) < 3 or lines[0] != "-----BEGIN PUBLIC KEY-----" or lines[-1] != "-----END PUBLIC KEY-----":
+        raise Exception("Public key is not a PEM encoded public key.")
+    return hashlib.sha256(base64.b64decode("".join(lines[1:-1]))).hexdigest()[:32]
+def VerifySignature(public_key_path, message, signature):
+    # openssl is used for ed25519 because the standard library has no public key crypto
+    with tempfile.TemporaryDirectory(prefix="epack_verify_") as temp_dir_path:
+        message_path = os.path.join(temp_dir_path, "message")
+        signature_path = os.path.join(temp_dir_path, "signature")
+        with open(message_path, "wb") as file:
+            file.write(message)
+        with open(signature_path, "wb") as file:
+            file.write(signature)
+        result = subprocess.run([ "openssl", "pkeyutl", "-verify", "-pubin", "-inkey", public_key_path, "-rawin", "-in", message_path, "-sigfile", signature_path ], capture_output=True)
+        return result.returncode == 0
+def CreateSignature(private_key_path, message):
+    with tempfile.TemporaryDirectory(prefix="epack_sign_") as temp_dir_path:
+        message_path = os.path.join(temp_dir_path, "message")
+        signature_path = os.path.join(temp_dir_path, "signature")
+        with open(message_path, "wb") as file:
+            file.write(message)
+        subprocess.run([ "openssl", "pkeyutl", "-sign", "-inkey", private_key_path, "-rawin", "-in", message_path, "-out", signature_path ], capture_output=True, check=True)
+        with open(signature_path, "rb") as file:
+            return file.read()
+def SignEpack(epack_path, private_key_path, domain, key_id, sig_path=None):
+    signature = CreateSignature(private_key_path, SignatureMessage(epack.HashFile(epack_path)))
+    sig = { "domain": domain, "key_id": key_id, "signature": base64.b64encode(signature).decode("ascii") }
+    with open(sig_path or f"{epack_path}.sig", "w", encoding="UTF-8") as file:
+        json.dump(sig, file, indent=4, sort_keys=True)
+    return sig
+
+def FetchUrl(url, headers):
+    # Default fetch layer. Returns (status, headers, body) and never follows a redirect off https.
+    if not url.startswith("https://"):
+        raise Exception(f"Refusing to fetch \"{url}\" without https.")
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=15) as response:
+            if not response.geturl().startswith("https://"):
+                raise Exception(f"\"{url}\" redirected away from https.")
+            return response.status, dict(response.headers.items()), response.read()
+    except urllib.error.HTTPError as ex:
+        if ex.code == 304:
+            return 304, dict(ex.headers.items()), b""
+        raise
+def GetMaxAge(headers):
+    headers = { key.lower(): value for key, value in headers.items() }
+    for directive in headers.get("cache-control", "").split(","):
+        directive = directive.strip().lower()
+        if directive.startswith("max-age="):
+            try:
+                return max(0, int(directive[len("max-age="):]))
+            except ValueError:
+                break
+    if "expires" in headers:
+        try:
+            return max(0, int(email.utils.parsedate_to_datetime(headers["expires"]).timestamp() - time.time()))
+        except (TypeError, ValueError):
+            pass
+    return DEFAULT_MAX_AGE
+
+class TrustResolver:
+    def __init__(self, cache_dir_path=None, fetch=FetchUrl, url_format=SIGKEY_URL_FORMAT, background_refresh=True):
+        if cache_dir_path == None:
+            cache_dir_path = "/var/cache/epack/trust" if os.geteuid() == 0 else os.path.expanduser("~/.cache/epack/trust")
+        self.cache_dir_path = cache_dir_path
+        self.fetch = fetch
+        self.url_format = url_format
+        self.background_refresh = background_refresh
+        self.entries = {}
+        self.verified_subkeys = {}
+        self.lock = threading.Lock()
+        self.domain_locks = {}
+        self.refreshing = set()
+        os.makedirs(os.path.join(self.cache_dir_path, "keys"), mode=0o700, exist_ok=True)
+
+    def GetDomainLock(self, domain):
+        with self.lock:
+            return self.domain_locks.setdefault(domain, threading.Lock())
+    def GetEntryPath(self, domain):
+        if domain == "" or not all([ c.isalnum() or c in "-." for c in domain ]) or domain.startswith("."):
+            raise Exception(f"\"{domain}\" is not a valid domain.")
+        return os.path.join(self.cache_dir_path, f"{domain.lower()}.json")
+    def LoadEntry(self, domain):
+        if domain in self.entries:
+            return self.entries[domain]
+        entry_path = self.GetEntryPath(domain)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path, "r", encoding="UTF-8") as file:
+            entry = json.load(file)
+        self.entries[domain] = entry
+        return entry
+    def SaveEntry(self, domain, entry):
+        entry_path = self.GetEntryPath(domain)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="UTF-8") as file:
+            json.dump(entry, file, sort_keys=True)
+        os.replace(temp_path, entry_path)
+        self.entries[domain] = entry
+    def Refresh(self, domain):
+        # Conditional fetch using the cached ETag so an unchanged sigkey.pub costs one tiny 304 response
+        with self.GetDomainLock(domain):
+            entry = self.LoadEntry(domain)
+            if entry != None and time.time() < entry["expires"]:
+                return entry
+            headers = {}
+            if entry != None and entry.get("etag") != None:
+                headers["If-None-Match"] = entry["etag"]
+            status, response_headers, body = self.fetch(self.url_format.format(domain=domain), headers)
+            now = time.time()
+            if status == 304 and entry != None:
+                entry = dict(entry)
+            elif status == 200:
+                document = json.loads(body.decode("UTF-8"))
+                self.ValidateDocument(domain, document)
+                entry = { "document": document, "etag": { key.lower(): value for key, value in response_headers.items() }.get("etag") }
+            else:
+                raise Exception(f"Fetching sigkey.pub for {domain} failed with status {status}.")
+            entry["fetched"] = now
+            entry["expires"] = now + GetMaxAge(response_headers)
+            self.SaveEntry(domain, entry)
+            return entry
+    def RefreshInBackground(self, domain):
+        with self.lock:
+            if domain in self.refreshing:
+                return
+            self.refreshing.add(domain)
+        def Run():
+            try:
+                self.Refresh(domain)
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(domain)
+        threading.Thread(target=Run, daemon=True).start()
+    def GetDocument(self, domain):
+        # Fresh cache entries never touch the network. Stale ones are still used while a background refresh runs.
+        entry = self.LoadEntry(domain)
+        now = time.time()
+        if entry != None and now < entry["expires"]:
+            return entry["document"]
+        if entry != None and self.background_refresh and now < entry["fetched"] + MAX_STALE_AGE:
+            self.RefreshInBackground(domain)
+            return entry["document"]
+        return self.Refresh(domain)["document"]
+
+    def GetKeyPath(self, public_key_pem):
+        key_path = os.path.join(self.cache_dir_path, "keys", f"{GetKeyId(public_key_pem)}.pem")
+        if not os.path.exists(key_path):
+            temp_path = f"{key_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="UTF-8") as file:
+                file.write(public_key_pem.strip() + "\n")
+            os.replace(temp_path, key_path)
+        return key_path
+    def ValidateDocument(self, domain, document):
+        if not isinstance(document, dict) or document.get("version") != 1 or not isinstance(document.get("root_key"), str):
+            raise Exception(f"sigkey.pub for {domain} is not a valid version 1 document.")
+        GetKeyId(document["root_key"])
+        for key_id, subkey in document.get("subkeys", {}).items():
+            if GetKeyId(subkey["public_key"]) != key_id:
+                raise Exception(f"sigkey.pub for {domain} lists subkey {key_id} under the wrong id.")
+    def GetSigningKeyPath(self, domain, key_id):
+        document = self.GetDocument(domain)
+        if key_id in document.get("revoked", []):
+            raise Exception(f"Key {key_id} has been revoked by {domain}.")
+        if key_id == GetKeyId(document["root_key"]):
+            return self.GetKeyPath(document["root_key"])
+        subkey = document.get("subkeys", {}).get(key_id)
+        if subkey == None:
+            raise Exception(f"Key {key_id} is not published by {domain}.")
+        # Subkey certifications are checked once per root key and remembered
+        cache_key = (domain, key_id, GetKeyId(document["root_key"]), subkey["signature"])
+        if not cache_key in self.verified_subkeys:
+            if not VerifySignature(self.GetKeyPath(document["root_key"]), SubkeyMessage(domain, key_id), base64.b64decode(subkey["signature"])):
+                raise Exception(f"Subkey {key_id} is not signed by the root key of {domain}.")
+            self.verified_subkeys[cache_key] = True
+        return self.GetKeyPath(subkey["public_key"])
+
+    def VerifyEpack(self, epack_path, sig_path=None):
+        # Returns the domain which vouches for the epack or raises if it can't be trusted
+        sig_path = sig_path or f"{epack_path}.sig"
+        if not os.path.exists(sig_path):
+            raise Exception(f"\"{epack_path}\" is unsigned.")
+        with open(sig_path, "r", encoding="UTF-8") as file:
+            sig = json.load(file)
+        key_path = self.GetSigningKeyPath(sig["domain"], sig["key_id"])
+        if not VerifySignature(key_path, SignatureMessage(epack.HashFile(epack_path)), base64.b64decode(sig["signature"])):
+            raise Exception(f"Signature on \"{epack_path}\" does not match {sig["domain"]} key {sig["key_id"]}.")
+        return sig["domain"]
+    def VerifyMany(self, epack_paths, jobs=None):
+        # Returns { path: domain or Exception }. Hashing and openssl both run outside the GIL so threads scale.
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = { executor.submit(self.VerifyEpack, epack_path): epack_path for epack_path in epack_paths }
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.exception() if future.exception() != None else future.result()
+        return results
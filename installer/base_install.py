@@ -1,14 +1,240 @@
 #!/bin/env python
 
+import concurrent.futures
+import contextlib
+import threading
+import uuid
 import os
 import sys
-import requests
 
 from lib_installer import *
+from lib_devices import *
+from lib_disk_profile import *
+from lib_locale import *
+from lib_timing import *
+from lib_storage import *
+from lib_swap import *
+
+def PrepareDisk(eosDisk, diskPass, timer, rootPath="/new_root", mapperName="new_cryptroot", rootImagePath=None, specs=None, luksSlots=None):
+    # Partitions, encrypts and formats eosDisk, mounts it at rootPath and writes its fstab. With rootImagePath
+    # the root filesystem is copied from a golden image instead of being created empty. specs is the machine the
+    # disk will boot in, this machine by default. luksSlots limits how many disks run argon2 at once.
+    eosDrive = eosDisk.name
+    mapperPath = f"/dev/mapper/{mapperName}"
+    bootPartitionPath = eosDisk.GetPartitionPath(1)
+    rootPartitionPath = eosDisk.GetPartitionPath(2)
+    with timer.Phase("partition"):
+        print("Creating new GPT partition table...")
+        RunCommand(f"wipefs -a /dev/{eosDrive}")
+        RunCommand(f"sgdisk --clear /dev/{eosDrive}")
+
+        print("Creating partitions...")
+        RunCommand(f"sgdisk --new=0:0:+512M --typecode=0:EF00 --change-name=0:\"EOS EFI Partition\" /dev/{eosDrive}")
+        RunCommand(f"sgdisk --new=0:0:0 --typecode=0:8309 --change-name=0:\"EOS Root\" /dev/{eosDrive}")
+        eosDisk = RefreshDisk(eosDrive)
+        if [partition.path for partition in eosDisk.partitions] != [bootPartitionPath, rootPartitionPath]:
+            raise Exception(f"Expected partitions {bootPartitionPath} and {rootPartitionPath} on /dev/{eosDrive} after partitioning.")
+
+    with timer.Phase("profile"):
+        print("Benchmarking encryption...")
+        diskProfile = DiskProfile(eosDisk, specs)
+        for line in diskProfile.Describe():
+            print(f"    {line}")
+
+    with timer.Phase("luks"), luksSlots if luksSlots != None else contextlib.nullcontext():
+        print("Setting up disk encryption...")
+        RunCommand(f"cryptsetup luksFormat {rootPartitionPath} {diskProfile.GetLuksFormatArgs()} --force-password --use-random --batch-mode", input=diskPass) # OPTIONAL: --integrity hmac-sha256
+        RunCommand(f"cryptsetup open {rootPartitionPath} {mapperName} {diskProfile.GetOpenArgs()} --batch-mode", input=diskPass)
+
+    with timer.Phase("mkfs"):
+        print("Creating filesystems...")
+        RunCommand(f"mkfs.fat -F32 -n \"EFI\" -S 4096 {bootPartitionPath}")
+        if rootImagePath == None:
+            RunCommand(f"mkfs.ext4 -q -L \"EOS Root\" {diskProfile.GetMkfsExt4Args()} {mapperPath}")
+            rootPartitionUUID = None
+        else:
+            # e2image only copies blocks the filesystem uses so the copy costs the size of the installed
+            # system, not the size of the disk. Each copy then gets its own uuid and grows to fill its disk.
+            RunCommand(f"e2image -ra \"{rootImagePath}\" {mapperPath}")
+            RunCommand(f"e2fsck -fy {mapperPath}")
+            rootPartitionUUID = str(uuid.uuid4())
+            RunCommand(f"tune2fs -U {rootPartitionUUID} {mapperPath}")
+            RunCommand(f"resize2fs {mapperPath}")
+
+    with timer.Phase("mount"):
+        print("Mounting filesystems...")
+        os.makedirs(rootPath, exist_ok=True)
+        RunCommand(f"mount {mapperPath} {rootPath}")
+        os.makedirs(f"{rootPath}/boot", exist_ok=True)
+        if rootImagePath != None and len(os.listdir(f"{rootPath}/boot")) != 0:
+            # The golden image keeps its kernel in /boot which belongs on the EFI partition
+            os.makedirs(f"{rootPath}.esp", exist_ok=True)
+            RunCommand(f"mount {bootPartitionPath} {rootPath}.esp")
+            RunCommand(f"cp -a {rootPath}/boot/. {rootPath}.esp/")
+            RunCommand(f"umount {rootPath}.esp")
+            os.rmdir(f"{rootPath}.esp")
+            RunCommand(f"find {rootPath}/boot -mindepth 1 -delete")
+        RunCommand(f"mount {bootPartitionPath} {rootPath}/boot")
+
+    with timer.Phase("fstab"):
+        # Genfstab
+        print(f"Generating fstab...")
+        bootPartitionUUID = GetFilesystemUuid(bootPartitionPath)
+        if rootPartitionUUID == None:
+            rootPartitionUUID = GetFilesystemUuid(mapperPath)
+        fstab = [
+            "# <partition> <mount point> <filesystem type> <options> <dump> <pass>",
+            "",
+            f"# EOS Root (dm-crypt options {diskProfile.GetCrypttabOptions()} are persisted in the LUKS2 header)",
+            f"UUID={rootPartitionUUID} / ext4 {diskProfile.GetExt4MountOptions()} 0 1",
+            "",
+            "# EOS EFI Partition",
+            f"UUID={bootPartitionUUID} /boot vfat {diskProfile.GetVfatMountOptions()} 0 2",
+        ]
+        os.makedirs(f"{rootPath}/etc/", exist_ok=True)
+        WriteFile(f"{rootPath}/etc/fstab", "\n".join(fstab))
+    return diskProfile
+
+def Benchmark(imageSizeGb, reportPath):
+    # Runs the disk phases against a sparse image on a loop device so installer changes can be compared
+    # without real hardware. Nothing outside the image is touched and everything is torn down afterwards.
+    timer = PhaseTimer()
+    imagePath = "/var/tmp/eos_benchmark.img"
+    loopName = None
+    try:
+        with timer.Phase("image"):
+            RunCommand(f"truncate -s {imageSizeGb}G \"{imagePath}\"")
+            loopName = os.path.basename(RunCommand(f"losetup --find --show --partscan \"{imagePath}\"", capture=True))
+        PrepareDisk(GetDisk(loopName), "eos-benchmark-password", timer)
+    finally:
+        RunCommand("umount -R /new_root", check=False)
+        RunCommand("cryptsetup close new_cryptroot", check=False)
+        if loopName != None:
+            RunCommand(f"losetup -d /dev/{loopName}", check=False)
+        if os.path.exists(imagePath):
+            os.remove(imagePath)
+        if os.path.isdir("/new_root") and len(os.listdir("/new_root")) == 0:
+            os.rmdir("/new_root")
+    print()
+    timer.PrintSummary()
+    timer.WriteReport(reportPath)
+    print(f"Wrote benchmark report to {reportPath}.")
+
+def BuildGoldenImage(imagePath, imageSizeGb):
+    # Installs the base system once into a sparse ext4 image which --image-deploy then copies to any number of
+    # disks. The image is unencrypted and has no fstab, swapfile or machine-id since those are made per disk.
+    timer = PhaseTimer()
+    try:
+        with timer.Phase("image"):
+            RunCommand(f"truncate -s {imageSizeGb}G \"{imagePath}\"")
+            RunCommand(f"mkfs.ext4 -q -F -L \"EOS Root\" -O metadata_csum_seed -E lazy_journal_init \"{imagePath}\"")
+            os.makedirs("/new_root", exist_ok=True)
+            RunCommand(f"mount -o loop \"{imagePath}\" /new_root")
+        with timer.Phase("pacstrap"):
+            print("Installing base system into the image... (This will take a very long time.)")
+            RunCommand("pacstrap /new_root base linux linux-firmware zram-generator --noconfirm", echo=True)
+            for identityPath in ["/new_root/etc/machine-id", "/new_root/etc/fstab"]:
+                if os.path.exists(identityPath):
+                    os.remove(identityPath)
+        with timer.Phase("storage"):
+            ConfigureStorage("/new_root")
+        with timer.Phase("trim"):
+            # Punches holes for every free block so the image stays sparse on disk
+            RunCommand("fstrim /new_root")
+    finally:
+        RunCommand("umount /new_root", check=False)
+        if os.path.isdir("/new_root") and len(os.listdir("/new_root")) == 0:
+            os.rmdir("/new_root")
+    RunCommand(f"e2fsck -fy \"{imagePath}\"")
+    print()
+    timer.PrintSummary()
+    print(f"Golden image written to {imagePath}.")
+
+def DeployGoldenImage(imagePath, eosDisk, diskPass, specs, luksSlots):
+    # Runs on its own thread per disk so every path and mapper name is unique to the disk. cpu and io counters
+    # would include every other disk's work so only wall time is recorded.
+    timer = PhaseTimer(wallOnly=True)
+    rootPath = f"/new_root_{eosDisk.name}"
+    mapperName = f"new_cryptroot_{eosDisk.name}"
+    try:
+        PrepareDisk(eosDisk, diskPass, timer, rootPath, mapperName, imagePath, specs, luksSlots)
+        with timer.Phase("machine-id"):
+            RunCommand(f"systemd-machine-id-setup --root={rootPath}")
+        with timer.Phase("swap"):
+            # The image has no swap since its size depends on the disk and on the machine being installed
+            ConfigureSwap(rootPath, specs)
+        timer.WriteReport(f"{rootPath}/var/log/eos_install.json")
+    finally:
+        RunCommand(f"umount -R {rootPath}", check=False)
+        RunCommand(f"cryptsetup close {mapperName}", check=False)
+        if os.path.isdir(rootPath) and len(os.listdir(rootPath)) == 0:
+            os.rmdir(rootPath)
+    return timer
+
+def DeployGoldenImageToDisks(imagePath, diskNames, specs):
+    disks = GetDisks()
+    imageSize = os.path.getsize(imagePath)
+    for diskName in diskNames:
+        if not diskName in disks:
+            raise Exception(f"/dev/{diskName} is not a valid disk.")
+        if disks[diskName].size < imageSize + 1024 * 1024 * 1024:
+            raise Exception(f"/dev/{diskName} is too small for {imagePath}.")
+    for diskName in diskNames:
+        PrintWarning(f"All data on {disks[diskName].Describe()} will be destroyed!")
+    print(f"Swap and encryption will be tuned for the target machine: {specs.Describe()}.")
+    if not Choice("Are you sure you want to proceed?"):
+        print()
+        print("Aborting install. Nothing was changed.")
+        print()
+        sys.exit(1)
+    print()
+    diskPass = PromptDiskPassword()
+
+    # Every luksFormat and open holds the full argon2 memory so only as many run at once as fit in half of the
+    # memory available. Everything else about each disk is independent.
+    pbkdfMemoryKib = GetPbkdfMemoryKib(specs)
+    availableKib = GetMemInfoKib("MemAvailable")
+    if pbkdfMemoryKib > availableKib:
+        PrintWarning(f"Argon2 needs {pbkdfMemoryKib // 1024} MiB per disk but only {availableKib // 1024} MiB is available on this machine.")
+    luksSlots = threading.BoundedSemaphore(max(1, availableKib // 2 // pbkdfMemoryKib))
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(diskNames)) as executor:
+        futures = { executor.submit(DeployGoldenImage, imagePath, disks[diskName], diskPass, specs, luksSlots): diskName for diskName in diskNames }
+        for future in concurrent.futures.as_completed(futures):
+            diskName = futures[future]
+            if future.exception() != None:
+                PrintError(f"/dev/{diskName}: {future.exception()}")
+                failed = True
+                continue
+            print(f"/dev/{diskName} done:")
+            future.result().PrintSummary()
+            print()
+    if failed:
+        raise Exception("Deploying the golden image failed on some disks.")
+
+def PromptDiskPassword():
+    while True:
+        diskPass = input("Please enter your password for disk encryption: ")
+        if diskPass == "":
+            PrintError("Disk encryption is required to install EOS and your password may not be blank.")
+            continue
+        if len(diskPass) < 16:
+            PrintWarning(f"A password of length 16 or greater is highly recommended but yours is only {len(diskPass)}.")
+            if not Choice("Are you sure you want to proceed?"):
+                print("Okay let's start over.")
+                continue
+        diskPassConfirmation = input("Please retype your password for disk encryption to confirm: ")
+        if diskPass != diskPassConfirmation:
+            PrintError("Passwords did not match. Let's start over.")
+            continue
+        break
+    print()
+    return diskPass
 
 def main():
     # Initialization and scanity checking
-    RequirePackage("util-linux") # lsblk wipefs mount blockdev
+    RequirePackage("util-linux") # wipefs mount blkid
+    RequirePackage("systemd") # udevadm
     RequirePackage("cryptsetup") # cryptsetup
     RequirePackage("gptfdisk") # sgdisk
     RequirePackage("dosfstools") # mkfs.fat
@@ -16,14 +242,42 @@ def main():
     RequirePackage("arch-install-scripts") # pacstrap arch-chroot
     AssertPacmanPacs()
     AssertRoot()
-    Assertx64()
-    AssertEfi()
     if os.path.ismount("/new_root"):
         raise Exception("Something is already mounted at /new_root. Please manually unmount.")
     if os.path.isdir("/new_root") and len(os.listdir("/new_root")) != 0:
         raise Exception("/new_root already exists and is not empty. Please manually check.")
     if os.path.exists("/dev/mapper/new_cryptroot"):
         raise Exception("Something is already open in cryptsetup as new_cryptroot. Please manually close.")
+    if "--benchmark" in sys.argv:
+        args = sys.argv[1:]
+        imageSizeGb = int(args[args.index("--size") + 1]) if "--size" in args else 8
+        reportPath = args[args.index("--report") + 1] if "--report" in args else "eos_install_benchmark.json"
+        Benchmark(imageSizeGb, reportPath)
+        return
+    if "--image-build" in sys.argv:
+        AssertInternet()
+        args = sys.argv[1:]
+        imageSizeGb = int(args[args.index("--size") + 1]) if "--size" in args else 16
+        BuildGoldenImage(args[args.index("--image-build") + 1], imageSizeGb)
+        return
+    if "--image-deploy" in sys.argv:
+        # The disks boot in another machine so its RAM and CPU count are needed to size swap and argon2
+        args = sys.argv[1:]
+        usage = "Usage: base_install.py --target-ram <GiB> --target-cpus <count> --image-deploy <image> <disk>..."
+        targetArgs = [ args[args.index(option) + 1] if option in args and args.index(option) + 1 < len(args) else "" for option in ["--target-ram", "--target-cpus"] ]
+        if not all([ targetArg.isdigit() and int(targetArg) > 0 for targetArg in targetArgs ]):
+            PrintError(usage)
+            sys.exit(1)
+        specs = MachineSpecs(int(targetArgs[0]) * 1024 * 1024 * 1024, int(targetArgs[1]))
+        deployArgs = args[args.index("--image-deploy") + 1:]
+        deployArgs = [ arg for i, arg in enumerate(deployArgs) if not arg in ["--target-ram", "--target-cpus"] and (i == 0 or not deployArgs[i - 1] in ["--target-ram", "--target-cpus"]) ]
+        if len(deployArgs) < 2:
+            PrintError(usage)
+            sys.exit(1)
+        DeployGoldenImageToDisks(deployArgs[0], deployArgs[1:], specs)
+        return
+    Assertx64()
+    AssertEfi()
     AssertInternet()
     print()
     print("----- EOS Base Installer v1.1.0 -----")
@@ -31,104 +285,61 @@ def main():
 
     # User input for disk, partitions, and filesystems phase of installation
     print("List of disks:")
-    RunCommand("lsblk -d -n -o NAME,MODEL,SIZE,TYPE | grep \' disk$\' | sed \'s/ disk$//\'", echo=True)
-    validDrives = RunCommand("lsblk -d -n -o NAME,TYPE | grep \' disk$\' | sed \'s/ disk$//\'", capture=True)
-    validDrives = [validDrive.strip() for validDrive in validDrives.splitlines() if validDrive.strip()]
+    disks = GetDisks()
+    for disk in disks.values():
+        print(disk.Describe())
     while True:
         print("Select a disk from the list above to install EOS: ", end="")
         eosDrive = input()
-        if not eosDrive in validDrives:
+        if not eosDrive in disks:
             PrintError(f"/dev/{eosDrive} is not a valid disk.")
-        elif int(RunCommand(f"blockdev --getsize64 /dev/{eosDrive}", capture=True)) < 4_000_000_000:
+        elif disks[eosDrive].size < 4_000_000_000:
             PrintError(f"/dev/{eosDrive} must have at least 4GB of space to install EOS.")
         else:
             break
+    eosDisk = disks[eosDrive]
     print()
 
-    PrintWarning(f"All data on {RunCommand(f"lsblk -d -n -o MODEL,SIZE /dev/{eosDrive}", capture=True)} will be destroyed!")
+    PrintWarning(f"All data on {eosDisk.Describe()} will be destroyed!")
     if not Choice("Are you sure you want to proceed?"):
         print()
         print("Aborting install. Nothing was changed.")
         print()
         sys.exit(1)
     print()
+    diskPass = PromptDiskPassword()
 
-    while True:
-        diskPass = input("Please enter your password for disk encryption: ")
-        if diskPass == "":
-            PrintError("Disk encryption is required to install EOS and your password may not be blank.")
-            continue
-        if len(diskPass) < 16:
-            PrintWarning(f"A password of length 16 or greater is highly recommended but yours is only {len(diskPass)}.")
-            if not Choice("Are you sure you want to proceed?"):
-                print("Okay let's start over.")
-                continue
-        diskPassConfirmation = input("Please retype your password for disk encryption to confirm: ")
-        if diskPass != diskPassConfirmation:
-            PrintError("Passwords did not match. Let's start over.")
-            continue
-        break
+    timer = PhaseTimer()
+    PrepareDisk(eosDisk, diskPass, timer)
     print()
 
-    # Disk, partition, filesystem, and encryption setup
-    print("Creating new GPT partition table...")
-    RunCommand(f"wipefs -a /dev/{eosDrive}")
-    RunCommand(f"sgdisk --clear /dev/{eosDrive}")
+    # Pacstrap base system install
+    with timer.Phase("pacstrap"):
+        print("Installing base system... (This will take a very long time.)")
+        RunCommand("pacstrap /new_root base linux linux-firmware zram-generator --noconfirm", echo=True)
+        print("Installed base system.")
+    print()
 
-    print("Creating partitions...")
-    RunCommand(f"sgdisk --new=0:0:+512M --typecode=0:EF00 --change-name=0:\"EOS EFI Partition\" /dev/{eosDrive}")
-    RunCommand(f"sgdisk --new=0:0:0 --typecode=0:8309 --change-name=0:\"EOS Root\" /dev/{eosDrive}")
-    
-    print("Setting up disk encryption...")
-    RunCommand(f"cryptsetup luksFormat /dev/{eosDrive}{"p2" if eosDrive.startswith("nvme") else "2"} --type luks2 --cipher aes-xts-plain64 --force-password --hash sha512 --pbkdf argon2id --use-random --batch-mode", input=diskPass) # OPTIONAL: --integrity hmac-sha256
-    RunCommand(f"cryptsetup open /dev/{eosDrive}{"p2" if eosDrive.startswith("nvme") else "2"} new_cryptroot --batch-mode", input=diskPass)
+    # IO schedulers, read ahead and periodic trim
+    with timer.Phase("storage"):
+        ConfigureStorage("/new_root")
 
-    print("Creating filesystems...")
-    RunCommand(f"mkfs.fat -F32 -n \"EFI\" -S 4096 /dev/{eosDrive}{"p1" if eosDrive.startswith("nvme") else "1"}")
-    RunCommand("mkfs.ext4 -q -L \"EOS Root\" -E lazy_journal_init /dev/mapper/new_cryptroot")
-    
-    print("Mounting filesystems...")
-    os.makedirs("/new_root/", exist_ok=True)
-    RunCommand("mount /dev/mapper/new_cryptroot /new_root")
-    os.makedirs("/new_root/boot", exist_ok=True)
-    RunCommand(f"mount /dev/{eosDrive}{"p1" if eosDrive.startswith("nvme") else "1"} /new_root/boot")
-    
-    # Genfstab
-    print(f"Generating fstab...")
-    bootPartitionUUID = RunCommand(f"blkid -o value -s UUID /dev/{eosDrive}{"p1" if eosDrive.startswith("nvme") else "1"}", capture=True)
-    rootPartitionUUID = RunCommand("blkid -o value -s UUID /dev/mapper/new_cryptroot", capture=True)
-    eosDriveSupportsTrim = ReadFile(f"/sys/block/{eosDrive}/queue/discard_max_bytes").strip() != "0"
-    fstab = [
-        "# <partition> <mount point> <filesystem type> <options> <dump> <pass>",
-        "",
-        "# EOS Root",
-        f"UUID={rootPartitionUUID} / ext4 rw,noatime,errors=remount-ro{",discard" if eosDriveSupportsTrim else ""} 0 1",
-        "",
-        "# EOS EFI Partition",
-        f"UUID={bootPartitionUUID} /boot vfat rw,noatime,errors=remount-ro,uid=0,gid=0,dmask=0077,fmask=0177,codepage=437,iocharset=ascii,shortname=mixed,utf8{",discard" if eosDriveSupportsTrim else ""} 0 2",
-    ]
-    os.makedirs("/new_root/etc/", exist_ok=True)
-    WriteFile("/new_root/etc/fstab", "\n".join(fstab))
+    # Swap sized from this machine's RAM and the new root filesystem
+    with timer.Phase("swap"):
+        swapPlan = ConfigureSwap("/new_root")
+        for line in swapPlan.Describe():
+            print(line)
     print()
 
-    # Pacstrap base system install
-    print("Installing base system... (This will take a very long time.)")
-    RunCommand("pacstrap /new_root base linux linux-firmware --noconfirm", echo=True)
-    print("Installed base system.")
+    timer.PrintSummary()
+    timer.WriteReport("/new_root/var/log/eos_install.json")
     print()
 
-    # DONT FORGET TO CREATE SOME SWAP
-    # for example a swap file can be created like this
-    # fallocate -l 64G /swapfile
-    # sudo chmod 600 /swapfile
-    # sudo chown +0:+0 /swapfile
-    # sudo mkswap /swapfile
-    # sudo swapon /swapfile
-
     return
 
 
     # Guess and set the user's timezone
+    import requests
     try:
         response = requests.get("https://ipapi.co/timezone/")
         response.raise_for_status()
@@ -146,21 +357,9 @@ def main():
     except:
         print(f"\033[0m\033[33mWARNING: Internet is required to auto set your locale. Defaulting to en_US.\033[0m")
         language = "en_US"
-    if "," in language: language = language[0:language.index(",")]
-    language = language.replace("-", "_")
-    bestLocale = "es_US.UTF-8 UTF-8"
-    with open("/new_root/usr/share/i18n/SUPPORTED", "r", encoding="UTF-8") as supportedLocalesFile:
-        locales = [locale.strip() for locale in supportedLocalesFile.readlines()]
-        for locale in locales:
-            langMatch = language in locale
-            bestLangMatch = language in bestLocale
-            charsetMatch = "UTF-8" in locale
-            bestCharsetMatch = "UTF-8" in bestLocale
-            if langMatch and not bestLangMatch:
-                bestLocale = locale
-            if langMatch and charsetMatch and not bestCharsetMatch:
-                bestLocale = locale
-    WriteFile("/new_root/etc/locale.gen", bestLocale)
+    locales = LocaleIndex("/new_root/usr/share/i18n/SUPPORTED").ResolveMany(language)
+    WriteFile("/new_root/etc/locale.gen", "".join([f"{locale.line}\n" for locale in locales]))
+    WriteFile("/new_root/etc/locale.conf", f"LANG={locales[0].name}\n")
     RunCommand(f"arch-chroot /new_root locale-gen")
     
     # Update the system time and set the timedate service to localtime
@@ -35,12 +35,17 @@ fi
 echo "Select drive to create hackstick."
 lsblk -d -n -o NAME,SIZE,MODEL
 read osDrive
-if [[ ! -b /dev/$osDrive ]] || [[ ! "$(lsblk -dn -o TYPE /dev/$osDrive)" == "disk" ]]; then
+if [[ ! -b /dev/$osDrive ]] || [[ ! -e /sys/block/$osDrive/device ]]; then
     error "/dev/$osDrive is not a valid disk."
     abort
 fi
+# Partitions of disks whose names end in a digit (nvme0n1, mmcblk0) get a p before the partition number
+osPart="/dev/$osDrive"
+if [[ "$osDrive" =~ [0-9]$ ]]; then
+    osPart="${osPart}p"
+fi
 echo "WARNING: All data in all partitions on /dev/$osDrive will be destroyed!"
-if (( $(lsblk -b -dn -o SIZE /dev/$osDrive) > 64 * 1024 * 1024 * 1024 )); then
+if (( $(cat /sys/block/$osDrive/size) * 512 > 64 * 1024 * 1024 * 1024 )); then
     printf "\e[31m"
     echo "WARNING: Additionally /dev/$osDrive seems to be a LARGE DRIVE!"
     printf "\e[0m"
@@ -59,16 +64,16 @@ sgdisk --zap-all /dev/$osDrive
 sgdisk /dev/$osDrive --new=1:1M:+1M --typecode=1:ef02 >/dev/null
 # EFI System Partition (ESP) (512 MiB)
 sgdisk --new=2:2M:+512M --typecode=2:EF00 --change-name=2:"EFI System Partition" /dev/$osDrive >/dev/null
-mkfs.fat -F32 -n "EFI" /dev/${osDrive}2 >/dev/null
+mkfs.fat -F32 -n "EFI" ${osPart}2 >/dev/null
 # Root partition (rest of the disk)
 sgdisk --new=3:514M:0 --typecode=3:8309 --change-name=3:"HackStick" /dev/$osDrive >/dev/null
-mkfs.ext4 -q -L "HackStick" -E lazy_journal_init /dev/${osDrive}3 >/dev/null
+mkfs.ext4 -q -L "HackStick" -E lazy_journal_init ${osPart}3 >/dev/null
 
 # Mount filesystems
 echo "Mounting filesystems..."
-mount /dev/${osDrive}3 /mnt
+mount ${osPart}3 /mnt
 mkdir -p /mnt/boot
-mount /dev/${osDrive}2 /mnt/boot
+mount ${osPart}2 /mnt/boot
 
 # Install arch
 echo "Installing base arch... (THIS WILL TAKE AWHILE)"
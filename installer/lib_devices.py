@@ -0,0 +1,117 @@
+import subprocess
+import os
+
+# Device inventory read straight from sysfs so listing disks, checking sizes and looking up trim support never
+# forks lsblk, blockdev or blkid. The inventory is read once and cached for the rest of the install.
+
+def ReadSysFile(filePath, defaultContents=""):
+    try:
+        with open(filePath, "r", encoding="UTF-8") as file:
+            return file.read().strip()
+    except OSError:
+        return defaultContents
+
+def ReadSysInt(filePath, defaultValue=0):
+    try:
+        return int(ReadSysFile(filePath))
+    except ValueError:
+        return defaultValue
+
+def GetPartitionName(diskName, partitionNumber):
+    # The kernel inserts a p when the disk name already ends in a digit (nvme0n1p1, mmcblk0p1, loop0p1 vs sda1)
+    return f"{diskName}{"p" if diskName[-1].isdigit() else ""}{partitionNumber}"
+
+def FormatSize(byteCount):
+    for unit in ["B", "K", "M", "G", "T"]:
+        if byteCount < 1024 or unit == "T":
+            return f"{byteCount:.1f}{unit}" if unit != "B" else f"{byteCount}B"
+        byteCount /= 1024
+
+class Partition:
+    def __init__(self, disk, name):
+        sysPath = f"/sys/class/block/{name}"
+        self.disk = disk
+        self.name = name
+        self.path = f"/dev/{name}"
+        self.number = ReadSysInt(f"{sysPath}/partition")
+        self.start = ReadSysInt(f"{sysPath}/start") * 512
+        self.size = ReadSysInt(f"{sysPath}/size") * 512
+
+    def __repr__(self):
+        return f"Partition({self.path}, {FormatSize(self.size)})"
+
+class Disk:
+    def __init__(self, name):
+        sysPath = f"/sys/block/{name}"
+        self.name = name
+        self.path = f"/dev/{name}"
+        # sysfs sizes are always in 512 byte sectors no matter the real sector size
+        self.size = ReadSysInt(f"{sysPath}/size") * 512
+        self.model = " ".join(ReadSysFile(f"{sysPath}/device/model").split())
+        self.physical = os.path.exists(f"{sysPath}/device")
+        # Disks a hypervisor provides. 0x1af4 is the virtio PCI vendor, vbd is the xen block driver.
+        self.virtual = os.path.basename(os.path.realpath(f"{sysPath}/device/driver")) in ["virtio_blk", "vbd"] or ReadSysFile(f"{sysPath}/device/vendor") in ["QEMU", "VMware", "Msft", "0x1af4"]
+        self.removable = ReadSysInt(f"{sysPath}/removable") != 0
+        self.readOnly = ReadSysInt(f"{sysPath}/ro") != 0
+        self.rotational = ReadSysInt(f"{sysPath}/queue/rotational") != 0
+        self.supportsTrim = ReadSysInt(f"{sysPath}/queue/discard_max_bytes") != 0
+        self.discardGranularity = ReadSysInt(f"{sysPath}/queue/discard_granularity")
+        self.logicalSectorSize = ReadSysInt(f"{sysPath}/queue/logical_block_size", 512)
+        self.physicalSectorSize = ReadSysInt(f"{sysPath}/queue/physical_block_size", 512)
+        self.minimumIoSize = ReadSysInt(f"{sysPath}/queue/minimum_io_size", 512)
+        self.optimalIoSize = ReadSysInt(f"{sysPath}/queue/optimal_io_size")
+        self.partitions = []
+        if os.path.isdir(sysPath):
+            for entryName in sorted(os.listdir(sysPath)):
+                if os.path.exists(f"{sysPath}/{entryName}/partition"):
+                    self.partitions.append(Partition(self, entryName))
+            self.partitions.sort(key=lambda partition: partition.number)
+
+    def GetPartitionPath(self, partitionNumber):
+        return f"/dev/{GetPartitionName(self.name, partitionNumber)}"
+
+    def Describe(self):
+        return f"{self.name} {self.model if self.model != "" else "(no model)"} {FormatSize(self.size)}"
+
+    def __repr__(self):
+        return f"Disk({self.path}, {self.Describe()})"
+
+cachedDisks = None
+def GetDisks(refresh=False):
+    # Only real disks, which have a device link in sysfs. Loop, dm, md, zram and ram devices are left out.
+    global cachedDisks
+    if cachedDisks == None or refresh:
+        disks = {}
+        for diskName in sorted(os.listdir("/sys/block")):
+            disk = Disk(diskName)
+            if disk.physical and disk.size > 0:
+                disks[diskName] = disk
+        cachedDisks = disks
+    return cachedDisks
+
+def GetDisk(diskName, refresh=False):
+    # Any block device in /sys/block can be looked up by name, including ones GetDisks leaves out
+    disks = GetDisks(refresh)
+    if diskName in disks:
+        return disks[diskName]
+    if diskName == "" or "/" in diskName or not os.path.isdir(f"/sys/block/{diskName}"):
+        return None
+    return Disk(diskName)
+
+def RefreshDisk(diskName):
+    # Call after repartitioning so the new partitions show up. Waits for udev to create the device nodes first.
+    subprocess.run(["udevadm", "settle"], check=False)
+    disk = Disk(diskName)
+    if cachedDisks != None and diskName in cachedDisks:
+        cachedDisks[diskName] = disk
+    return disk
+
+def GetFilesystemUuid(devicePath):
+    # udev already maintains /dev/disk/by-uuid so blkid is only needed when udev hasn't caught up
+    subprocess.run(["udevadm", "settle"], check=False)
+    realPath = os.path.realpath(devicePath)
+    if os.path.isdir("/dev/disk/by-uuid"):
+        for uuidName in os.listdir("/dev/disk/by-uuid"):
+            if os.path.realpath(f"/dev/disk/by-uuid/{uuidName}") == realPath:
+                return uuidName
+    return subprocess.run(["blkid", "-o", "value", "-s", "UUID", devicePath], capture_output=True, check=True, text=True).stdout.strip()
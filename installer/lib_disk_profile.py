@@ -0,0 +1,143 @@
+import threading
+import os
+
+from lib_installer import *
+from lib_storage import *
+
+# Picks LUKS and ext4 settings for the disk EOS is being installed to. Ciphers are benchmarked because machines
+# without AES instructions are several times faster with adiantum. Argon2 iterations are benchmarked against a
+# target unlock time with memory and threads capped to what the machine has. SSDs get 4K crypt sectors and
+# bypass the dm-crypt workqueues, which otherwise add a context switch to every request and cap NVMe throughput.
+TARGET_UNLOCK_MS = 2000
+MAX_PBKDF_MEMORY_KIB = 1024 * 1024
+
+# Benchmarks are cached and never run concurrently. Disks imaged in parallel would otherwise each benchmark
+# a CPU that is busy benchmarking for the other disks and all pick weaker settings.
+benchmarkLock = threading.Lock()
+benchmarkCache = {}
+def CachedBenchmark(benchmarkFunction, *args):
+    with benchmarkLock:
+        key = (benchmarkFunction.__name__,) + args
+        if not key in benchmarkCache:
+            benchmarkCache[key] = benchmarkFunction(*args)
+        return benchmarkCache[key]
+
+def BenchmarkCipher(cipher, keySize):
+    # Returns the slower of encryption and decryption in MiB/s or 0 if the kernel lacks the cipher
+    output = RunCommand(f"cryptsetup benchmark --cipher {cipher} --key-size {keySize}", capture=True, check=False)
+    for line in output.splitlines():
+        tokens = line.split()
+        if line.startswith("#") or len(tokens) < 6 or tokens[2] == "N/A":
+            continue
+        try:
+            return min(float(tokens[2]), float(tokens[4]))
+        except ValueError:
+            continue
+    return 0
+
+def BenchmarkArgon2(memoryKib, parallel):
+    # Returns the argon2id iterations that take TARGET_UNLOCK_MS on this machine or 0 if it couldn't be measured.
+    # Output looks like "argon2id      4 iterations, 1048576 memory, 4 parallel threads (CPUs) for 256-bit key (requested 2000 ms time)"
+    output = RunCommand(f"cryptsetup benchmark --pbkdf argon2id --iter-time {TARGET_UNLOCK_MS} --pbkdf-memory {memoryKib} --pbkdf-parallel {parallel}", capture=True, check=False)
+    for line in output.splitlines():
+        tokens = line.split()
+        if len(tokens) >= 3 and tokens[0] == "argon2id" and tokens[2].startswith("iterations") and tokens[1].isdigit():
+            return int(tokens[1])
+    return 0
+
+def GetMemInfoKib(key):
+    for line in ReadFile("/proc/meminfo").splitlines():
+        if line.startswith(f"{key}:"):
+            return int(line.split()[1])
+    return 0
+def GetMemTotalKib():
+    return GetMemInfoKib("MemTotal")
+
+class MachineSpecs:
+    # The machine a disk is being set up for. Normally that is this machine but golden images are deployed on an
+    # imaging host to disks which then boot somewhere else.
+    def __init__(self, ramBytes, cpuCount):
+        self.ramBytes = ramBytes
+        self.cpuCount = cpuCount
+
+    def Describe(self):
+        return f"{self.ramBytes // (1024 * 1024 * 1024)} GiB RAM, {self.cpuCount} CPUs"
+
+def GetHostSpecs():
+    return MachineSpecs(GetMemTotalKib() * 1024, os.cpu_count() or 1)
+
+def GetPbkdfMemoryKib(specs):
+    return max(64 * 1024, min(MAX_PBKDF_MEMORY_KIB, specs.ramBytes // 1024 // 4))
+
+class DiskProfile:
+    def __init__(self, disk, specs=None):
+        # Argon2 iterations are still timed on this machine since luksFormat can only run here
+        specs = specs if specs != None else GetHostSpecs()
+        self.disk = disk
+        self.aesSpeed = CachedBenchmark(BenchmarkCipher, "aes-xts-plain64", 512)
+        self.adiantumSpeed = CachedBenchmark(BenchmarkCipher, "xchacha12,aes-adiantum-plain64", 256)
+        if self.adiantumSpeed > self.aesSpeed * 1.5:
+            self.cipher = "xchacha12,aes-adiantum-plain64"
+            self.keySize = 256
+        else:
+            self.cipher = "aes-xts-plain64"
+            self.keySize = 512
+        self.solidState = not disk.rotational
+        # Partitions are 1MiB aligned so 4K crypt sectors are always safe and halve per sector overhead
+        self.sectorSize = 4096 if self.solidState or disk.logicalSectorSize >= 4096 or disk.physicalSectorSize >= 4096 else 512
+        self.noWorkqueues = self.solidState
+        # Discards pass through dm-crypt whenever the disk can trim so fstrim works even without online discard
+        self.allowDiscards = disk.supportsTrim
+        self.discardMode = ChooseDiscardMode(disk)
+        self.pbkdfMemoryKib = GetPbkdfMemoryKib(specs)
+        self.pbkdfParallel = max(1, min(4, specs.cpuCount))
+        self.pbkdfIterations = CachedBenchmark(BenchmarkArgon2, self.pbkdfMemoryKib, self.pbkdfParallel)
+        # stride and stripe width only mean something when the device reports io hints (md raid, some SSDs)
+        self.stride = disk.minimumIoSize // 4096 if disk.minimumIoSize > 4096 else 0
+        self.stripeWidth = disk.optimalIoSize // 4096 if disk.optimalIoSize > 4096 else 0
+
+    def GetLuksFormatArgs(self):
+        return f"--type luks2 --cipher {self.cipher} --key-size {self.keySize} --sector-size {self.sectorSize} --hash sha512 --pbkdf argon2id {f"--pbkdf-force-iterations {self.pbkdfIterations}" if self.pbkdfIterations != 0 else f"--iter-time {TARGET_UNLOCK_MS}"} --pbkdf-memory {self.pbkdfMemoryKib} --pbkdf-parallel {self.pbkdfParallel}"
+
+    def GetOpenArgs(self):
+        # --persistent stores the flags in the LUKS2 header so every later open, including the encrypt hook in
+        # the initramfs which never reads crypttab, uses them without anything on the kernel cmdline
+        args = ["--persistent"]
+        if self.allowDiscards:
+            args.append("--allow-discards")
+        if self.noWorkqueues:
+            args.append("--perf-no_read_workqueue")
+            args.append("--perf-no_write_workqueue")
+        return " ".join(args)
+
+    def GetCrypttabOptions(self):
+        options = ["luks"]
+        if self.allowDiscards:
+            options.append("discard")
+        if self.noWorkqueues:
+            options.append("no-read-workqueue")
+            options.append("no-write-workqueue")
+        return ",".join(options)
+
+    def GetMkfsExt4Args(self):
+        extendedOptions = ["lazy_journal_init"]
+        if self.stride != 0:
+            extendedOptions.append(f"stride={self.stride}")
+        if self.stripeWidth != 0:
+            extendedOptions.append(f"stripe_width={self.stripeWidth}")
+        return f"-b 4096 -E {",".join(extendedOptions)}"
+
+    def GetExt4MountOptions(self):
+        return GetExt4MountOptions(self.discardMode)
+
+    def GetVfatMountOptions(self):
+        return GetVfatMountOptions(self.discardMode)
+
+    def Describe(self):
+        return [
+            f"Cipher: {self.cipher} ({self.keySize} bit key, {self.sectorSize} byte sectors) aes-xts {self.aesSpeed:.0f} MiB/s, adiantum {self.adiantumSpeed:.0f} MiB/s",
+            f"Argon2id: {TARGET_UNLOCK_MS}ms unlock target ({self.pbkdfIterations if self.pbkdfIterations != 0 else "unknown"} iterations), {self.pbkdfMemoryKib // 1024} MiB, {self.pbkdfParallel} threads",
+            f"dm-crypt: {self.GetCrypttabOptions()}",
+            f"ext4: {self.GetMkfsExt4Args()}",
+            f"Trim: {self.discardMode}",
+        ]
@@ -1,6 +1,5 @@
 import subprocess
 import os
-import requests
 
 def WriteFile(filePath, contents, binary=False):
     filePath = os.path.abspath(filePath)
@@ -58,6 +57,8 @@ def AssertRoot():
         raise Exception("The EOS installer must be run as root.")
 
 def AssertInternet():
+    # requests is slow to import and only needed here so it isn't loaded by paths that never touch the network
+    import requests
     try:
         response = requests.get("http://clients3.google.com/generate_204")
         response.raise_for_status()
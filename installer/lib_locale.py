@@ -0,0 +1,96 @@
+from lib_installer import *
+
+# Resolves language tags like "en-US", "sr-Latn-RS", "pt" or the comma separated lists geo ip services return to
+# the best entries in glibc's SUPPORTED file. SUPPORTED is parsed once into an index keyed by language so each
+# lookup only scores that language's handful of locales, and only the chosen locales end up in locale.gen.
+
+# Territory to prefer when a tag names no territory, or one SUPPORTED lacks, and the language code isn't a country code
+DEFAULT_TERRITORIES = {
+    "ar": "EG", "bn": "BD", "cs": "CZ", "da": "DK", "el": "GR", "en": "US", "et": "EE", "fa": "IR", "he": "IL",
+    "hi": "IN", "ja": "JP", "ko": "KR", "nb": "NO", "nn": "NO", "pt": "BR", "sl": "SI", "sq": "AL", "sr": "RS",
+    "sv": "SE", "sw": "KE", "ta": "IN", "uk": "UA", "ur": "PK", "vi": "VN", "zh": "CN",
+}
+# BCP-47 scripts which glibc spells as @modifiers or implies by territory
+SCRIPT_MODIFIERS = { "latn": "latin", "cyrl": "cyrillic", "deva": "devanagari" }
+SCRIPT_TERRITORIES = { "hans": "CN", "hant": "TW" }
+DEFAULT_LOCALE = "en_US.UTF-8 UTF-8"
+
+class SupportedLocale:
+    def __init__(self, line):
+        # "sr_RS.UTF-8@latin UTF-8" -> language sr, territory RS, codeset UTF-8, modifier latin
+        self.line = line
+        self.name, self.charset = line.split()
+        rest = self.name
+        self.modifier = ""
+        if "@" in rest:
+            rest, self.modifier = rest.split("@", 1)
+        self.codeset = ""
+        if "." in rest:
+            rest, self.codeset = rest.split(".", 1)
+        self.language, _, self.territory = rest.partition("_")
+        self.utf8 = self.charset.upper() == "UTF-8"
+
+class LanguageTag:
+    def __init__(self, tag):
+        parts = [part for part in tag.strip().replace("_", "-").split(".")[0].split("-") if part != ""]
+        self.language = parts[0].lower() if len(parts) > 0 else ""
+        self.script = ""
+        self.territory = ""
+        for part in parts[1:]:
+            if len(part) == 4 and part.isalpha() and self.script == "":
+                self.script = part.lower()
+            elif (len(part) == 2 and part.isalpha()) or (len(part) == 3 and part.isdigit()):
+                if self.territory == "":
+                    self.territory = part.upper()
+        if self.territory == "" and self.script in SCRIPT_TERRITORIES:
+            self.territory = SCRIPT_TERRITORIES[self.script]
+
+class LocaleIndex:
+    def __init__(self, supportedPath="/usr/share/i18n/SUPPORTED"):
+        self.byLanguage = {}
+        self.byName = {}
+        for line in ReadFile(supportedPath).splitlines():
+            line = line.strip()
+            if line == "" or line.startswith("#") or len(line.split()) != 2:
+                continue
+            locale = SupportedLocale(line)
+            self.byLanguage.setdefault(locale.language, []).append(locale)
+            self.byName[locale.name] = locale
+
+    def Score(self, locale, tag):
+        # Territory beats script beats charset. Locales for the wrong territory still beat no match at all.
+        score = 0
+        if tag.territory != "" and locale.territory == tag.territory:
+            score += 16
+        elif locale.territory == DEFAULT_TERRITORIES.get(tag.language, tag.language.upper()):
+            score += 8
+        if SCRIPT_MODIFIERS.get(tag.script, "") == locale.modifier:
+            score += 4
+        if locale.utf8:
+            score += 2
+        if locale.modifier == "":
+            score += 1
+        return score
+
+    def Resolve(self, tag):
+        # Returns the best SupportedLocale for one tag or None when SUPPORTED has nothing in that language
+        tag = LanguageTag(tag)
+        candidates = self.byLanguage.get(tag.language, [])
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda locale: self.Score(locale, tag))
+
+    def ResolveMany(self, tags, limit=2):
+        # tags may be a list or a comma separated string like "en-US,es-US,haw". Falls back to DEFAULT_LOCALE.
+        if isinstance(tags, str):
+            tags = tags.split(",")
+        resolved = []
+        for tag in tags:
+            locale = self.Resolve(tag)
+            if locale != None and not locale in resolved:
+                resolved.append(locale)
+            if len(resolved) >= limit:
+                break
+        if len(resolved) == 0:
+            resolved.append(self.byName.get(DEFAULT_LOCALE.split()[0], SupportedLocale(DEFAULT_LOCALE)))
+        return resolved
@@ -0,0 +1,55 @@
+import os
+
+from lib_installer import *
+from lib_devices import *
+
+# Storage tuning shared by every filesystem the installer sets up. Online discard (the discard mount option)
+# sends a trim with every delete, which stalls writes on many SSDs, so real disks are trimmed in batches by
+# fstrim.timer instead. Virtual disks keep online discard since it is cheap there and hands freed space back to
+# the host right away. dm-crypt passes discards through in both cases because fstrim needs that too.
+EXT4_COMMIT_SECONDS = 30
+STORAGE_RULES_PATH = "/etc/udev/rules.d/69-eos-storage.rules"
+FSTRIM_DROPIN_PATH = "/etc/systemd/system/fstrim.service.d/eos.conf"
+
+def ChooseDiscardMode(disk):
+    # "online", "periodic" or "none" when the disk can't trim at all
+    if not disk.supportsTrim:
+        return "none"
+    if disk.virtual:
+        return "online"
+    return "periodic"
+
+def GetExt4MountOptions(discardMode):
+    # commit= only delays journal commits nothing asked to sync. fsync still hits the disk straight away.
+    return f"rw,noatime,commit={EXT4_COMMIT_SECONDS},errors=remount-ro{",discard" if discardMode == "online" else ""}"
+
+def GetVfatMountOptions(discardMode):
+    return f"rw,noatime,errors=remount-ro,uid=0,gid=0,dmask=0077,fmask=0177,codepage=437,iocharset=ascii,shortname=mixed,utf8{",discard" if discardMode == "online" else ""}"
+
+def ConfigureStorage(rootPath):
+    # Installs the io scheduler rules and turns on periodic trim in rootPath. Neither depends on the disks in
+    # this machine so this can run while building a golden image.
+    storageRules = [
+        "# This file is auto-generated by the EOS installer.",
+        "",
+        "# Only whole disks have a queue. Partitions match the same kernel names so they are skipped by DEVTYPE.",
+        "# NVMe and virtio queue in hardware so a kernel scheduler only adds latency",
+        "ACTION==\"add|change\", ENV{DEVTYPE}==\"disk\", KERNEL==\"nvme[0-9]*n[0-9]*|vd[a-z]*|xvd[a-z]*\", ATTR{queue/scheduler}=\"none\", ATTR{queue/read_ahead_kb}=\"128\"",
+        "# SATA and eMMC SSDs",
+        "ACTION==\"add|change\", ENV{DEVTYPE}==\"disk\", KERNEL==\"sd[a-z]*|mmcblk[0-9]*\", ATTR{queue/rotational}==\"0\", ATTR{queue/scheduler}=\"mq-deadline\", ATTR{queue/read_ahead_kb}=\"128\"",
+        "# Spinning disks and USB drives, where bfq keeps everything else responsive during long copies",
+        "ACTION==\"add|change\", ENV{DEVTYPE}==\"disk\", KERNEL==\"sd[a-z]*\", ATTR{queue/rotational}==\"1\", ATTR{queue/scheduler}=\"bfq\", ATTR{queue/read_ahead_kb}=\"1024\"",
+        "ACTION==\"add|change\", ENV{DEVTYPE}==\"disk\", KERNEL==\"sd[a-z]*|mmcblk[0-9]*\", ENV{ID_BUS}==\"usb\", ATTR{queue/scheduler}=\"bfq\", ATTR{queue/read_ahead_kb}=\"512\"",
+    ]
+    WriteFile(f"{rootPath}{STORAGE_RULES_PATH}", "\n".join(storageRules) + "\n")
+    # The stock unit only trims filesystems in fstab once fstab exists, which would skip volumes the EOS scripts
+    # mount themselves
+    fstrimDropin = [
+        "# This file is auto-generated by the EOS installer.",
+        "",
+        "[Service]",
+        "ExecStart=",
+        "ExecStart=/usr/bin/fstrim --listed-in /proc/self/mountinfo --verbose --quiet-unsupported",
+    ]
+    WriteFile(f"{rootPath}{FSTRIM_DROPIN_PATH}", "\n".join(fstrimDropin) + "\n")
+    RunCommand(f"systemctl --root={rootPath} enable fstrim.timer")
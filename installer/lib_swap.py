@@ -0,0 +1,68 @@
+import os
+
+from lib_installer import *
+from lib_disk_profile import *
+
+# Swap is two tiers. zram is the primary swap since compressing a page in memory is far cheaper than writing it
+# to disk, so memory pressure turns into a little cpu work instead of io stalls. A swapfile on the root filesystem
+# sits below it as a fallback and, when it can hold all of RAM, doubles as the hibernation image.
+GIB = 1024 * 1024 * 1024
+ZRAM_MAX_BYTES = 16 * GIB
+SWAPFILE_DISK_FRACTION = 0.10
+SWAPFILE_MIN_BYTES = 512 * 1024 * 1024
+
+class SwapPlan:
+    def __init__(self, ramBytes, rootFsBytes, cpuCount):
+        # zstd compresses roughly a third better but lz4 is several times cheaper on slow machines
+        self.zramCompressor = "zstd" if cpuCount > 2 else "lz4"
+        self.zramBytes = min(ramBytes // 2, ZRAM_MAX_BYTES)
+        # Hibernation needs room for everything in RAM. Rounded up to whole GiB so small RAM changes don't matter.
+        hibernateBytes = -(-ramBytes // GIB) * GIB
+        diskBudget = int(rootFsBytes * SWAPFILE_DISK_FRACTION)
+        if hibernateBytes <= diskBudget:
+            self.swapfileBytes = hibernateBytes
+            self.hibernate = True
+        else:
+            self.swapfileBytes = min(ramBytes // 2, diskBudget) // (256 * 1024 * 1024) * (256 * 1024 * 1024)
+            self.hibernate = False
+        if self.swapfileBytes < SWAPFILE_MIN_BYTES:
+            self.swapfileBytes = 0
+
+    def Describe(self):
+        return [
+            f"zram: {self.zramBytes // (1024 * 1024)} MiB with {self.zramCompressor}, priority 100",
+            f"swapfile: {self.swapfileBytes // (1024 * 1024)} MiB, priority 10{", hibernation capable" if self.hibernate else ""}" if self.swapfileBytes != 0 else "swapfile: none, the disk is too small",
+        ]
+
+def ConfigureSwap(rootPath, specs=None):
+    # Needs zram-generator installed in rootPath. Sized for specs, this machine by default. Returns the SwapPlan
+    # which was applied.
+    specs = specs if specs != None else GetHostSpecs()
+    statvfs = os.statvfs(rootPath)
+    plan = SwapPlan(specs.ramBytes, statvfs.f_blocks * statvfs.f_frsize, specs.cpuCount)
+    zramGeneratorConf = [
+        "[zram0]",
+        f"zram-size = {plan.zramBytes // (1024 * 1024)}",
+        f"compression-algorithm = {plan.zramCompressor}",
+        "swap-priority = 100",
+    ]
+    WriteFile(f"{rootPath}/etc/systemd/zram-generator.conf", "\n".join(zramGeneratorConf) + "\n")
+    # Recommended for swap on zram. Swapping to memory is cheap so prefer it over dropping page cache and
+    # don't read ahead since there is no seek cost to amortize.
+    sysctlConf = [
+        "vm.swappiness = 180",
+        "vm.watermark_boost_factor = 0",
+        "vm.watermark_scale_factor = 125",
+        "vm.page-cluster = 0",
+    ]
+    WriteFile(f"{rootPath}/etc/sysctl.d/99-eos-swap.conf", "\n".join(sysctlConf) + "\n")
+    if plan.swapfileBytes != 0:
+        # fallocate gives ext4 unwritten extents that are valid swap, unlike a sparse file, without writing zeros
+        RunCommand(f"fallocate -l {plan.swapfileBytes} {rootPath}/swapfile")
+        os.chmod(f"{rootPath}/swapfile", 0o600)
+        os.chown(f"{rootPath}/swapfile", 0, 0)
+        RunCommand(f"mkswap -L \"EOS Swap\" {rootPath}/swapfile")
+        fstab = ReadFile(f"{rootPath}/etc/fstab").rstrip("\n")
+        fstab += "\n\n# EOS Swap (zram is configured in /etc/systemd/zram-generator.conf)\n/swapfile none swap defaults,pri=10 0 0\n"
+        WriteFile(f"{rootPath}/etc/fstab", fstab)
+    return plan
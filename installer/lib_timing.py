@@ -0,0 +1,104 @@
+import contextlib
+import resource
+import platform
+import json
+import time
+import os
+
+from lib_installer import *
+
+# Wraps installer phases to record where the time went. Wall and cpu time come from the installer process and
+# its children (mkfs, cryptsetup, pacstrap and friends all run as children). Bytes read and written come from
+# /proc/self/io for the installer itself and from child rusage block counts for everything it ran. Those are all
+# process wide so timers used on several threads at once, like one per disk in a parallel deploy, are wallOnly.
+
+def ReadProcIo():
+    counters = {}
+    for line in ReadFile("/proc/self/io", "").splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            counters[key.strip()] = int(value)
+    return counters
+
+class PhaseTimer:
+    def __init__(self, wallOnly=False):
+        self.wallOnly = wallOnly
+        self.phases = []
+        self.startTime = time.time()
+        self.startMonotonic = time.monotonic()
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        if self.wallOnly:
+            with self.WallPhase(name):
+                yield
+            return
+        startWall = time.monotonic()
+        startSelf = resource.getrusage(resource.RUSAGE_SELF)
+        startChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        startIo = ReadProcIo()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            endSelf = resource.getrusage(resource.RUSAGE_SELF)
+            endChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+            endIo = ReadProcIo()
+            self.phases.append({
+                "name": name,
+                "status": status,
+                "wallSeconds": round(time.monotonic() - startWall, 3),
+                "cpuSeconds": round((endSelf.ru_utime + endSelf.ru_stime) - (startSelf.ru_utime + startSelf.ru_stime), 3),
+                "childCpuSeconds": round((endChildren.ru_utime + endChildren.ru_stime) - (startChildren.ru_utime + startChildren.ru_stime), 3),
+                "readBytes": endIo.get("read_bytes", 0) - startIo.get("read_bytes", 0),
+                "writtenBytes": endIo.get("write_bytes", 0) - startIo.get("write_bytes", 0),
+                # ru_inblock and ru_oublock count 512 byte blocks
+                "childReadBytes": (endChildren.ru_inblock - startChildren.ru_inblock) * 512,
+                "childWrittenBytes": (endChildren.ru_oublock - startChildren.ru_oublock) * 512,
+                # ru_maxrss is a high water mark in KiB, not a counter
+                "childPeakRssKib": endChildren.ru_maxrss,
+            })
+
+    @contextlib.contextmanager
+    def WallPhase(self, name):
+        startWall = time.monotonic()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.phases.append({
+                "name": name,
+                "status": status,
+                "wallSeconds": round(time.monotonic() - startWall, 3),
+            })
+
+    def GetReport(self):
+        return {
+            "version": 1,
+            "wallOnly": self.wallOnly,
+            "startTime": round(self.startTime),
+            "totalWallSeconds": round(time.monotonic() - self.startMonotonic, 3),
+            "host": {
+                "kernel": platform.release(),
+                "cpuCount": os.cpu_count(),
+                "cpuModel": next((line.split(":", 1)[1].strip() for line in ReadFile("/proc/cpuinfo", "").splitlines() if line.startswith("model name")), ""),
+                "memTotal": next((line.split(":", 1)[1].strip() for line in ReadFile("/proc/meminfo", "").splitlines() if line.startswith("MemTotal")), ""),
+            },
+            "phases": self.phases,
+        }
+
+    def WriteReport(self, reportPath):
+        WriteFile(reportPath, json.dumps(self.GetReport(), indent=4) + "\n")
+
+    def PrintSummary(self):
+        print(f"{"Phase":<24} {"Wall":>9} {"CPU":>9} {"Read":>10} {"Written":>10}")
+        for phase in self.phases:
+            if not "cpuSeconds" in phase:
+                print(f"{phase["name"]:<24} {phase["wallSeconds"]:>8.2f}s {"-":>9} {"-":>10} {"-":>10}{"" if phase["status"] == "ok" else " FAILED"}")
+                continue
+            cpuSeconds = phase["cpuSeconds"] + phase["childCpuSeconds"]
+            readBytes = phase["readBytes"] + phase["childReadBytes"]
+            writtenBytes = phase["writtenBytes"] + phase["childWrittenBytes"]
+            print(f"{phase["name"]:<24} {phase["wallSeconds"]:>8.2f}s {cpuSeconds:>8.2f}s {readBytes / 1048576:>8.1f}MB {writtenBytes / 1048576:>8.1f}MB{"" if phase["status"] == "ok" else " FAILED"}")
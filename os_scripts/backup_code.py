@@ -1,59 +1,14 @@
 #!/usr/bin/env python3
 import subprocess
+import select
+import struct
+import ctypes
 import os
 import sys
 import time
 
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True):
-    result = subprocess.run(command, capture_output=(not echo), input=input, check=check, shell=True, text=True)
-    if capture and not check:
-        return (result.stdout + result.stderr).strip(), result.returncode
-    elif capture:
-        return (result.stdout + result.stderr).strip()
-    elif not check:
-        return result.returncode
-    else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-def Install():
-    script_path = os.path.realpath(__file__)
-    script_name = os.path.splitext(os.path.basename(script_path))[0]
-    install_path = f"/usr/bin/{script_name}"
-    if script_path == install_path:
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) == os.path.getmtime(install_path):
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) < os.path.getmtime(install_path):
-        PrintWarning(f"Not installing because script in \"{install_path}\" is newer than \"{script_path}\".")
-        return
-    if os.geteuid() != 0 or os.getegid() != 0:
-        print(f"Root is required to install \"{script_path}\" to \"{install_path}\".")
-    sudo_commands = [
-        f"cp -p \"{script_path}\" \"{install_path}\"",
-        f"chmod 755 \"{install_path}\"",
-        f"chown +0:+0 \"{install_path}\"",
-    ]
-    RunCommand(f"sudo sh -c \'{"; ".join(sudo_commands)}\'")
-    print(f"Installed \"{script_path}\" to \"{install_path}\".")
-    print()
-Install()
-# endregion
+from eos_helpers import *
+Install(__file__)
 
 # Types of .backup files:
 # lastpush.backup: Stores the timestamp when the given repo was last pushed to the remote.
@@ -63,6 +18,229 @@ Install()
 # To audit .backup files:
 # find /important_data/ -type f -name "*.backup" -not -path "*/.git/lastpush.backup"
 
+CODE_EXTS = [
+    ".c", ".cpp", ".cc", ".asm", ".cs", ".java", # C family
+    ".py", ".ps1", ".sh", ".cmd", ".bat", # Scripting
+    ".js", ".ts", ".html", ".css", ".htm", # Web
+    ".rb", ".swift", ".go", ".php", ".r", ".rs", ".sql", ".kt", ".dart" # Other
+]
+ROOT_PATH = "/important_data"
+
+def IsUnder(path, parent_paths):
+    return any([ path.startswith(parent_path) for parent_path in parent_paths ])
+def BackupRepo(repo_path, ignore_repos_paths):
+    # Commits and pushes one repo. Returns False when it should be tried again later.
+    if IsUnder(repo_path, ignore_repos_paths):
+        return True
+    if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
+        PrintError(f"Repo missing required .gitignore. \"{repo_path}\"")
+        return True
+    os.chdir(repo_path)
+    remote_url, status_code  = RunCommand(f"git remote get-url origin", capture=True, check=False)
+    if status_code != 0 or not remote_url.startswith("git@github.com:RandomiaGaming/"):
+        PrintError(f"Repo has invalid or non-existant remote origin. \"{repo_path}\".")
+        return True
+    # Repos with no commits or no upstream yet have nothing to be out of sync with. Being only ahead of the
+    # upstream just means an earlier push failed, so those commits are pushed again.
+    local_head, local_status = RunCommand("git rev-parse @", capture=True, check=False)
+    upstream_head, upstream_status = RunCommand("git rev-parse @{u}", capture=True, check=False)
+    ahead = local_status == 0 and (upstream_status != 0 or local_head != upstream_head)
+    if local_status == 0 and upstream_status == 0 and local_head != upstream_head and RunCommand("git merge-base --is-ancestor @{u} @", check=False) != 0:
+        PrintError(f"Repo has become desync with remote origin. \"{repo_path}\".")
+        return True
+    changes = RunCommand(f"git status --porcelain", capture=True)
+    if changes != "" or ahead:
+        if changes != "":
+            print(f"Committing and pushing changes to \"{repo_path}\"...")
+            RunCommand(f"git rm --cached -r --quiet --ignore-unmatch .")
+            RunCommand(f"git add --all")
+            RunCommand(f"git commit -m\"Auto-generated backup commit.\"")
+        else:
+            print(f"Pushing earlier commits to \"{repo_path}\"...")
+        if RunCommand(f"git push --set-upstream origin --all", check=False) != 0:
+            PrintError(f"Failed to push \"{repo_path}\".")
+            return False
+    return True
+
+# Daemon mode keeps the results of one walk of /important_data up to date from inotify events instead of walking
+# it again. fanotify would need CAP_SYS_ADMIN and this script refuses root, so every directory gets an inotify
+# watch instead, except .git directories since nothing in them changes the work tree and the commits this script
+# makes would wake it up again. Repos are backed up once edits to them have been quiet for the debounce window,
+# or after MAX_WAIT_SECONDS of constant edits.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+MAX_WAIT_SECONDS = 120
+RETRY_SECONDS = 60
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+    def AddWatch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, dir_path.encode("UTF-8"), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28:
+                PrintError(f"Out of inotify watches at \"{dir_path}\". Raise fs.inotify.max_user_watches.")
+            return
+        self.paths[wd] = dir_path
+    def ReadEvents(self):
+        # Yields (mask, path) with path being the watched directory joined with the name the event is about
+        buffer = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_size = struct.unpack_from("iIII", buffer, offset)
+            name = buffer[offset + 16:offset + 16 + name_size].rstrip(b"\x00").decode("UTF-8", errors="surrogateescape")
+            offset += 16 + name_size
+            if mask & IN_Q_OVERFLOW:
+                yield mask, None
+                continue
+            dir_path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if dir_path != None:
+                yield mask, os.path.join(dir_path, name) if name != "" else dir_path
+
+class BackupState:
+    def __init__(self, inotify):
+        self.inotify = inotify
+        self.repo_paths = set()
+        self.code_paths = set()
+        self.ignore_repos_paths = set()
+        self.ignore_code_paths = set()
+        self.dirty_repos = {}
+    def AddTree(self, tree_path, warn):
+        # Watches tree_path and records what is in it. Used once at startup and for directories made or moved in later.
+        for dir_path, dir_names, file_names in os.walk(tree_path):
+            self.inotify.AddWatch(dir_path)
+            if ".git" in dir_names:
+                dir_names.remove(".git")
+                self.repo_paths.add(dir_path)
+            for file_name in file_names:
+                self.AddFile(os.path.join(dir_path, file_name), warn)
+    def RemoveTree(self, tree_path):
+        prefix = tree_path.rstrip("/") + "/"
+        for paths in [ self.repo_paths, self.code_paths, self.ignore_repos_paths, self.ignore_code_paths ]:
+            paths.difference_update([ path for path in paths if path == tree_path or path.startswith(prefix) ])
+        for wd, dir_path in list(self.inotify.paths.items()):
+            if dir_path == tree_path or dir_path.startswith(prefix):
+                self.inotify.paths.pop(wd)
+    def AddFile(self, file_path, warn):
+        file_name = os.path.basename(file_path)
+        if file_name == "ignorerepos.backup":
+            self.ignore_repos_paths.add(os.path.dirname(file_path))
+        elif file_name == "ignorecode.backup":
+            self.ignore_code_paths.add(os.path.dirname(file_path))
+        elif file_name.endswith(".backup"):
+            PrintWarning(f"Unknown backup file at \"{file_path}\".")
+        elif os.path.splitext(file_name)[1] in CODE_EXTS:
+            if warn and not file_path in self.code_paths and file_path in self.GetUnprotectedCode([ file_path ]):
+                PrintWarning(f"Unprotected code at \"{file_path}\".")
+            self.code_paths.add(file_path)
+    def RemoveFile(self, file_path):
+        file_name = os.path.basename(file_path)
+        if file_name == "ignorerepos.backup":
+            self.ignore_repos_paths.discard(os.path.dirname(file_path))
+        elif file_name == "ignorecode.backup":
+            self.ignore_code_paths.discard(os.path.dirname(file_path))
+        self.code_paths.discard(file_path)
+    def GetUnprotectedCode(self, code_paths):
+        return [ code_path for code_path in code_paths if not IsUnder(code_path, self.repo_paths) and not IsUnder(code_path, self.ignore_code_paths) ]
+    def GetRepo(self, path):
+        # The innermost repo holding path, or None
+        matches = [ repo_path for repo_path in self.repo_paths if path.startswith(repo_path + "/") ]
+        return max(matches, key=len) if len(matches) != 0 else None
+    def MarkDirty(self, repo_path, delay):
+        now = time.monotonic()
+        first_time = self.dirty_repos[repo_path][0] if repo_path in self.dirty_repos else now
+        self.dirty_repos[repo_path] = (first_time, min(first_time + MAX_WAIT_SECONDS, now + delay))
+    def HandleEvent(self, mask, path, debounce):
+        added = mask & (IN_CREATE | IN_MOVED_TO) != 0
+        removed = mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF) != 0
+        if os.path.basename(path) == ".git" and mask & IN_ISDIR:
+            # A repo was made or deleted. Its code changes from unprotected to protected or back.
+            repo_path = os.path.dirname(path)
+            if added:
+                self.repo_paths.add(repo_path)
+                self.MarkDirty(repo_path, debounce)
+            elif removed:
+                self.repo_paths.discard(repo_path)
+                self.dirty_repos.pop(repo_path, None)
+                for code_path in self.GetUnprotectedCode([ code_path for code_path in self.code_paths if code_path.startswith(repo_path + "/") ]):
+                    PrintWarning(f"Unprotected code at \"{code_path}\".")
+            return
+        if mask & IN_ISDIR:
+            if added:
+                self.AddTree(path, True)
+            elif removed:
+                self.RemoveTree(path)
+        elif added or mask & (IN_MODIFY | IN_CLOSE_WRITE):
+            self.AddFile(path, True)
+        elif removed:
+            self.RemoveFile(path)
+        repo_path = self.GetRepo(path)
+        if repo_path != None and not IsUnder(repo_path, self.ignore_repos_paths):
+            self.MarkDirty(repo_path, debounce)
+
+def RunDaemon(debounce):
+    print(f"Watching {ROOT_PATH}/ for changes...")
+    inotify = Inotify()
+    state = BackupState(inotify)
+    state.AddTree(ROOT_PATH, False)
+    for code_path in sorted(state.GetUnprotectedCode(state.code_paths)):
+        PrintWarning(f"Unprotected code at \"{code_path}\".")
+    # Anything changed while the daemon wasn't running gets backed up straight away
+    for repo_path in state.repo_paths:
+        state.MarkDirty(repo_path, 0)
+    print(f"Watching {len(inotify.paths)} directories and {len(state.repo_paths)} repos.")
+    while True:
+        now = time.monotonic()
+        for repo_path, (_, due_time) in sorted(state.dirty_repos.items(), key=lambda item: item[1][1]):
+            if due_time > now:
+                continue
+            del state.dirty_repos[repo_path]
+            if not os.path.isdir(repo_path):
+                continue
+            # One broken repo must never take the daemon down with it
+            try:
+                backed_up = BackupRepo(repo_path, state.ignore_repos_paths)
+            except Exception as exception:
+                PrintError(f"Failed to back up \"{repo_path}\". {exception}")
+                backed_up = False
+            if not backed_up:
+                state.MarkDirty(repo_path, RETRY_SECONDS)
+        timeout = None
+        if len(state.dirty_repos) != 0:
+            timeout = max(0, min([ due_time for _, due_time in state.dirty_repos.values() ]) - time.monotonic())
+        readable, _, _ = select.select([ inotify.fd ], [], [], timeout)
+        if len(readable) == 0:
+            continue
+        for mask, path in inotify.ReadEvents():
+            if path == None:
+                # The kernel dropped events so the in memory view can't be trusted anymore
+                PrintWarning("inotify queue overflowed. Rescanning.")
+                state.RemoveTree(ROOT_PATH)
+                state.AddTree(ROOT_PATH, False)
+                for repo_path in state.repo_paths:
+                    state.MarkDirty(repo_path, debounce)
+                continue
+            state.HandleEvent(mask, path, debounce)
+
 def Main():
     # Initial scanity checks
     if os.geteuid() == 0 or os.getegid() == 0:
@@ -82,15 +260,28 @@ def Main():
         PrintError("Git is not configured with auto setup remote. Please run: git config --global push.autoSetupRemote true")
         return 1
 
+    # daemon [debounce seconds] keeps running and backs up repos shortly after they change
+    args = sys.argv[1:]
+    script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
+    usage = f"Usage: {script_name} [daemon [debounce seconds]]"
+    if len(args) >= 1 and args[0] == "daemon":
+        debounce = 10.0
+        if len(args) >= 2:
+            try:
+                debounce = float(args[1])
+            except ValueError:
+                debounce = -1.0
+        if len(args) > 2 or not 0 <= debounce < float("inf"):
+            PrintError(usage)
+            return 1
+        return RunDaemon(debounce)
+    elif len(args) != 0:
+        PrintError(usage)
+        return 1
+
     # Enumerating files and folders
     print("Enumerating files in /important_data/...")
-    code_exts = [
-        ".c", ".cpp", ".cc", ".asm", ".cs", ".java", # C family
-        ".py", ".ps1", ".sh", ".cmd", ".bat", # Scripting
-        ".js", ".ts", ".html", ".css", ".htm", # Web
-        ".rb", ".swift", ".go", ".php", ".r", ".rs", ".sql", ".kt", ".dart" # Other
-    ]
-    code_paths = RunCommand(f"find \"/important_data/\" -type f" + " -o".join([ f" -name \"*{code_ext}\"" for code_ext in code_exts ]), capture=True).splitlines()
+    code_paths = RunCommand(f"find \"/important_data/\" -type f" + " -o".join([ f" -name \"*{code_ext}\"" for code_ext in CODE_EXTS ]), capture=True).splitlines()
     repo_paths = [ os.path.dirname(repo_path) for repo_path in RunCommand(f"find \"/important_data/\" -type d -name \".git\"", capture=True).splitlines() ]
     backup_file_paths = RunCommand(f"find \"/important_data/\" -type f -name \"*.backup\"", capture=True).splitlines()
     ignore_repos_paths = []
@@ -106,36 +297,18 @@ def Main():
 
     # Checking for unprotected code
     for code_path in code_paths:
-        if any([ code_path.startswith(repo_path) for repo_path in repo_paths ]):
+        if IsUnder(code_path, repo_paths):
             continue
-        if any([ code_path.startswith(ignore_code_path) for ignore_code_path in ignore_code_paths ]):
+        if IsUnder(code_path, ignore_code_paths):
             continue
         PrintWarning(f"Unprotected code at \"{code_path}\".")
 
     # Committing and pushing git repos
     print("Committing and pushing all repos...")
     for repo_path in repo_paths:
-        if any([ repo_path.startswith(ignore_repos_path) for ignore_repos_path in ignore_repos_paths ]):
-            continue
-        if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
-            PrintError(f"Repo missing required .gitignore. \"{repo_path}\"")
-            continue
-        os.chdir(repo_path)
-        remote_url, status_code  = RunCommand(f"git remote get-url origin", capture=True, check=False)
-        if status_code != 0 or not remote_url.startswith("git@github.com:RandomiaGaming/"):
-            PrintError(f"Repo has invalid or non-existant remote origin. \"{repo_path}\".")
-            continue
-        if RunCommand("git rev-parse @", capture=True) != RunCommand("git rev-parse @{u}", capture=True):
-            PrintError(f"Repo has become desync with remote origin. \"{repo_path}\".")
-            continue
-        changes = RunCommand(f"git status --porcelain", capture=True)
-        if changes != "":
-            print(f"Committing and pushing changes to \"{repo_path}\"...")
-            RunCommand(f"git rm --cached -r .")
-            RunCommand(f"git add --all")
-            RunCommand(f"git commit -m\"Auto-generated backup commit.\"")
-            RunCommand(f"git push origin --all")
+        BackupRepo(repo_path, ignore_repos_paths)
 
     print("Backup Complete!")
     return 0
-sys.exit(Main())
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -1,83 +1,322 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import contextlib
 import subprocess
+import hashlib
+import json
+import fcntl
+import time
 import os
 import re
 import sys
 
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True):
-    result = subprocess.run(command, capture_output=(not echo), input=input, check=check, shell=True, text=True)
-    if capture and not check:
-        return (result.stdout + result.stderr).strip(), result.returncode
-    elif capture:
-        return (result.stdout + result.stderr).strip()
-    elif not check:
-        return result.returncode
-    else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-def Install():
-    script_path = os.path.realpath(__file__)
-    script_name = os.path.splitext(os.path.basename(script_path))[0]
-    install_path = f"/usr/bin/{script_name}"
-    if script_path == install_path:
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) == os.path.getmtime(install_path):
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) < os.path.getmtime(install_path):
-        PrintWarning(f"Not installing because script in \"{install_path}\" is newer than \"{script_path}\".")
+from eos_helpers import *
+Install(__file__)
+
+def GetResumeArgs(root_mapper_path):
+    # Returns the cmdline args to resume from the swapfile the installer made, or "" when there is no swapfile on
+    # the root filesystem big enough to hold a hibernation image. zram can't be resumed from since it is in RAM.
+    mem_total = 0
+    for line in ReadFile("/proc/meminfo").splitlines():
+        if line.startswith("MemTotal:"):
+            mem_total = int(line.split()[1]) * 1024
+    for line in ReadFile("/etc/fstab", "").splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0].startswith("#") or fields[2] != "swap" or not fields[0].startswith("/"):
+            continue
+        swap_path = fields[0]
+        if not os.path.isfile(swap_path) or os.path.getsize(swap_path) < mem_total:
+            continue
+        if RunCommand(f"findmnt --noheadings --raw --output source --target \"{swap_path}\"", capture=True) != root_mapper_path:
+            continue
+        # resume_offset is the swapfile's first physical block which filefrag -v prints as
+        # "   0:        0..       0:      34816..     34816:      1:"
+        for extent_line in RunCommand(f"filefrag -v \"{swap_path}\"", capture=True).splitlines():
+            tokens = extent_line.split()
+            if len(tokens) >= 4 and tokens[0] == "0:":
+                return f"resume={root_mapper_path} resume_offset={tokens[3].rstrip(".")}"
+    return ""
+
+# Modules from the strict allow-list replace the generic sets the block and keyboard hooks add. autodetect stays
+# since the filesystems hook relies on it to add only the root filesystem.
+MODULES_ALLOW_LIST_PATH = "/etc/boot_builder.modules"
+BASE_MODULES = [ "fat", "vfat", "nls_iso8859_1" ]
+
+def ReadCpio(cpio_path):
+    # Yields (path, mode, size) for every entry in a newc cpio file. The microcode hook prepends an uncompressed
+    # early cpio so archives are read back to back until the file runs out.
+    with open(cpio_path, "rb") as file:
+        while True:
+            header = file.read(110)
+            while header.startswith(b"\x00"):
+                header = header.lstrip(b"\x00") + file.read(110 - len(header.lstrip(b"\x00")))
+            if len(header) < 110:
+                return
+            if header[:6] != b"070701":
+                raise Exception(f"\"{cpio_path}\" is not an uncompressed newc cpio archive.")
+            mode = int(header[14:22], 16)
+            size = int(header[54:62], 16)
+            name_size = int(header[94:102], 16)
+            name = file.read(name_size)[:-1].decode("UTF-8", errors="replace")
+            file.seek((4 - (110 + name_size) % 4) % 4, 1)
+            file.seek(size + (4 - size % 4) % 4, 1)
+            if name == "TRAILER!!!":
+                continue
+            yield "/" + name.removeprefix("./").lstrip("/"), mode, size
+def ReadHookFiles(mkinitcpio_output):
+    # mkinitcpio -v prints "-> Running build hook: [name]" before each hook and "adding file: path" for every
+    # file a hook adds, which is the only record of which hook a file came from
+    hook_files = {}
+    hook_name = "mkinitcpio"
+    for line in mkinitcpio_output.splitlines():
+        hook_match = re.search(r"Running build hook: \[(.+?)\]", line)
+        if hook_match != None:
+            hook_name = hook_match.group(1)
+            continue
+        if line.lstrip().startswith("==>"):
+            hook_name = "mkinitcpio"
+            continue
+        file_match = re.search(r"adding (\w+): (\S+)", line)
+        if file_match != None and not file_match.group(2) in hook_files:
+            hook_files[file_match.group(2)] = hook_name
+    return hook_files
+def FormatSize(size):
+    return f"{size / (1024 * 1024):.2f} MiB" if size >= 1024 * 1024 else f"{size / 1024:.1f} KiB"
+def PrintInitramfsProfile(cpio_path, hook_files, verbose, kernel_name):
+    total_size = 0
+    file_count = 0
+    hooks = {}
+    modules = {}
+    firmware = {}
+    for path, mode, size in ReadCpio(cpio_path):
+        if mode & 0o170000 != 0o100000:
+            continue
+        total_size += size
+        file_count += 1
+        hook_name = hook_files.get(path, "mkinitcpio")
+        hook_size, hook_count = hooks.get(hook_name, (0, 0))
+        hooks[hook_name] = (hook_size + size, hook_count + 1)
+        if path.startswith("/usr/lib/modules/") and ".ko" in path:
+            modules[os.path.basename(path).split(".ko")[0]] = size
+        elif path.startswith("/usr/lib/firmware/"):
+            firmware[path.removeprefix("/usr/lib/firmware/")] = size
+    print(f"{kernel_name} initramfs holds {file_count} files in {FormatSize(total_size)} ({len(modules)} modules {FormatSize(sum(modules.values()))}, {len(firmware)} firmware {FormatSize(sum(firmware.values()))}).")
+    if not verbose:
         return
-    if os.geteuid() != 0 or os.getegid() != 0:
-        print(f"Root is required to install \"{script_path}\" to \"{install_path}\".")
-    sudo_commands = [
-        f"cp -p \"{script_path}\" \"{install_path}\"",
-        f"chmod 755 \"{install_path}\"",
-        f"chown +0:+0 \"{install_path}\"",
-    ]
-    RunCommand(f"sudo sh -c \'{"; ".join(sudo_commands)}\'")
-    print(f"Installed \"{script_path}\" to \"{install_path}\".")
     print()
-Install()
-# endregion
+    print(f"{kernel_name} by hook:")
+    for hook_name, (hook_size, hook_count) in sorted(hooks.items(), key=lambda item: -item[1][0]):
+        print(f"    {hook_name:<24} {FormatSize(hook_size):>12} {hook_count:>6} files")
+    for title, sizes in [ ("Modules", modules), ("Firmware", firmware) ]:
+        if len(sizes) == 0:
+            continue
+        print()
+        print(f"{kernel_name} {title.lower()}:")
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            print(f"    {name:<48} {FormatSize(size):>12}")
+
+def GetLoadedModules():
+    return [ line.split()[0] for line in ReadFile("/proc/modules", "").splitlines() if line.strip() != "" ]
+def GetDeviceModules(sys_path):
+    # Modules driving a device and everything it hangs off of, from bound drivers and modaliases
+    module_names = []
+    sys_path = os.path.realpath(sys_path)
+    while sys_path.startswith("/sys/devices/"):
+        module_link_path = os.path.join(sys_path, "driver", "module")
+        if os.path.exists(module_link_path):
+            module_names.append(os.path.basename(os.path.realpath(module_link_path)))
+        modalias = ReadFile(os.path.join(sys_path, "modalias"), "").strip()
+        if modalias != "":
+            output, status_code = RunCommand(f"modprobe --resolve-alias \"{modalias}\"", capture=True, check=False)
+            if status_code == 0:
+                module_names += output.split()
+        sys_path = os.path.dirname(sys_path)
+    return module_names
+def GetCipherModules(cipher):
+    # /proc/crypto lists the module behind every algorithm the kernel has set up, like aes_generic or aesni_intel
+    cipher_parts = [ part for part in re.split(r"[-,()]", cipher) if part != "" ]
+    module_names = []
+    name = ""
+    for line in ReadFile("/proc/crypto", "").splitlines():
+        key, _, value = [ part.strip() for part in line.partition(":") ]
+        if key == "name":
+            name = value
+        elif key == "module" and value != "kernel" and any([ part in cipher_parts for part in re.split(r"[-,()]", name) ]):
+            module_names.append(value)
+    return module_names
+def MakeModulesAllowList(root_dev, crypt_info):
+    # Only modules that are loaded right now and sit between the root filesystem and the disk it lives on, or
+    # drive a keyboard to type the passphrase with. Modules that are built into the kernel don't need listing.
+    module_names = [ "dm_mod", "dm_crypt" ]
+    module_names += RunCommand("findmnt --noheadings --raw --output fstype --target /", capture=True).split()
+    for line in crypt_info.splitlines():
+        if line.strip().startswith("cipher:"):
+            module_names += GetCipherModules(line.split(":", 1)[1].strip())
+    for disk_name in GetBackingDisks(root_dev):
+        module_names += GetDeviceModules(f"/sys/block/{disk_name}/device")
+    # /proc/bus/input/devices has one block per device with H: Handlers=... kbd ... for keyboards
+    for block in ReadFile("/proc/bus/input/devices", "").split("\n\n"):
+        lines = block.splitlines()
+        if not any([ line.startswith("H:") and "kbd" in line.split() for line in lines ]):
+            continue
+        for line in lines:
+            if line.startswith("S: Sysfs="):
+                module_names += GetDeviceModules("/sys" + line.removeprefix("S: Sysfs="))
+    loaded_module_names = GetLoadedModules()
+    allow_list = []
+    for module_name in module_names:
+        module_name = module_name.replace("-", "_")
+        if module_name in loaded_module_names and not module_name in allow_list:
+            allow_list.append(module_name)
+    return allow_list
+
+# The pacman hook only queues a build so kernel upgrades don't wait on it. The queue is a single pending file so
+# any number of requests made before the worker gets to them cost one build. The worker holds a block inhibitor
+# while it runs, and stopping its service waits for the build lock, so shutdown can't cut a build short.
+PENDING_PATH = "/var/lib/boot_builder/pending"
+LOCK_PATH = "/run/boot_builder.lock"
+
+@contextlib.contextmanager
+def BuildLock():
+    with open(LOCK_PATH, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+def QueueBuild(script_name):
+    # Returns False when nothing would run the worker, like inside the installer's chroot
+    WriteFile(PENDING_PATH, f"{time.time()}\n")
+    if not os.path.isdir("/run/systemd/system") or not os.path.exists(f"/etc/systemd/system/{script_name}.service"):
+        return False
+    RunCommand(f"systemctl start --no-block \"{script_name}.service\"")
+    print(f"Queued a boot image rebuild. Follow it with journalctl -u {script_name}.")
+    return True
+def RunWorker(script_name, install_path):
+    status_code = 0
+    with BuildLock():
+        while os.path.exists(PENDING_PATH):
+            os.remove(PENDING_PATH)
+            status_code = Build(script_name, install_path, "build")
+    return status_code
+
+# Every installed kernel gets its own UKI. The default kernel, linux when it is installed, boots from the fallback
+# path firmware finds on its own and the rest go in EFI/EOS. A kernel is only rebuilt when something it was built
+# from changed: the stamp records the files its last initramfs held and a digest of their sizes and mtimes.
+STAMP_DIR_PATH = "/var/lib/boot_builder"
+
+def GetKernels():
+    kernels = []
+    for version in sorted(os.listdir("/usr/lib/modules")):
+        kernel_path = os.path.join("/usr/lib/modules", version, "vmlinuz")
+        if not os.path.isfile(kernel_path):
+            continue
+        name = ReadFile(os.path.join("/usr/lib/modules", version, "pkgbase"), version).strip()
+        kernels.append({ "name": name, "version": version, "path": kernel_path })
+    kernels.sort(key=lambda kernel: (kernel["name"] != "linux", kernel["name"]))
+    for index, kernel in enumerate(kernels):
+        if index == 0:
+            kernel["esp_path"] = "/boot/EFI/BOOT/BOOTX64.EFI"
+            kernel["label"] = "EOS"
+        else:
+            kernel["esp_path"] = f"/boot/EFI/EOS/{kernel["name"]}.efi"
+            kernel["label"] = f"EOS ({kernel["name"]})"
+    return kernels
+def GetInputsDigest(kernel, input_paths, settings):
+    sha256 = hashlib.sha256(settings.encode("UTF-8"))
+    sha256.update(ReadFile(os.path.realpath(__file__), binary=True))
+    for path in sorted(set([ kernel["path"] ] + input_paths)):
+        try:
+            stat = os.stat(path)
+            sha256.update(f"{path}\x00{stat.st_size}\x00{stat.st_mtime_ns}\n".encode("UTF-8"))
+        except OSError:
+            sha256.update(f"{path}\x00missing\n".encode("UTF-8"))
+    return sha256.hexdigest()
+def GetFileDigest(file_path):
+    with open(file_path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+def BuildKernelImage(kernel, temp_dir_path, mkinitcpio_conf, cmdline, mode):
+    # Builds kernel["build_path"] and returns True, or returns False when the UKI on the ESP is already current
+    stamp_path = os.path.join(STAMP_DIR_PATH, f"{kernel["name"]}.json")
+    kernel_dir_path = os.path.join(temp_dir_path, kernel["name"])
+    os.makedirs(kernel_dir_path, mode=0o700)
+    cpio_path = os.path.join(kernel_dir_path, "initramfs.cpio")
+    cpio_zstd_path = cpio_path + ".zst"
+    ukify_conf = [
+        f"[UKI]",
+        f"Linux={kernel["path"]}",
+        f"Initrd={cpio_zstd_path}",
+        f"OSRelease=EOS",
+        f"Uname={kernel["version"]}",
+        f"Cmdline={cmdline}",
+    ]
+    settings = "".join([ line + "\n" for line in mkinitcpio_conf + ukify_conf ])
+    stamp = json.loads(ReadFile(stamp_path, "{}"))
+    if mode == "build" and stamp.get("digest") == GetInputsDigest(kernel, stamp.get("inputs", []), settings) and os.path.exists(kernel["esp_path"]) and stamp.get("efi_digest") == GetFileDigest(kernel["esp_path"]):
+        print(f"{kernel["name"]} is up to date.")
+        return False
+
+    # Generate initramfs
+    print(f"Making {kernel["name"]} initramfs...")
+    mkinitcpio_conf_path = os.path.join(kernel_dir_path, "mkinitcpio.conf")
+    WriteFile(mkinitcpio_conf_path, "".join([ line + "\n" for line in mkinitcpio_conf ]))
+    mkinitcpio_output = RunCommand(f"mkinitcpio -v -c \"{mkinitcpio_conf_path}\" -g \"{cpio_path}\" -k \"{kernel["path"]}\"", capture=True)
+    hook_files = ReadHookFiles(mkinitcpio_output)
+    PrintInitramfsProfile(cpio_path, hook_files, mode == "profile", kernel["name"])
+    if mode == "profile":
+        return False
+
+    # Compress initramfs
+    print(f"Compressing {kernel["name"]} initramfs...")
+    RunCommand(f"zstd --rm \"{cpio_path}\" -o \"{cpio_zstd_path}\"")
+
+    # Generate unified kernel image
+    print(f"Making {kernel["name"]} unified kernel image...")
+    ukify_conf_path = os.path.join(kernel_dir_path, "ukify.conf")
+    WriteFile(ukify_conf_path, "".join([ line + "\n" for line in ukify_conf ]))
+    kernel["build_path"] = os.path.join(kernel_dir_path, "eos.efi")
+    RunCommand(f"ukify -c \"{ukify_conf_path}\" build -o \"{kernel["build_path"]}\"")
+    RunCommand(f"rm \"{cpio_zstd_path}\"")
+    kernel["stamp"] = {
+        "digest": GetInputsDigest(kernel, list(hook_files.keys()), settings),
+        "inputs": sorted(hook_files.keys()),
+        "efi_digest": GetFileDigest(kernel["build_path"]),
+    }
+    return True
 
 def Main():
     script_path = os.path.realpath(__file__)
     script_name = os.path.splitext(os.path.basename(script_path))[0]
     install_path = f"/usr/bin/{script_name}"
 
-    # Initial setup and scanity checks
+    # No arguments builds and installs. profile only builds the initramfs and reports what is in it. queue is
+    # what the pacman hook runs and worker is what the service it starts runs.
+    args = sys.argv[1:]
+    if len(args) > 1 or (len(args) == 1 and not args[0] in [ "profile", "strict", "generic", "queue", "worker" ]):
+        PrintError(f"Usage: {script_name} [profile | strict | generic | queue]")
+        return 1
+    mode = args[0] if len(args) == 1 else "build"
     if os.geteuid() != 0 or os.getegid() != 0:
         PrintError(f"Root is required to run {script_name}. Try sudo {script_name}.")
         return 1
+    if mode == "queue":
+        if QueueBuild(script_name):
+            return 0
+        mode = "build"
+    if mode == "worker":
+        return RunWorker(script_name, install_path)
+    with BuildLock():
+        return Build(script_name, install_path, mode)
+
+def Build(script_name, install_path, mode):
+    # Initial setup and scanity checks
     if RunCommand("findmnt --noheadings --raw --output source --target /boot", check=False) != 0:
         PrintError("Nothing is mounted on /boot. Did you forget something?")
         return 1
     if RunCommand("findmnt --noheadings --raw --output source --target /sys/firmware/efi/efivars/", check=False) != 0:
         PrintError("Nothing is mounted on /sys/firmware/efi/efivars/. Maybe you forgot to mount efivarsfs inside a chroot?")
         return 1
-    kernel_paths = RunCommand("find /usr/lib/modules -maxdepth 2 -mindepth 2 -type f -name vmlinuz", capture=True).splitlines()
-    if len(kernel_paths) == 0:
+    kernels = GetKernels()
+    if len(kernels) == 0:
         PrintError("Unable to locate system kernel.")
         return 1
-    if len(kernel_paths) > 1:
-        PrintError("Multiple system kernels installed.")
-        return 1
-    kernel_path = kernel_paths[0]
     root_dev = RunCommand("findmnt --noheadings --raw --output source --target /", capture=True)
     crypt_info, crypt_status_code = RunCommand(f"cryptsetup status \"{root_dev}\"", capture=True, check=False)
     if crypt_status_code != 0:
@@ -109,19 +348,44 @@ def Main():
         f"[Trigger]",
         f"Operation = Install",
         f"Operation = Upgrade",
-        f"Type = Package",
-        f"Target = linux",
+        f"Operation = Remove",
+        f"Type = Path",
+        f"Target = usr/lib/modules/*/vmlinuz",
+        f"Target = usr/lib/initcpio/*",
+        f"Target = usr/lib/firmware/*",
         f"",
         f"[Action]",
         f"Description = Running {script_name}...",
         f"When = PostTransaction",
-        f"Exec = {install_path}",
+        f"Exec = {install_path} queue",
     ]
     hook_path = os.path.join(hooks_dir_path, "boot_builder.hook")
     WriteFile(hook_path, "".join([ line + "\n" for line in hook_payload ]))
     RunCommand(f"chmod 644 \"{hook_path}\"")
     RunCommand(f"chown +0:+0 \"{hook_path}\"")
 
+    # Install the service that builds queued requests
+    service_payload = [
+        f"# This file is auto-generated by {script_name}.",
+        f"# Do not modify. All changes will be lost.",
+        f"",
+        f"[Unit]",
+        f"Description=Rebuilds the boot image after kernel upgrades.",
+        f"After=local-fs.target",
+        f"",
+        f"[Service]",
+        f"Type=simple",
+        f"ExecStart=/usr/bin/systemd-inhibit --what=shutdown:sleep --mode=block --who={script_name} \"--why=Rebuilding the boot image\" \"{install_path}\" worker",
+        f"ExecStop=/usr/bin/flock \"{LOCK_PATH}\" true",
+        f"TimeoutStopSec=infinity",
+    ]
+    service_path = f"/etc/systemd/system/{script_name}.service"
+    if ReadFile(service_path, "") != "".join([ line + "\n" for line in service_payload ]):
+        WriteFile(service_path, "".join([ line + "\n" for line in service_payload ]))
+        RunCommand(f"chmod 644 \"{service_path}\"")
+        RunCommand(f"chown +0:+0 \"{service_path}\"")
+        RunCommand("systemctl daemon-reload", check=False)
+
     # Create boot builder temp folder
     temp_dir_path = "/tmp/boot_builder"
     RunCommand(f"rm -rf \"{temp_dir_path}\"")
@@ -129,60 +393,97 @@ def Main():
     RunCommand(f"chmod 700 \"{temp_dir_path}\"")
     RunCommand(f"chown +0:+0 \"{temp_dir_path}\"")
 
-    # Generate initramfs
-    print("Making initramfs...")
-    mkinitcpio_conf_path = os.path.join(temp_dir_path, "mkinitcpio.conf")
+    # Hibernation needs the resume hook after encrypt so the swapfile is readable before the image is loaded
+    resume_args = GetResumeArgs(root_dev)
+    if resume_args == "":
+        PrintWarning("No swapfile large enough to hibernate to was found. Hibernation will be unavailable.")
+
+    # strict pins the initramfs to the modules this machine uses to unlock and mount root, generic goes back to
+    # what autodetect picks. Firmware follows the modules since mkinitcpio adds whatever each module declares.
+    if mode == "strict":
+        allow_list = MakeModulesAllowList(root_dev, crypt_info)
+        allow_list_payload = [
+            f"# This file is auto-generated by {script_name} strict.",
+            f"# Only these modules and their dependencies go in the initramfs. Run {script_name} generic to remove it.",
+        ] + allow_list
+        WriteFile(MODULES_ALLOW_LIST_PATH, "".join([ line + "\n" for line in allow_list_payload ]))
+        RunCommand(f"chmod 644 \"{MODULES_ALLOW_LIST_PATH}\"")
+        RunCommand(f"chown +0:+0 \"{MODULES_ALLOW_LIST_PATH}\"")
+        print(f"Wrote {len(allow_list)} modules to \"{MODULES_ALLOW_LIST_PATH}\": {" ".join(allow_list)}")
+    elif mode == "generic" and os.path.exists(MODULES_ALLOW_LIST_PATH):
+        os.remove(MODULES_ALLOW_LIST_PATH)
+        print(f"Removed \"{MODULES_ALLOW_LIST_PATH}\".")
+    allow_list = [ line.strip() for line in ReadFile(MODULES_ALLOW_LIST_PATH, "").splitlines() if line.strip() != "" and not line.strip().startswith("#") ]
+
+    # Settings shared by every kernel
+    if len(allow_list) != 0:
+        modules = BASE_MODULES + [ module_name for module_name in allow_list if not module_name in BASE_MODULES ]
+        hooks = [ "autodetect", "base", "udev", "microcode", "keymap", "numlock", "encrypt" ]
+    else:
+        modules = BASE_MODULES
+        hooks = [ "autodetect", "base", "udev", "microcode", "keyboard", "keymap", "numlock", "block", "encrypt" ]
+    if resume_args != "":
+        hooks.append("resume")
+    hooks.append("filesystems")
     mkinitcpio_conf = [
-        f"MODULES=(fat vfat nls_iso8859_1)",
+        f"MODULES=({" ".join(modules)})",
         f"BINARIES=()",
         f"FILES=()",
-        f"HOOKS=(autodetect base udev microcode keyboard keymap numlock block encrypt filesystems)",
+        f"HOOKS=({" ".join(hooks)})",
         f"COMPRESSION=\"cat\"",
         f"COMPRESSION_OPTIONS=()",
     ]
-    WriteFile(mkinitcpio_conf_path, "".join([ line + "\n" for line in mkinitcpio_conf ]))
-    cpio_path = os.path.join(temp_dir_path, "initramfs.cpio")
-    RunCommand(f"mkinitcpio -c \"{mkinitcpio_conf_path}\" -g \"{cpio_path}\" -k \"{kernel_path}\"")
-
-    # Compress initramfs
-    print("Compressing initramfs...")
-    cpio_zstd_path = cpio_path + ".zst"
-    RunCommand(f"zstd --rm \"{cpio_path}\" -o \"{cpio_zstd_path}\"")
-
-    # Generate unified kernel image
-    print("Making unified kernel image...")
     crypt_root_uuid = RunCommand(f"blkid -o value -s UUID \"{crypt_root_dev}\"", capture=True)
-    cmdline = f"cryptdevice=UUID={crypt_root_uuid}:crypt_root root=/dev/mapper/crypt_root rw"
-    kernel_info = RunCommand(f"file \"{kernel_path}\"", capture=True)
-    uname = kernel_info[kernel_info.find("version ") + len("version "):]
-    uname = uname[:uname.find(" ")]
-    ukify_conf_path = os.path.join(temp_dir_path, "ukify.conf")
-    ukify_conf = [
-        f"[UKI]",
-        f"Linux={kernel_path}",
-        f"Initrd={cpio_zstd_path}",
-        f"OSRelease=EOS",
-        f"Uname={uname}",
-        f"Cmdline={cmdline}",
-    ]
-    WriteFile(ukify_conf_path, "".join([ line + "\n" for line in ukify_conf ]))
-    efi_path = os.path.join(temp_dir_path, "eos.efi")
-    RunCommand(f"ukify -c \"{ukify_conf_path}\" build -o \"{efi_path}\"")
-    RunCommand(f"rm \"{cpio_zstd_path}\"")
+    # allow-discards matches the flags the installer persists in the LUKS2 header, so trim keeps working on
+    # headers made without them
+    cryptdevice_options = ":allow-discards" if GetDiscardMode(crypt_root_dev) != "none" else ""
+    cmdline = f"cryptdevice=UUID={crypt_root_uuid}:crypt_root{cryptdevice_options} root=/dev/mapper/crypt_root rw"
+    if resume_args != "":
+        cmdline += f" {resume_args}"
 
-    # Install uki to boot partition
-    RunCommand("rm -rf /boot/*")
-    RunCommand("chmod 700 /boot")
-    RunCommand("chown +0:+0 /boot")
-    RunCommand("mkdir /boot/EFI")
-    RunCommand("chmod 700 /boot/EFI")
-    RunCommand("chown +0:+0 /boot/EFI")
-    RunCommand("mkdir /boot/EFI/BOOT")
-    RunCommand("chmod 700 /boot/EFI/BOOT")
-    RunCommand("chown +0:+0 /boot/EFI/BOOT")
-    RunCommand(f"cp \"{efi_path}\" /boot/EFI/BOOT/BOOTX64.EFI")
-    RunCommand("chmod 700 /boot/EFI/BOOT/BOOTX64.EFI")
-    RunCommand("chown +0:+0 /boot/EFI/BOOT/BOOTX64.EFI")
+    # Build every kernel at once. mkinitcpio, zstd and ukify are mostly single threaded so kernels build in
+    # about the time of one. profile runs one at a time so the reports don't interleave.
+    worker_count = 1 if mode == "profile" else max(1, min(len(kernels), os.cpu_count() or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = [ executor.submit(BuildKernelImage, kernel, temp_dir_path, mkinitcpio_conf, cmdline, mode) for kernel in kernels ]
+    for kernel, future in zip(kernels, futures):
+        if future.exception() != None:
+            PrintError(f"Failed to build {kernel["name"]}. {future.exception()}")
+            RunCommand(f"rm -rf \"{temp_dir_path}\"")
+            return 1
+    if mode == "profile":
+        RunCommand(f"rm -rf \"{temp_dir_path}\"")
+        return 0
+
+    # Install ukis to boot partition. Each is copied next to its final name and renamed over it so a failed copy
+    # never leaves a half written image. Anything else on the ESP is removed.
+    for dir_path in [ "/boot", "/boot/EFI", "/boot/EFI/BOOT", "/boot/EFI/EOS" ]:
+        if not os.path.isdir(dir_path):
+            RunCommand(f"mkdir \"{dir_path}\"")
+        RunCommand(f"chmod 700 \"{dir_path}\"")
+        RunCommand(f"chown +0:+0 \"{dir_path}\"")
+    os.makedirs(STAMP_DIR_PATH, mode=0o700, exist_ok=True)
+    for kernel in kernels:
+        if not "build_path" in kernel:
+            continue
+        RunCommand(f"cp \"{kernel["build_path"]}\" \"{kernel["esp_path"]}.new\"")
+        RunCommand(f"chmod 700 \"{kernel["esp_path"]}.new\"")
+        RunCommand(f"chown +0:+0 \"{kernel["esp_path"]}.new\"")
+        RunCommand("sync")
+        os.replace(f"{kernel["esp_path"]}.new", kernel["esp_path"])
+        WriteFile(os.path.join(STAMP_DIR_PATH, f"{kernel["name"]}.json"), json.dumps(kernel["stamp"]) + "\n")
+    for stamp_name in os.listdir(STAMP_DIR_PATH):
+        if stamp_name.endswith(".json") and not stamp_name.removesuffix(".json") in [ kernel["name"] for kernel in kernels ]:
+            os.remove(os.path.join(STAMP_DIR_PATH, stamp_name))
+    esp_paths = [ kernel["esp_path"] for kernel in kernels ]
+    for root, dir_names, file_names in os.walk("/boot", topdown=False):
+        for file_name in file_names:
+            if not os.path.join(root, file_name) in esp_paths:
+                os.remove(os.path.join(root, file_name))
+        for dir_name in dir_names:
+            dir_path = os.path.join(root, dir_name)
+            if not dir_path in [ "/boot/EFI", "/boot/EFI/BOOT", "/boot/EFI/EOS" ] and len(os.listdir(dir_path)) == 0:
+                os.rmdir(dir_path)
 
     # Setup efi boot entries as needed
     for line in RunCommand("efibootmgr", capture=True).splitlines():
@@ -199,7 +500,11 @@ def Main():
     boot_dev = RunCommand("findmnt --noheadings --raw --output source --target /boot", capture=True)
     boot_disk = os.path.join("/dev", RunCommand(f"lsblk --noheadings --raw --output PKNAME \"{boot_dev}\"", capture=True))
     boot_part = RunCommand(f"lsblk --noheadings --raw --output PARTN \"{boot_dev}\"", capture=True)
-    RunCommand(f"efibootmgr --create-only --disk \"{boot_disk}\" --part \"{boot_part}\" --loader \"\\EFI\\BOOT\\BOOTX64.EFI\" --label \"EOS\"")
+    # Entries are numbered in the order they are made, so listing order is also the default kernel first
+    for kernel in kernels:
+        loader = kernel["esp_path"].removeprefix("/boot").replace("/", "\\")
+        RunCommand(f"efibootmgr --create-only --disk \"{boot_disk}\" --part \"{boot_part}\" --loader \"{loader}\" --label \"{kernel["label"]}\"")
+    boot_nums = []
     for line in RunCommand("efibootmgr", capture=True).splitlines():
         if not len(line) > 8:
             continue
@@ -210,8 +515,8 @@ def Main():
         boot_num = line[4:8]
         if not all([ c in "0123456789" for c in boot_num ]):
             continue
-        RunCommand(f"efibootmgr --bootorder {boot_num}")
-        break
+        boot_nums.append(boot_num)
+    RunCommand(f"efibootmgr --bootorder {",".join(boot_nums)}")
     RunCommand("efibootmgr --timeout 0", check=False)
     RunCommand("efibootmgr --delete-bootnext", check=False)
 
@@ -247,7 +552,7 @@ def Main():
         RunCommand(f"cert-to-efi-sig-list -g \"{eos_uuid}\" \"{kek_cert_path}\" \"{kek_esl_path}\"")
 
     db_esl_path = os.path.join(keys_dir_path, "db.esl")
-    RunCommand(f"hash-to-efi-sig-list \"{efi_path}\" \"{db_esl_path}\"")
+    RunCommand(f"hash-to-efi-sig-list {" ".join([ f"\"{kernel["esp_path"]}\"" for kernel in kernels ])} \"{db_esl_path}\"")
     RunCommand(f"cat \"{optrom_esl_path}\" >> \"{db_esl_path}\"")
 
     dbx_payload = b"\x26\x16\xC4\xC1\x4C\x50\x92\x40\xAC\xA9\x41\xF9\x36\x93\x43\x28\x4C\x00\x00\x00\x00\x00\x00\x00\x30\x00\x00\x00\x04\x2C\x70\x81\xCC\x15\x73\x45\xB5\xD4\xC3\xA4\x76\xB6\x35\xDC\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
@@ -289,4 +594,5 @@ def Main():
     RunCommand(f"rm -rf \"{temp_dir_path}\"")
     print("Successfully updated and installed new bootloader!")
     return 0
-sys.exit(Main())
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(Main())
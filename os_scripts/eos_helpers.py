@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import subprocess
+import os
+import sys
+
+# Shared by every EOS script. Scripts are installed together into INSTALL_DIR with bytecode compiled ahead of
+# time, and each command in /usr/bin is a tiny launcher which imports its script from there. The bytecode uses
+# unchecked hashes so starting a command never compiles or even stats the source.
+INSTALL_DIR = "/usr/lib/eos_scripts"
+BIN_DIR = "/usr/bin"
+VERSION_FILE_NAME = ".version"
+
+def WriteFile(filePath, contents, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
+        file.write(contents)
+def ReadFile(filePath, defaultContents=None, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    if not os.path.exists(filePath):
+        if defaultContents != None:
+            return defaultContents
+    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
+        return file.read()
+def RunCommand(command, echo=False, capture=False, input=None, check=True):
+    result = subprocess.run(command, capture_output=(not echo), input=input, check=check, shell=True, text=True)
+    if capture and not check:
+        return (result.stdout + result.stderr).strip(), result.returncode
+    elif capture:
+        return (result.stdout + result.stderr).strip()
+    elif not check:
+        return result.returncode
+    else:
+        return
+def PrintWarning(message):
+    print(f"\033[93mWarning: {message}\033[0m")
+def PrintError(message):
+    print(f"\033[91mERROR: {message}\033[0m")
+
+# Mount policy matching the installer's. Real disks are trimmed in batches by fstrim.timer since online discard
+# stalls writes on many SSDs, virtual disks use online discard, and dm-crypt passes discards through either way.
+EXT4_COMMIT_SECONDS = 30
+
+def GetBackingDisks(dev_path):
+    # Names of the whole disks under a device, following partitions and dm/md slaves
+    name = os.path.basename(os.path.realpath(dev_path))
+    sys_path = os.path.realpath(f"/sys/class/block/{name}")
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        return [ os.path.basename(os.path.dirname(sys_path)) ]
+    slaves_path = os.path.join(sys_path, "slaves")
+    slave_names = sorted(os.listdir(slaves_path)) if os.path.isdir(slaves_path) else []
+    if len(slave_names) == 0:
+        return [ name ]
+    disk_names = []
+    for slave_name in slave_names:
+        disk_names += [ disk_name for disk_name in GetBackingDisks(f"/dev/{slave_name}") if not disk_name in disk_names ]
+    return disk_names
+def GetDiscardMode(dev_path):
+    # Returns "online", "periodic" or "none" when a disk under dev_path can't trim
+    disk_names = GetBackingDisks(dev_path)
+    if len(disk_names) == 0:
+        return "none"
+    virtual = True
+    for disk_name in disk_names:
+        sys_path = f"/sys/block/{disk_name}"
+        if ReadFile(f"{sys_path}/queue/discard_max_bytes", "0").strip() in [ "", "0" ]:
+            return "none"
+        driver_name = os.path.basename(os.path.realpath(f"{sys_path}/device/driver"))
+        vendor = ReadFile(f"{sys_path}/device/vendor", "").strip()
+        if not driver_name in [ "virtio_blk", "vbd" ] and not vendor in [ "QEMU", "VMware", "Msft", "0x1af4" ]:
+            virtual = False
+    return "online" if virtual else "periodic"
+def GetMountOptions(dev_path, fs_type, read_only=False):
+    options = [ "ro" if read_only else "rw", "noatime" ]
+    if fs_type == "ext4":
+        options += [ f"commit={EXT4_COMMIT_SECONDS}", "errors=remount-ro" ]
+    if GetDiscardMode(dev_path) == "online":
+        options.append("discard")
+    return ",".join(options)
+
+def GetSourceVersion(source_dir_path):
+    # Hash of every script plus the interpreter's bytecode tag so a python upgrade also triggers a reinstall
+    import hashlib
+    sha256 = hashlib.sha256(sys.implementation.cache_tag.encode("UTF-8"))
+    for file_name in sorted(os.listdir(source_dir_path)):
+        if file_name.endswith(".py"):
+            sha256.update(file_name.encode("UTF-8") + b"\x00")
+            sha256.update(ReadFile(os.path.join(source_dir_path, file_name), binary=True) + b"\x00")
+    return sha256.hexdigest()
+def InstallScripts(source_dir_path, version):
+    # Stages the whole set next to INSTALL_DIR and swaps it in so a running command never sees half an install
+    import py_compile
+    import shutil
+    staging_dir_path = f"{INSTALL_DIR}.new"
+    old_dir_path = f"{INSTALL_DIR}.old"
+    for dir_path in [ staging_dir_path, old_dir_path ]:
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path)
+    os.makedirs(staging_dir_path, mode=0o755)
+    command_names = []
+    for file_name in sorted(os.listdir(source_dir_path)):
+        if not file_name.endswith(".py"):
+            continue
+        install_path = os.path.join(staging_dir_path, file_name)
+        shutil.copyfile(os.path.join(source_dir_path, file_name), install_path)
+        os.chmod(install_path, 0o644)
+        py_compile.compile(install_path, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        if "\ndef Main(" in ReadFile(install_path):
+            command_names.append(os.path.splitext(file_name)[0])
+    WriteFile(os.path.join(staging_dir_path, VERSION_FILE_NAME), version + "\n")
+    for root, dir_names, file_names in os.walk(staging_dir_path):
+        for name in dir_names + file_names:
+            os.chmod(os.path.join(root, name), 0o755 if name in dir_names else 0o644)
+            os.chown(os.path.join(root, name), 0, 0)
+    if os.path.exists(INSTALL_DIR):
+        os.rename(INSTALL_DIR, old_dir_path)
+    os.rename(staging_dir_path, INSTALL_DIR)
+    if os.path.exists(old_dir_path):
+        shutil.rmtree(old_dir_path)
+
+    for command_name in command_names:
+        launcher = [
+            f"#!{sys.executable} -IS",
+            f"# This file is auto-generated by eos_helpers.",
+            f"# Do not modify. All changes will be lost.",
+            f"import sys",
+            f"sys.path.insert(0, \"{INSTALL_DIR}\")",
+            f"import {command_name}",
+            f"sys.exit({command_name}.Main())",
+        ]
+        launcher_path = os.path.join(BIN_DIR, command_name)
+        WriteFile(f"{launcher_path}.new", "".join([ line + "\n" for line in launcher ]))
+        os.chmod(f"{launcher_path}.new", 0o755)
+        os.chown(f"{launcher_path}.new", 0, 0)
+        os.replace(f"{launcher_path}.new", launcher_path)
+    return command_names
+def Install(script_path):
+    # Installed commands return straight away. Running a script from a checkout installs the whole set when its
+    # version hash differs from the installed one, which only needs sudo when something actually changed.
+    source_dir_path = os.path.dirname(script_path)
+    if source_dir_path == INSTALL_DIR:
+        return
+    source_dir_path = os.path.dirname(os.path.realpath(script_path))
+    version = GetSourceVersion(source_dir_path)
+    if ReadFile(os.path.join(INSTALL_DIR, VERSION_FILE_NAME), "").strip() == version:
+        return
+    if os.geteuid() != 0 or os.getegid() != 0:
+        print(f"Root is required to install \"{source_dir_path}\" to \"{INSTALL_DIR}\".")
+        RunCommand(f"sudo \"{sys.executable}\" -I \"{os.path.realpath(__file__)}\" install \"{source_dir_path}\"", echo=True)
+    else:
+        InstallScripts(source_dir_path, version)
+    print(f"Installed \"{source_dir_path}\" to \"{INSTALL_DIR}\".")
+    print()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "install":
+        print(f"Usage: {os.path.basename(__file__)} install <os_scripts dir>")
+        sys.exit(1)
+    source_dir_path = os.path.realpath(sys.argv[2])
+    InstallScripts(source_dir_path, GetSourceVersion(source_dir_path))
@@ -1,58 +1,435 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import subprocess
+import tempfile
+import fnmatch
+import json
+import shutil
+import time
 import os
 import sys
 
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True):
-    result = subprocess.run(command, capture_output=(not echo), input=input, check=check, shell=True, text=True)
-    if capture and not check:
-        return (result.stdout + result.stderr).strip(), result.returncode
-    elif capture:
-        return (result.stdout + result.stderr).strip()
-    elif not check:
-        return result.returncode
+from eos_helpers import *
+Install(__file__)
+
+def GetFileSizes(dir_path):
+    file_sizes = {}
+    for root, dir_names, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            try:
+                file_sizes[file_path] = os.lstat(file_path).st_size
+            except OSError:
+                continue
+    return file_sizes
+def CountNewBytes(old_file_sizes, new_file_sizes):
+    return sum([ max(0, size - old_file_sizes.get(file_path, 0)) for file_path, size in new_file_sizes.items() ])
+def FormatBytes(byte_count):
+    for unit in [ "B", "KiB", "MiB", "GiB" ]:
+        if byte_count < 1024 or unit == "GiB":
+            return f"{byte_count:.1f} {unit}" if unit != "B" else f"{byte_count} {unit}"
+        byte_count /= 1024
+def WriteParallelPacmanConf(pacman_conf_path, parallel_downloads):
+    output = []
+    for line in ReadFile("/etc/pacman.conf").splitlines():
+        if line.strip().lstrip("#").strip().startswith("ParallelDownloads"):
+            continue
+        output.append(line)
+        if line.strip() == "[options]":
+            output.append(f"ParallelDownloads = {parallel_downloads}")
+    WriteFile(pacman_conf_path, "".join([ line + "\n" for line in output ]))
+def PrefetchAurSources(build_dir_path, package_base):
+    package_dir_path = os.path.join(build_dir_path, package_base)
+    if os.path.isdir(os.path.join(package_dir_path, ".git")):
+        RunCommand(f"git -C \"{package_dir_path}\" pull --ff-only --quiet")
     else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-def Install():
-    script_path = os.path.realpath(__file__)
-    script_name = os.path.splitext(os.path.basename(script_path))[0]
-    install_path = f"/usr/bin/{script_name}"
-    if script_path == install_path:
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) == os.path.getmtime(install_path):
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) < os.path.getmtime(install_path):
-        PrintWarning(f"Not installing because script in \"{install_path}\" is newer than \"{script_path}\".")
-        return
-    if os.geteuid() != 0 or os.getegid() != 0:
-        print(f"Root is required to install \"{script_path}\" to \"{install_path}\".")
-    sudo_commands = [
-        f"cp -p \"{script_path}\" \"{install_path}\"",
-        f"chmod 755 \"{install_path}\"",
-        f"chown +0:+0 \"{install_path}\"",
+        RunCommand(f"git clone --quiet \"https://aur.archlinux.org/{package_base}.git\" \"{package_dir_path}\"")
+    RunCommand(f"cd \"{package_dir_path}\" && makepkg --verifysource --noconfirm")
+def QueryAur(package_names):
+    # urllib.request pulls in ssl, http and email so it is only imported when the AUR is actually queried
+    import urllib.parse
+    import urllib.request
+    query = urllib.parse.urlencode([ ("arg[]", package_name) for package_name in package_names ])
+    with urllib.request.urlopen(f"https://aur.archlinux.org/rpc/v5/info?{query}", timeout=30) as response:
+        return json.loads(response.read().decode("UTF-8"))["results"]
+def ResolveAurGraph(aur_info):
+    # Maps each package base to the other package bases in this update it depends on
+    providers = {}
+    for info in aur_info:
+        for provide in [ info["Name"] ] + info.get("Provides", []):
+            providers[StripDepVersion(provide)] = info["PackageBase"]
+    graph = {}
+    for info in aur_info:
+        deps = graph.setdefault(info["PackageBase"], set())
+        for dep in info.get("Depends", []) + info.get("MakeDepends", []) + info.get("CheckDepends", []):
+            dep_base = providers.get(StripDepVersion(dep))
+            if dep_base != None and dep_base != info["PackageBase"]:
+                deps.add(dep_base)
+    return graph
+def WriteMakepkgConf(makepkg_conf_path, make_jobs, use_ccache):
+    makepkg_conf = [
+        f"source /etc/makepkg.conf",
+        f"MAKEFLAGS=\"-j{make_jobs}\"",
     ]
-    RunCommand(f"sudo sh -c \'{"; ".join(sudo_commands)}\'")
-    print(f"Installed \"{script_path}\" to \"{install_path}\".")
+    if use_ccache:
+        makepkg_conf.append(f"BUILDENV=(\"${{BUILDENV[@]/!ccache/ccache}}\")")
+    WriteFile(makepkg_conf_path, "".join([ line + "\n" for line in makepkg_conf ]))
+def BuildAurPackage(build_dir_path, package_base, temp_dir_path, makepkg_conf_path):
+    # Each package gets its own clean BUILDDIR under the temp folder so parallel builds never share a tree
+    package_dir_path = os.path.join(build_dir_path, package_base)
+    clean_build_path = os.path.join(temp_dir_path, "build", package_base)
+    log_path = os.path.join(temp_dir_path, "logs", f"{package_base}.log")
+    os.makedirs(clean_build_path, exist_ok=True)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    start_time = time.monotonic()
+    status_code = RunCommand(f"cd \"{package_dir_path}\" && BUILDDIR=\"{clean_build_path}\" PKGDEST=\"{package_dir_path}\" makepkg --config \"{makepkg_conf_path}\" --cleanbuild --clean --force --noconfirm > \"{log_path}\" 2>&1", check=False)
+    RunCommand(f"rm -rf \"{clean_build_path}\"")
+    if status_code != 0:
+        raise Exception(f"makepkg failed. See \"{log_path}\".")
+    package_paths = RunCommand(f"cd \"{package_dir_path}\" && PKGDEST=\"{package_dir_path}\" makepkg --config \"{makepkg_conf_path}\" --packagelist", capture=True).splitlines()
+    return package_paths, time.monotonic() - start_time
+def GetUpdatePackagePaths(built_paths, package_names):
+    # Split packages can build more than was asked for so only the packages being updated are kept
+    package_paths = []
+    for built_path in built_paths:
+        package_name = os.path.basename(built_path)[:os.path.basename(built_path).index(".pkg.tar")].rsplit("-", 3)[0]
+        if package_name in package_names and os.path.exists(built_path):
+            package_paths.append(built_path)
+    return package_paths
+def BuildAurGraph(graph, jobs, build_function, install_function):
+    # Starts every package whose dependencies have finished, up to jobs at a time. Packages other packages in the
+    # graph depend on are installed as soon as they are built so their dependents build against the new version.
+    built = {}
+    failed = set()
+    remaining = dict(graph)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(remaining) != 0 or len(running) != 0:
+            for package_base, deps in sorted(remaining.items()):
+                if any([ dep in failed for dep in deps ]):
+                    PrintWarning(f"Skipping {package_base} because a dependency failed to build.")
+                    failed.add(package_base)
+                    del remaining[package_base]
+                elif all([ dep in built for dep in deps ]):
+                    print(f"Building {package_base}...")
+                    running[executor.submit(build_function, package_base)] = package_base
+                    del remaining[package_base]
+            if len(running) == 0:
+                for package_base in remaining:
+                    PrintError(f"Unable to build {package_base} because of a dependency cycle.")
+                failed.update(remaining.keys())
+                break
+            finished, pending = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                package_base = running.pop(future)
+                if future.exception() != None:
+                    PrintError(f"Failed to build {package_base}. {future.exception()}")
+                    failed.add(package_base)
+                    continue
+                built_paths, duration = future.result()
+                print(f"Built {package_base} in {duration:.1f}s.")
+                if any([ package_base in deps for deps in graph.values() ]):
+                    try:
+                        install_function(package_base, built_paths)
+                    except Exception as exception:
+                        PrintError(f"Failed to install {package_base} for the packages which depend on it. {exception}")
+                        failed.add(package_base)
+                        continue
+                built[package_base] = built_paths
+    return built, failed
+def FindStalePackages(cache_dir_path, keep_versions):
+    # Package files are grouped by name and the least recently used versions past keep_versions are stale
+    packages = {}
+    for file_name in os.listdir(cache_dir_path):
+        if not ".pkg.tar" in file_name or file_name.endswith(".sig") or file_name.endswith(".part"):
+            continue
+        fields = file_name[:file_name.index(".pkg.tar")].rsplit("-", 3)
+        if len(fields) != 4:
+            continue
+        file_path = os.path.join(cache_dir_path, file_name)
+        st = os.stat(file_path)
+        packages.setdefault(fields[0], []).append((max(st.st_atime, st.st_mtime), file_path))
+    stale_paths = []
+    for versions in packages.values():
+        versions.sort(reverse=True)
+        for last_used, file_path in versions[keep_versions:]:
+            stale_paths.append(file_path)
+            if os.path.exists(file_path + ".sig"):
+                stale_paths.append(file_path + ".sig")
+    return stale_paths
+
+def RpmVercmp(a, b):
+    # Port of rpmvercmp from libalpm so plans don't fork vercmp per package
+    if a == b:
+        return 0
+    i = 0
+    j = 0
+    while i < len(a) and j < len(b):
+        start_i = i
+        start_j = j
+        while i < len(a) and not a[i].isalnum():
+            i += 1
+        while j < len(b) and not b[j].isalnum():
+            j += 1
+        if i >= len(a) or j >= len(b):
+            break
+        if i - start_i != j - start_j:
+            return -1 if i - start_i < j - start_j else 1
+        start_i = i
+        start_j = j
+        is_number = a[i].isdigit()
+        while i < len(a) and (a[i].isdigit() if is_number else a[i].isalpha()):
+            i += 1
+        while j < len(b) and (b[j].isdigit() if is_number else b[j].isalpha()):
+            j += 1
+        segment_a = a[start_i:i]
+        segment_b = b[start_j:j]
+        if segment_b == "":
+            return 1 if is_number else -1
+        if is_number:
+            segment_a = segment_a.lstrip("0")
+            segment_b = segment_b.lstrip("0")
+            if len(segment_a) != len(segment_b):
+                return 1 if len(segment_a) > len(segment_b) else -1
+        if segment_a != segment_b:
+            return 1 if segment_a > segment_b else -1
+    if i >= len(a) and j >= len(b):
+        return 0
+    if (i >= len(a) and not b[j].isalpha()) or (i < len(a) and a[i].isalpha()):
+        return -1
+    return 1
+def Vercmp(a, b):
+    def Split(version):
+        epoch = "0"
+        release = None
+        if ":" in version:
+            epoch, version = version.split(":", 1)
+        if "-" in version:
+            version, release = version.rsplit("-", 1)
+        return epoch, version, release
+    epoch_a, version_a, release_a = Split(a)
+    epoch_b, version_b, release_b = Split(b)
+    result = RpmVercmp(epoch_a, epoch_b)
+    if result == 0:
+        result = RpmVercmp(version_a, version_b)
+    if result == 0 and release_a != None and release_b != None:
+        result = RpmVercmp(release_a, release_b)
+    return result
+def ParseDesc(contents):
+    fields = {}
+    key = None
+    for line in contents.splitlines():
+        if line.startswith("%") and line.endswith("%"):
+            key = line[1:-1]
+            fields[key] = []
+        elif line != "" and key != None:
+            fields[key].append(line)
+    return fields
+def StripDepVersion(dep):
+    for separator in [ ">=", "<=", "=", ">", "<", ":" ]:
+        if separator in dep:
+            dep = dep[:dep.index(separator)]
+    return dep.strip()
+def ParseSyncDb(db_path):
+    import tarfile
+    packages = {}
+    with tarfile.open(db_path, "r:*") as db:
+        for member in db:
+            if not member.isfile() or not member.name.endswith("/desc"):
+                continue
+            fields = ParseDesc(db.extractfile(member).read().decode("UTF-8"))
+            packages[fields["NAME"][0]] = {
+                "version": fields["VERSION"][0],
+                "filename": fields["FILENAME"][0],
+                "csize": int(fields.get("CSIZE", ["0"])[0]),
+                "isize": int(fields.get("ISIZE", ["0"])[0]),
+                "depends": [ StripDepVersion(dep) for dep in fields.get("DEPENDS", []) ],
+                "provides": [ StripDepVersion(provide) for provide in fields.get("PROVIDES", []) ],
+            }
+    return packages
+def ReadLocalDb(local_db_path):
+    packages = {}
+    for entry_name in os.listdir(local_db_path):
+        desc_path = os.path.join(local_db_path, entry_name, "desc")
+        if not os.path.isfile(desc_path):
+            continue
+        fields = ParseDesc(ReadFile(desc_path))
+        packages[fields["NAME"][0]] = {
+            "version": fields["VERSION"][0],
+            "isize": int(fields.get("SIZE", ["0"])[0]),
+            "provides": [ StripDepVersion(provide) for provide in fields.get("PROVIDES", []) ],
+            "files_path": os.path.join(local_db_path, entry_name, "files"),
+        }
+    return packages
+def ReadLocalFiles(files_path):
+    if not os.path.isfile(files_path):
+        return []
+    return ParseDesc(ReadFile(files_path)).get("FILES", [])
+def ReadHooks():
+    # Hooks in /etc/pacman.d/hooks override hooks with the same name in /usr/share/libalpm/hooks
+    hook_paths = {}
+    for hooks_dir_path in [ "/usr/share/libalpm/hooks", "/etc/pacman.d/hooks" ]:
+        if not os.path.isdir(hooks_dir_path):
+            continue
+        for hook_name in os.listdir(hooks_dir_path):
+            if hook_name.endswith(".hook"):
+                hook_paths[hook_name] = os.path.join(hooks_dir_path, hook_name)
+    hooks = []
+    for hook_name, hook_path in sorted(hook_paths.items()):
+        hook = { "name": hook_name, "description": hook_name, "triggers": [] }
+        section = None
+        for line in ReadFile(hook_path).splitlines():
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = line[1:-1]
+                if section == "Trigger":
+                    hook["triggers"].append({ "operations": [], "type": None, "targets": [] })
+                continue
+            key, _, value = line.partition("=")
+            key = key.strip()
+            value = value.strip()
+            if section == "Trigger" and key == "Operation":
+                hook["triggers"][-1]["operations"].append(value)
+            elif section == "Trigger" and key == "Type":
+                hook["triggers"][-1]["type"] = value
+            elif section == "Trigger" and key == "Target":
+                hook["triggers"][-1]["targets"].append(value)
+            elif section == "Action" and key == "Description":
+                hook["description"] = value
+        hooks.append(hook)
+    return hooks
+def TriggerMatches(trigger, operation, package_name, file_paths):
+    if not operation in trigger["operations"]:
+        return False
+    candidates = [ package_name ] if trigger["type"] == "Package" else file_paths
+    for candidate in candidates:
+        matched = False
+        for target in trigger["targets"]:
+            if target.startswith("!") and fnmatch.fnmatchcase(candidate, target[1:]):
+                matched = False
+            elif not target.startswith("!") and fnmatch.fnmatchcase(candidate, target):
+                matched = True
+        if matched:
+            return True
+    return False
+def Plan():
+    cache_dir_path = os.path.expanduser("~/.cache/eos_updates")
+    db_path = os.path.join(cache_dir_path, "db")
+    parsed_cache_path = os.path.join(cache_dir_path, "sync.json")
+    pacman_cache_path = "/var/cache/pacman/pkg"
+    local_db_path = "/var/lib/pacman/local"
+    sync_max_age = 10 * 60
+
+    # Sync into a private db path so the real sync databases are left alone (like checkupdates)
+    os.makedirs(db_path, exist_ok=True)
+    if not os.path.islink(os.path.join(db_path, "local")):
+        os.symlink(local_db_path, os.path.join(db_path, "local"))
+    parsed_cache = json.loads(ReadFile(parsed_cache_path, defaultContents="{}"))
+    start_time = time.monotonic()
+    if time.time() - parsed_cache.get("synced", 0) > sync_max_age:
+        print("\033[36mSyncing package databases...\033[0m")
+        RunCommand(f"fakeroot -- pacman -Sy --dbpath \"{db_path}\" --logfile /dev/null", echo=True)
+        parsed_cache["synced"] = time.time()
+    sync_time = time.monotonic() - start_time
+
+    # Parsed databases are reused until pacman downloads a new copy
+    start_time = time.monotonic()
+    repo_names = [ line.strip()[1:-1] for line in ReadFile("/etc/pacman.conf").splitlines() if line.strip().startswith("[") and line.strip() != "[options]" ]
+    repos = parsed_cache.setdefault("repos", {})
+    for repo_name in repo_names:
+        repo_db_path = os.path.join(db_path, "sync", f"{repo_name}.db")
+        if not os.path.exists(repo_db_path):
+            continue
+        st = os.stat(repo_db_path)
+        if repo_name in repos and repos[repo_name]["mtime"] == st.st_mtime and repos[repo_name]["size"] == st.st_size:
+            continue
+        repos[repo_name] = { "mtime": st.st_mtime, "size": st.st_size, "packages": ParseSyncDb(repo_db_path) }
+    WriteFile(parsed_cache_path, json.dumps(parsed_cache))
+    sync_packages = {}
+    sync_provides = {}
+    for repo_name in reversed(repo_names):
+        if not repo_name in repos:
+            continue
+        for package_name, package in repos[repo_name]["packages"].items():
+            sync_packages[package_name] = package
+            for provide in package["provides"]:
+                sync_provides[provide] = package_name
+    local_packages = ReadLocalDb(local_db_path)
+    local_provides = set(local_packages.keys())
+    for package in local_packages.values():
+        local_provides.update(package["provides"])
+    parse_time = time.monotonic() - start_time
+
+    # Work out the upgrade set then walk the dependency graph for anything newly pulled in
+    upgrades = [ package_name for package_name, package in sorted(local_packages.items()) if package_name in sync_packages and Vercmp(sync_packages[package_name]["version"], package["version"]) > 0 ]
+    installs = {}
+    pending = [ (dep, package_name) for package_name in upgrades for dep in sync_packages[package_name]["depends"] ]
+    while len(pending) != 0:
+        dep, required_by = pending.pop()
+        if dep in local_provides:
+            continue
+        dep_name = dep if dep in sync_packages else sync_provides.get(dep)
+        if dep_name == None:
+            PrintWarning(f"Unable to resolve dependency {dep} of {required_by}.")
+            continue
+        if dep_name in installs or dep_name in local_packages:
+            continue
+        installs[dep_name] = required_by
+        pending += [ (new_dep, dep_name) for new_dep in sync_packages[dep_name]["depends"] ]
+
+    print("\033[36mUpgrade plan:\033[0m")
+    if len(upgrades) == 0 and len(installs) == 0:
+        print("There is nothing to do.")
+        return 0
+    download_size = 0
+    install_size = 0
+    net_size = 0
+    for package_name in upgrades + sorted(installs.keys()):
+        package = sync_packages[package_name]
+        if not os.path.exists(os.path.join(pacman_cache_path, package["filename"])):
+            download_size += package["csize"]
+        install_size += package["isize"]
+        if package_name in local_packages:
+            net_size += package["isize"] - local_packages[package_name]["isize"]
+            print(f"{package_name} {local_packages[package_name]["version"]} -> {package["version"]}")
+        else:
+            net_size += package["isize"]
+            print(f"{package_name} {package["version"]} (new, required by {installs[package_name]})")
+    print()
+
+    # Path triggers are matched against the installed file list, new packages only match package triggers
+    print("\033[36mHooks which will run:\033[0m")
+    fired_hooks = []
+    for hook in ReadHooks():
+        for package_name in upgrades + sorted(installs.keys()):
+            operation = "Upgrade" if package_name in local_packages else "Install"
+            file_paths = ReadLocalFiles(local_packages[package_name]["files_path"]) if package_name in local_packages and any([ trigger["type"] == "Path" for trigger in hook["triggers"] ]) else []
+            if any([ TriggerMatches(trigger, operation, package_name, file_paths) for trigger in hook["triggers"] ]):
+                fired_hooks.append(hook)
+                print(f"{hook["description"]} ({hook["name"]}, triggered by {package_name})")
+                break
+    if len(fired_hooks) == 0:
+        print("None.")
     print()
-Install()
-# endregion
+
+    print(f"Packages: {len(upgrades)} upgraded, {len(installs)} new")
+    print(f"Download size: {FormatBytes(download_size)}")
+    print(f"Installed size: {FormatBytes(install_size)}")
+    print(f"Net size change: {"-" if net_size < 0 else ""}{FormatBytes(abs(net_size))}")
+    print(f"Planned in {sync_time + parse_time:.2f}s (sync {sync_time:.2f}s, parse {parse_time:.2f}s).")
+    print()
+    return 0
+
+def ReadCountOption(args, option, default, minimum):
+    # Returns default when the option is missing and None when its value is not a whole number of at least minimum
+    if not option in args:
+        return default
+    index = args.index(option)
+    if index + 1 >= len(args) or not args[index + 1].isdigit() or int(args[index + 1]) < minimum:
+        return None
+    return int(args[index + 1])
 
 def Main():
     if os.geteuid() == 0 or os.getegid() == 0:
@@ -60,24 +437,148 @@ def Main():
         PrintError(f"{script_name} may not be run as root. Please try again.")
         return 1
     print()
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == "plan":
+        return Plan()
 
-    print("\033[36mClearing cache...\033[0m")
-    RunCommand("yay -Scc --noconfirm", echo=True)
-    print()
+    parallel_downloads = 10
+    aur_jobs = ReadCountOption(args, "--jobs", max(1, (os.cpu_count() or 1) // 4), 1)
+    keep_versions = ReadCountOption(args, "--keep", 3, 1)
+    if aur_jobs == None or keep_versions == None:
+        script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
+        PrintError(f"Usage: {script_name} [plan] [--jobs <count>] [--keep <versions>]")
+        return 1
+    pacman_cache_path = "/var/cache/pacman/pkg"
+    # stdout only since RunCommand would mix any warnings yay prints into the json
+    yay_config = json.loads(subprocess.run([ "yay", "-Pg" ], capture_output=True, text=True, check=True).stdout)
+    aur_build_path = os.path.expanduser(yay_config.get("buildDir", "~/.cache/yay"))
+    temp_dir_path = tempfile.mkdtemp(prefix="eos_updates_")
+    # The temp folder holds the pacman and makepkg configs plus build logs and is removed even if a step fails
+    try:
+        pacman_conf_path = os.path.join(temp_dir_path, "pacman.conf")
+        WriteParallelPacmanConf(pacman_conf_path, parallel_downloads)
+        makepkg_conf_path = os.path.join(temp_dir_path, "makepkg.conf")
+        WriteMakepkgConf(makepkg_conf_path, max(1, (os.cpu_count() or 1) // aur_jobs), shutil.which("ccache") != None)
+        phases = []
+        downloaded_bytes = 0
 
-    print(f"\033[36mRemoving orphaned packages...\033[0m")
-    stdout, statusCode = RunCommand("yay -Qqdt", capture=True, check=False)
-    orphans = stdout.splitlines()
-    if len(orphans) == 0:
-        print("There is nothing to do.")
-    else:
-        print(f"{" ".join(orphans)}")
-        RunCommand(f"yay -Rns {" ".join(orphans)} --noconfirm")
-    print()
+        phase_start = time.monotonic()
+        print(f"\033[36mRemoving orphaned packages...\033[0m")
+        stdout, statusCode = RunCommand("yay -Qqdt", capture=True, check=False)
+        orphans = stdout.splitlines()
+        if len(orphans) == 0:
+            print("There is nothing to do.")
+        else:
+            print(f"{" ".join(orphans)}")
+            RunCommand(f"yay -Rns {" ".join(orphans)} --noconfirm")
+        phases.append(("Remove orphans", time.monotonic() - phase_start))
+        print()
+
+        # Everything is downloaded ahead of installing. Partial downloads stay in the cache so an interrupted run resumes.
+        phase_start = time.monotonic()
+        print("\033[36mDownloading package updates...\033[0m")
+        old_file_sizes = GetFileSizes(pacman_cache_path)
+        RunCommand(f"sudo pacman --config \"{pacman_conf_path}\" -Syuw --noconfirm", echo=True)
+        pacman_bytes = CountNewBytes(old_file_sizes, GetFileSizes(pacman_cache_path))
+        downloaded_bytes += pacman_bytes
+        phases.append(("Download repo packages", time.monotonic() - phase_start))
+        print()
+
+        phase_start = time.monotonic()
+        print("\033[36mPrefetching AUR sources...\033[0m")
+        stdout, statusCode = RunCommand("yay -Qua", capture=True, check=False)
+        aur_updates = [ line.split()[0] for line in stdout.splitlines() if line.strip() != "" ]
+        aur_graph = {}
+        if len(aur_updates) == 0:
+            print("There is nothing to do.")
+        else:
+            aur_info = QueryAur(aur_updates)
+            aur_graph = ResolveAurGraph(aur_info)
+            os.makedirs(aur_build_path, exist_ok=True)
+            old_file_sizes = GetFileSizes(aur_build_path)
+            package_bases = sorted(aur_graph.keys())
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_downloads) as executor:
+                futures = [ executor.submit(PrefetchAurSources, aur_build_path, package_base) for package_base in package_bases ]
+            for package_base, future in zip(package_bases, futures):
+                if future.exception() != None:
+                    PrintWarning(f"Failed to prefetch sources for {package_base}. makepkg will retry while building.")
+                else:
+                    print(f"Prefetched sources for {package_base}.")
+            downloaded_bytes += CountNewBytes(old_file_sizes, GetFileSizes(aur_build_path))
+        phases.append(("Prefetch AUR sources", time.monotonic() - phase_start))
+        print()
+
+        phase_start = time.monotonic()
+        print("\033[36mInstalling repo updates...\033[0m")
+        RunCommand(f"sudo pacman --config \"{pacman_conf_path}\" -Su --noconfirm", echo=True)
+        phases.append(("Install repo updates", time.monotonic() - phase_start))
+        print()
+
+        # Independent AUR packages build side by side. Dependencies are installed as soon as they are built and
+        # everything else in one transaction at the end.
+        phase_start = time.monotonic()
+        print(f"\033[36mBuilding AUR updates with {aur_jobs} job(s)...\033[0m")
+        if len(aur_graph) == 0:
+            print("There is nothing to do.")
+        else:
+            all_deps = [ dep for info in aur_info for dep in info.get("Depends", []) + info.get("MakeDepends", []) + info.get("CheckDepends", []) ]
+            aur_provides = set([ StripDepVersion(provide) for info in aur_info for provide in [ info["Name"] ] + info.get("Provides", []) ])
+            repo_deps = [ dep for dep in all_deps if not StripDepVersion(dep) in aur_provides ]
+            missing_deps = []
+            if len(repo_deps) != 0:
+                missing_deps = RunCommand(f"pacman -T {" ".join([ f"\"{dep}\"" for dep in repo_deps ])}", capture=True, check=False)[0].splitlines()
+            if len(missing_deps) != 0:
+                print(f"Installing build dependencies {" ".join(missing_deps)}...")
+                if RunCommand(f"sudo pacman --config \"{pacman_conf_path}\" -S --needed --asdeps --noconfirm {" ".join([ f"\"{dep}\"" for dep in missing_deps ])}", check=False) != 0:
+                    PrintWarning("Some build dependencies could not be installed from the repos.")
+            # Every package here is an update so pacman -U keeps each one's existing install reason
+            installed_paths = set()
+            def InstallAurDependency(package_base, built_paths):
+                package_paths = GetUpdatePackagePaths(built_paths, aur_updates)
+                if len(package_paths) == 0:
+                    return
+                print(f"Installing {package_base} before building the packages which depend on it...")
+                RunCommand(f"sudo pacman --config \"{pacman_conf_path}\" -U --noconfirm {" ".join([ f"\"{package_path}\"" for package_path in package_paths ])}", echo=True)
+                installed_paths.update(package_paths)
+            built, failed = BuildAurGraph(aur_graph, aur_jobs, lambda package_base: BuildAurPackage(aur_build_path, package_base, temp_dir_path, makepkg_conf_path), InstallAurDependency)
+            package_paths = [ package_path for built_paths in built.values() for package_path in GetUpdatePackagePaths(built_paths, aur_updates) if not package_path in installed_paths ]
+            if len(package_paths) != 0:
+                print("Installing AUR updates...")
+                RunCommand(f"sudo pacman --config \"{pacman_conf_path}\" -U --noconfirm {" ".join([ f"\"{package_path}\"" for package_path in package_paths ])}", echo=True)
+            if len(failed) != 0:
+                PrintWarning(f"These AUR packages were not updated: {" ".join(sorted(failed))}")
+        phases.append(("Build AUR updates", time.monotonic() - phase_start))
+        print()
+
+        # Keep the most recently used versions of each package instead of wiping the whole cache
+        phase_start = time.monotonic()
+        print(f"\033[36mPruning package cache to the last {keep_versions} versions...\033[0m")
+        stale_paths = FindStalePackages(pacman_cache_path, keep_versions)
+        freed_bytes = sum([ os.path.getsize(stale_path) for stale_path in stale_paths ])
+        for i in range(0, len(stale_paths), 256):
+            RunCommand(f"sudo rm -f {" ".join([ f"\"{stale_path}\"" for stale_path in stale_paths[i:i + 256] ])}")
+        if os.path.isdir(aur_build_path):
+            for package_name in os.listdir(aur_build_path):
+                package_dir_path = os.path.join(aur_build_path, package_name)
+                if not os.path.isdir(package_dir_path):
+                    continue
+                for stale_path in FindStalePackages(package_dir_path, keep_versions):
+                    freed_bytes += os.path.getsize(stale_path)
+                    os.remove(stale_path)
+                    stale_paths.append(stale_path)
+        print(f"Removed {len(stale_paths)} files and freed {FormatBytes(freed_bytes)}.")
+        phases.append(("Prune cache", time.monotonic() - phase_start))
+        print()
+    finally:
+        shutil.rmtree(temp_dir_path, ignore_errors=True)
 
-    print("\033[36mUpdating all packages...\033[0m")
-    RunCommand("yay -Syu --noconfirm", echo=True)
+    print("\033[36mSummary:\033[0m")
+    for phase_name, duration in phases:
+        print(f"{phase_name:<24} {duration:>8.1f}s")
+    print(f"{"Total":<24} {sum([ duration for phase_name, duration in phases ]):>8.1f}s")
+    print(f"Downloaded {FormatBytes(downloaded_bytes)} ({FormatBytes(pacman_bytes)} from repos).")
     print()
 
     return 0
-sys.exit(Main())
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(Main())
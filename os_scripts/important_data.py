@@ -1,58 +1,93 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import subprocess
+import time
 import os
 import sys
 
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True):
-    result = subprocess.run(command, capture_output=(not echo), input=input, check=check, shell=True, text=True)
-    if capture and not check:
-        return (result.stdout + result.stderr).strip(), result.returncode
-    elif capture:
-        return (result.stdout + result.stderr).strip()
-    elif not check:
-        return result.returncode
-    else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-def Install():
-    script_path = os.path.realpath(__file__)
-    script_name = os.path.splitext(os.path.basename(script_path))[0]
-    install_path = f"/usr/bin/{script_name}"
-    if script_path == install_path:
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) == os.path.getmtime(install_path):
-        return
-    if os.path.exists(install_path) and os.path.getmtime(script_path) < os.path.getmtime(install_path):
-        PrintWarning(f"Not installing because script in \"{install_path}\" is newer than \"{script_path}\".")
-        return
-    if os.geteuid() != 0 or os.getegid() != 0:
-        print(f"Root is required to install \"{script_path}\" to \"{install_path}\".")
-    sudo_commands = [
-        f"cp -p \"{script_path}\" \"{install_path}\"",
-        f"chmod 755 \"{install_path}\"",
-        f"chown +0:+0 \"{install_path}\"",
-    ]
-    RunCommand(f"sudo sh -c \'{"; ".join(sudo_commands)}\'")
-    print(f"Installed \"{script_path}\" to \"{install_path}\".")
-    print()
-Install()
-# endregion
+from eos_helpers import *
+Install(__file__)
+
+def ReadVolumes(config_path):
+    volumes = []
+    for line_number, line in enumerate(ReadFile(config_path).splitlines(), start=1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 6:
+            PrintWarning(f"Ignoring invalid volume on line {line_number} of \"{config_path}\".")
+            continue
+        volumes.append({
+            "name": fields[0],
+            "uuid": fields[1],
+            "key_path": fields[2],
+            "mount_path": fields[3],
+            "fs_type": fields[4],
+            "options": fields[5],
+        })
+    return volumes
+def GetVolumeOptions(volume):
+    # auto picks the same options the installer uses for the root filesystem based on the drive underneath
+    if volume["options"] != "auto":
+        return volume["options"]
+    return GetMountOptions(f"/dev/disk/by-uuid/{volume["uuid"]}", volume["fs_type"])
+def UnlockVolume(volume):
+    dev_path = f"/dev/disk/by-uuid/{volume["uuid"]}"
+    if not os.path.exists(dev_path):
+        raise Exception(f"{volume["name"]} drive is not connected to this PC.")
+    dev_path = os.path.realpath(dev_path)
+    if volume["key_path"] == "none":
+        return dev_path
+    if not os.path.exists(volume["key_path"]):
+        raise Exception(f"Key could not be found at {volume["key_path"]}.")
+    mapper_path = f"/dev/mapper/crypt_{volume["name"]}"
+    if not os.path.exists(mapper_path):
+        # Discards pass through whenever the drive can trim so fstrim.timer reaches it
+        allow_discards = " --allow-discards" if GetDiscardMode(dev_path) != "none" else ""
+        RunCommand(f"cryptsetup open \"{dev_path}\" \"{os.path.basename(mapper_path)}\" --key-file=\"{volume["key_path"]}\"{allow_discards}")
+    return mapper_path
+def LockVolume(volume):
+    mapper_path = f"/dev/mapper/crypt_{volume["name"]}"
+    if volume["key_path"] != "none" and os.path.exists(mapper_path):
+        RunCommand(f"cryptsetup close \"{os.path.basename(mapper_path)}\"")
+def PrepareMountPath(mount_path):
+    if os.path.ismount(mount_path):
+        raise Exception(f"Something is already mounted at {mount_path}.")
+    if not os.path.exists(mount_path):
+        os.makedirs(mount_path)
+        os.chmod(mount_path, 0o777)
+        os.chown(mount_path, 0, 0)
+    if len(os.listdir(mount_path)) != 0:
+        raise Exception(f"{mount_path} is not empty.")
+def MountVolume(volume):
+    timings = { "unlock": 0.0, "mount": 0.0 }
+    PrepareMountPath(volume["mount_path"])
+    start_time = time.monotonic()
+    dev_path = UnlockVolume(volume)
+    timings["unlock"] = time.monotonic() - start_time
+    start_time = time.monotonic()
+    RunCommand(f"mount -t {volume["fs_type"]} -o {GetVolumeOptions(volume)} \"{dev_path}\" \"{volume["mount_path"]}\"")
+    timings["mount"] = time.monotonic() - start_time
+    return timings
+def EscapeUnitPath(path):
+    # Same rules as systemd-escape --path without forking it
+    path = path.strip("/")
+    if path == "":
+        return "-"
+    output = ""
+    for i, c in enumerate(path):
+        if c == "/":
+            output += "-"
+        elif c.isascii() and (c.isalnum() or c == "_" or (c == "." and i != 0)):
+            output += c
+        else:
+            output += "".join([ f"\\x{b:02x}" for b in c.encode("UTF-8") ])
+    return output
+def InstallUnit(unit_path, payload):
+    WriteFile(unit_path, "".join([ line + "\n" for line in payload ]))
+    RunCommand(f"chmod 644 \"{unit_path}\"")
+    RunCommand(f"chown +0:+0 \"{unit_path}\"")
 
 def Main():
     script_path = os.path.realpath(__file__)
@@ -62,9 +97,141 @@ def Main():
         PrintError(f"{script_name} requires root. Try sudo {script_name}.")
         return 1
 
+    # Each line of the config describes one volume to unlock and mount
+    config_payload = [
+        f"# This file is read by {script_name} every boot.",
+        f"# All volumes listed here are unlocked and mounted at the same time.",
+        f"# Use none as the key file for volumes which are not encrypted.",
+        f"# Use auto as the options to pick trim and commit settings for the drive.",
+        f"#",
+        f"# <name> <uuid> <key file> <mount point> <type> <options>",
+        f"important_data c6b3988d-979c-4468-9b05-59c01ac32ad7 /etc/important_data.key /important_data ext4 auto",
+    ]
+    config_path = "/etc/important_data.conf"
+    if not os.path.exists(config_path):
+        WriteFile(config_path, "".join([ line + "\n" for line in config_payload ]))
+        RunCommand(f"chmod 644 \"{config_path}\"")
+        RunCommand(f"chown +0:+0 \"{config_path}\"")
+        print(f"Created default volume list at \"{config_path}\".")
+    volumes = ReadVolumes(config_path)
+    if len(volumes) == 0:
+        PrintWarning(f"No volumes are listed in \"{config_path}\".")
+        return 0
+
+    # Called by the generated unlock units in automount mode
+    args = sys.argv[1:]
+    if len(args) == 2 and (args[0] == "unlock" or args[0] == "lock"):
+        matches = [ volume for volume in volumes if volume["name"] == args[1] ]
+        if len(matches) == 0:
+            PrintError(f"No volume named {args[1]} in \"{config_path}\".")
+            return 1
+        if args[0] == "unlock":
+            start_time = time.monotonic()
+            UnlockVolume(matches[0])
+            print(f"Unlocked {args[1]} in {time.monotonic() - start_time:.2f}s.")
+        else:
+            LockVolume(matches[0])
+        return 0
+
+    # Automount mode mounts each volume on first access and unmounts it again when idle
+    unlock_unit_path = "/etc/systemd/system/important_data-unlock@.service"
+    systemd_dir_path = "/etc/systemd/system"
+    usage = f"Usage: {script_name} [boot | automount [idle seconds]]"
+    if len(args) >= 1 and args[0] == "automount":
+        if len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+            PrintError(usage)
+            return 1
+        idle_timeout = int(args[1]) if len(args) == 2 else 600
+        unlock_payload = [
+            f"# This file is auto-generated by {script_name}.",
+            f"# Do not modify. All changes will be lost.",
+            f"",
+            f"[Unit]",
+            f"Description=Unlocks the %i volume from {config_path}.",
+            f"DefaultDependencies=no",
+            f"StopWhenUnneeded=yes",
+            f"",
+            f"[Service]",
+            f"Type=oneshot",
+            f"RemainAfterExit=yes",
+            f"ExecStart=\"{install_path}\" unlock %i",
+            f"ExecStop=\"{install_path}\" lock %i",
+        ]
+        InstallUnit(unlock_unit_path, unlock_payload)
+        automount_names = []
+        for volume in volumes:
+            if not os.path.ismount(volume["mount_path"]):
+                PrepareMountPath(volume["mount_path"])
+            unit_name = EscapeUnitPath(volume["mount_path"])
+            mount_payload = [
+                f"# This file is auto-generated by {script_name}.",
+                f"# Do not modify. All changes will be lost.",
+                f"",
+                f"[Unit]",
+                f"Description=Mounts the {volume["name"]} volume on demand.",
+            ]
+            if volume["key_path"] != "none":
+                mount_payload += [
+                    f"Requires=important_data-unlock@{volume["name"]}.service",
+                    f"After=important_data-unlock@{volume["name"]}.service",
+                    f"",
+                    f"[Mount]",
+                    f"What=/dev/mapper/crypt_{volume["name"]}",
+                ]
+            else:
+                mount_payload += [
+                    f"",
+                    f"[Mount]",
+                    f"What=/dev/disk/by-uuid/{volume["uuid"]}",
+                ]
+            mount_payload += [
+                f"Where={volume["mount_path"]}",
+                f"Type={volume["fs_type"]}",
+                f"Options={GetVolumeOptions(volume)}",
+            ]
+            InstallUnit(os.path.join(systemd_dir_path, f"{unit_name}.mount"), mount_payload)
+            automount_payload = [
+                f"# This file is auto-generated by {script_name}.",
+                f"# Do not modify. All changes will be lost.",
+                f"",
+                f"[Unit]",
+                f"Description=Mounts the {volume["name"]} volume on first access.",
+                f"",
+                f"[Automount]",
+                f"Where={volume["mount_path"]}",
+                f"TimeoutIdleSec={idle_timeout}",
+                f"",
+                f"[Install]",
+                f"WantedBy=local-fs.target",
+            ]
+            InstallUnit(os.path.join(systemd_dir_path, f"{unit_name}.automount"), automount_payload)
+            automount_names.append(f"{unit_name}.automount")
+        RunCommand("systemctl disable important_data", check=False)
+        RunCommand("systemctl daemon-reload")
+        RunCommand(f"systemctl enable --now {" ".join(automount_names)}")
+        print(f"Enabled on demand mounting for {len(volumes)} volume(s) with an idle timeout of {idle_timeout}s.")
+        return 0
+    if len(args) == 1 and args[0] == "boot":
+        if os.path.exists(unlock_unit_path):
+            for volume in volumes:
+                unit_name = EscapeUnitPath(volume["mount_path"])
+                RunCommand(f"systemctl disable --now \"{unit_name}.automount\"", check=False)
+                for unit_path in [ os.path.join(systemd_dir_path, f"{unit_name}.automount"), os.path.join(systemd_dir_path, f"{unit_name}.mount") ]:
+                    if os.path.exists(unit_path):
+                        os.remove(unit_path)
+            os.remove(unlock_unit_path)
+            RunCommand("systemctl daemon-reload")
+            print("Disabled on demand mounting.")
+    elif len(args) != 0:
+        PrintError(usage)
+        return 1
+    elif os.path.exists(unlock_unit_path):
+        print(f"Volumes are mounted on demand. Run {script_name} boot to mount them at boot instead.")
+        return 0
+
     service_payload = [
         f"[Unit]",
-        f"Description=Mounts /important_data after root filesystem is mounted.",
+        f"Description=Unlocks and mounts the volumes in {config_path} after root filesystem is mounted.",
         f"After=local-fs.target",
         f"Requires=local-fs.target",
         f"",
@@ -81,34 +248,30 @@ def Main():
     if os.path.exists(service_path) and os.path.getmtime(script_path) < os.path.getmtime(service_path):
         PrintWarning(f"Not installing because service in \"{service_path}\" is newer than \"{script_path}\".")
         return 1
-    if os.path.exists(service_path) and os.path.getmtime(script_path) > os.path.getmtime(service_path):
+    if not os.path.exists(service_path) or os.path.getmtime(script_path) > os.path.getmtime(service_path):
         WriteFile(service_path, "".join([ line + "\n" for line in service_payload ]))
         script_stat = os.stat(script_path)
         os.utime(service_path, (script_stat.st_atime, script_stat.st_mtime))
         RunCommand(f"chmod 755 \"{service_path}\"")
         RunCommand(f"chown +0:+0 \"{service_path}\"")
         print(f"Installed {script_name} service to \"{service_path}\".")
-    RunCommand("systemctl enable important_data")
+    if not os.path.exists("/etc/systemd/system/multi-user.target.wants/important_data.service"):
+        RunCommand("systemctl enable important_data")
 
-    if not os.path.exists("/important_data"):
-        RunCommand("mkdir /important_data")
-        RunCommand("chmod 777 /important_data")
-        RunCommand("chown root:root /important_data")
-    if len(os.listdir("/important_data")) != 0:
-        PrintError("/important_data is not empty.")
-        return 1
-    if RunCommand("findmnt /important_data", check=False) == 0:
-        PrintError("Something is already mounted at /important_data.")
-    important_data_dev, status_code = RunCommand("blkid --uuid c6b3988d-979c-4468-9b05-59c01ac32ad7", check=False, capture=True)
-    if status_code != 0:
-        PrintError("important_data drive is not connected to this PC.")
-        return 1
-    important_data_key_path = "/etc/important_data.key"
-    if not os.path.exists(important_data_key_path):
-        PrintError(f"Key could not be found at {important_data_key_path}.")
-        return 1
-    RunCommand(f"cryptsetup open \"{important_data_dev}\" crypt_important_data --key-file=\"{important_data_key_path}\"")
-    RunCommand("mount -t ext4 -o rw,noatime,discard,errors=remount-ro /dev/mapper/crypt_important_data /important_data")
+    # Unlock and mount every volume concurrently so key derivation isn't paid serially
+    start_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(volumes)) as executor:
+        futures = [ executor.submit(MountVolume, volume) for volume in volumes ]
+    status_code = 0
+    for volume, future in zip(volumes, futures):
+        if future.exception() != None:
+            PrintError(f"Failed to mount {volume["name"]}. {future.exception()}")
+            status_code = 1
+            continue
+        timings = future.result()
+        print(f"Mounted {volume["name"]} at {volume["mount_path"]} (unlock {timings["unlock"]:.2f}s, mount {timings["mount"]:.2f}s).")
+    print(f"Finished {len(volumes)} volume(s) in {time.monotonic() - start_time:.2f}s.")
 
-    return 0
-sys.exit(Main())
\ No newline at end of file
+    return status_code
+if __name__ == "__main__":
+    sys.exit(Main())